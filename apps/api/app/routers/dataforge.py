@@ -13,7 +13,7 @@ import logging
 from ..core.auth import get_current_user, get_user_organization
 from ..services.database_engines import (
     DatabaseEngine, DatabaseType, QueryResult, QueryStatus,
-    create_engine
+    create_engine, get_engine, engine_pool
 )
 from ..core.supabase import get_supabase_client
 
@@ -210,6 +210,9 @@ async def update_connection(
     if not result.data:
         raise HTTPException(status_code=404, detail="Connection not found")
 
+    # Engines built from the old config must not be reused
+    engine_pool.invalidate(connection_id)
+
     return result.data[0]
 
 
@@ -229,6 +232,8 @@ async def delete_connection(
     if not result.data:
         raise HTTPException(status_code=404, detail="Connection not found")
 
+    engine_pool.invalidate(connection_id)
+
     return {"message": "Connection deleted successfully"}
 
 
@@ -251,10 +256,11 @@ async def test_connection(
     connection_data = result.data[0]
 
     try:
-        # Create engine and test
-        engine = create_engine(
+        # Get the pooled engine and test
+        engine = get_engine(
+            connection_id,
             DatabaseType(connection_data["type"]),
-            json.loads(connection_data["connection_config"])
+            connection_data["connection_config"]
         )
         is_valid = await engine.test_connection()
 
@@ -270,6 +276,38 @@ async def test_connection(
         }
 
 
+@router.get("/connections/{connection_id}/schema/{database}")
+async def get_connection_schema(
+    connection_id: str,
+    database: str,
+    refresh: bool = False,
+    org_id = Depends(get_user_organization)
+):
+    """Get the tables and columns of a database, cached per connection."""
+    supabase = get_supabase_client()
+
+    result = supabase.table("database_connections").select(
+        "type, connection_config"
+    ).eq("id", connection_id).eq("organization_id", org_id).execute()
+
+    if not result.data:
+        raise HTTPException(status_code=404, detail="Connection not found")
+
+    connection_data = result.data[0]
+
+    engine = get_engine(
+        connection_id,
+        DatabaseType(connection_data["type"]),
+        connection_data["connection_config"]
+    )
+    schema_info = await engine.get_schema_info(database, refresh=refresh)
+
+    if "error" in schema_info:
+        raise HTTPException(status_code=400, detail=schema_info["error"])
+
+    return schema_info
+
+
 # Queries endpoints
 @router.post("/queries", response_model=QueryResponse)
 async def create_query(
@@ -474,10 +512,11 @@ async def execute_query_background(
             "started_at": datetime.utcnow().isoformat()
         }).eq("id", job_id).execute()
 
-        # Create database engine
-        engine = create_engine(
+        # Get the pooled database engine
+        engine = get_engine(
+            connection_data["id"],
             DatabaseType(connection_data["type"]),
-            json.loads(connection_data["connection_config"])
+            connection_data["connection_config"]
         )
 
         # Substitute parameters in SQL
@@ -582,9 +621,10 @@ async def cancel_job(
 
             if conn_result.data:
                 connection_data = conn_result.data[0]
-                engine = create_engine(
+                engine = get_engine(
+                    connection_data["id"],
                     DatabaseType(connection_data["type"]),
-                    json.loads(connection_data["connection_config"])
+                    connection_data["connection_config"]
                 )
                 await engine.cancel_job(job_data["external_job_id"])
 
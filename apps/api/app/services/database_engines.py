@@ -4,14 +4,49 @@ Provides unified interface for BigQuery, Snowflake, Databricks, etc.
 """
 
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional, Any
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Tuple
 from enum import Enum
 import asyncio
+import hashlib
+import json
 import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 logger = logging.getLogger(__name__)
 
+# Client libraries are synchronous: their calls run on this bounded pool
+# so they never block the event loop
+ENGINE_IO_WORKERS = int(os.environ.get("ENGINE_IO_WORKERS", "32"))
+
+# Job polling backs off from the first to the max interval, in seconds
+JOB_POLL_INITIAL_INTERVAL = 0.1
+JOB_POLL_MAX_INTERVAL = 2.0
+
+_io_pool: Optional[ThreadPoolExecutor] = None
+_io_pool_lock = threading.Lock()
+
+
+def _get_io_pool() -> ThreadPoolExecutor:
+    global _io_pool
+    with _io_pool_lock:
+        if _io_pool is None:
+            _io_pool = ThreadPoolExecutor(
+                max_workers=ENGINE_IO_WORKERS, thread_name_prefix="engine-io"
+            )
+        return _io_pool
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking client call on the engine IO pool and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_io_pool(), lambda: func(*args, **kwargs))
+
 
 class DatabaseType(str, Enum):
     BIGQUERY = "bigquery"
@@ -48,6 +83,57 @@ class QueryResult:
         self.created_at = datetime.utcnow()
 
 
+def config_hash(connection_config: Dict[str, Any]) -> str:
+    """Stable hash of a connection config, used to key per-connection caches."""
+    canonical = json.dumps(connection_config, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class SchemaCache:
+    """
+    Process-wide cache of schema info keyed by connection and database.
+
+    Entries expire after ttl_seconds and the least recently used are
+    evicted beyond max_entries. Thread safe.
+    """
+
+    def __init__(self, ttl_seconds: float = 300.0, max_entries: int = 256):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, connection_key: str, database: str) -> Optional[Dict[str, Any]]:
+        key = (connection_key, database)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, schema_info = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return schema_info
+
+    def put(self, connection_key: str, database: str, schema_info: Dict[str, Any]):
+        key = (connection_key, database)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, schema_info)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, connection_key: str):
+        """Drop every cached database of a connection."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == connection_key]:
+                del self._entries[key]
+
+
+schema_cache = SchemaCache()
+
+
 class DatabaseEngine(ABC):
     """Abstract base class for all database engines."""
 
@@ -86,11 +172,43 @@ class DatabaseEngine(ABC):
         pass
 
     @abstractmethod
-    async def get_schema_info(self, database: str) -> Dict[str, Any]:
-        """Get schema information for a database."""
+    async def get_schema_info(self, database: str, refresh: bool = False) -> Dict[str, Any]:
+        """Get schema information for a database, bypassing any cache if refresh."""
         pass
 
 
+# Identifiers SCHEMA_INFO_QUERY formats into backticks are checked against
+# these first: project ids, optionally domain scoped, and dataset names
+PROJECT_ID_PATTERN = re.compile(r"(?:[a-z0-9.-]+:)?[a-z][a-z0-9-]{4,28}[a-z0-9]")
+DATASET_ID_PATTERN = re.compile(r"[A-Za-z0-9_]{1,1024}")
+
+# Every table of a dataset with its columns and nested fields, in one query.
+# INFORMATION_SCHEMA only has the nullability of top level columns, so
+# nested fields are never reported REQUIRED
+SCHEMA_INFO_QUERY = """
+SELECT
+  t.table_name,
+  t.table_type,
+  f.column_name,
+  f.field_path,
+  f.data_type,
+  c.is_nullable
+FROM `{project}.{dataset}`.INFORMATION_SCHEMA.TABLES t
+LEFT JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMN_FIELD_PATHS f
+  ON f.table_name = t.table_name
+LEFT JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.COLUMNS c
+  ON c.table_name = f.table_name AND c.column_name = f.column_name
+ORDER BY t.table_name, c.ordinal_position, f.field_path
+"""
+
+# INFORMATION_SCHEMA reports standard SQL type names, get_table legacy ones
+LEGACY_TYPE_NAMES = {
+    "INT64": "INTEGER",
+    "FLOAT64": "FLOAT",
+    "BOOL": "BOOLEAN",
+}
+
+
 class BigQueryEngine(DatabaseEngine):
     """BigQuery implementation using the bqm2 engine."""
 
@@ -131,8 +249,9 @@ class BigQueryEngine(DatabaseEngine):
         try:
             # Simple query to test connection
             query = "SELECT 1 as test"
-            job = self._client.query(query)
-            result = job.result()
+            job = await run_blocking(self._client.query, query)
+            await self._wait_for_job(job)
+            await run_blocking(job.result)
             return True
         except Exception as e:
             logger.error(f"BigQuery connection test failed: {e}")
@@ -142,6 +261,7 @@ class BigQueryEngine(DatabaseEngine):
         """Execute BigQuery SQL using bqm2 patterns."""
         try:
             import uuid
+            from google.cloud import bigquery
             query_id = str(uuid.uuid4())
 
             # Configure job
@@ -152,25 +272,25 @@ class BigQueryEngine(DatabaseEngine):
 
             # Execute query
             start_time = datetime.utcnow()
-            job = self._client.query(sql, job_config=job_config, job_id=query_id)
+            job = await run_blocking(
+                self._client.query, sql, job_config=job_config, job_id=query_id
+            )
 
-            # Wait for completion (async in production)
-            result = job.result()
+            # Poll for completion without holding a thread for the whole query
+            await self._wait_for_job(job)
             end_time = datetime.utcnow()
 
             execution_time_ms = int((end_time - start_time).total_seconds() * 1000)
 
-            # Convert results to list of dicts
-            result_data = []
-            for row in result:
-                result_data.append(dict(row))
+            # Only fetch the rows returned by the API response
+            total_rows, result_data = await run_blocking(self._fetch_preview, job, 100)
 
             return QueryResult(
                 query_id=query_id,
                 status=QueryStatus.COMPLETED,
-                rows_affected=result.total_rows,
+                rows_affected=total_rows,
                 execution_time_ms=execution_time_ms,
-                result_data=result_data[:100]  # Limit for API response
+                result_data=result_data
             )
 
         except Exception as e:
@@ -184,7 +304,7 @@ class BigQueryEngine(DatabaseEngine):
     async def get_job_status(self, job_id: str) -> QueryStatus:
         """Get BigQuery job status."""
         try:
-            job = self._client.get_job(job_id)
+            job = await run_blocking(self._client.get_job, job_id)
 
             if job.state == "PENDING":
                 return QueryStatus.PENDING
@@ -204,16 +324,30 @@ class BigQueryEngine(DatabaseEngine):
     async def cancel_job(self, job_id: str) -> bool:
         """Cancel BigQuery job."""
         try:
-            job = self._client.get_job(job_id)
-            job.cancel()
+            job = await run_blocking(self._client.get_job, job_id)
+            await run_blocking(job.cancel)
             return True
         except Exception as e:
             logger.error(f"Failed to cancel job: {e}")
             return False
 
+    async def _wait_for_job(self, job):
+        """Poll a job until it is done, sleeping on the event loop in between."""
+        interval = JOB_POLL_INITIAL_INTERVAL
+        while not await run_blocking(job.done):
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, JOB_POLL_MAX_INTERVAL)
+
+    def _fetch_preview(self, job, max_rows: int):
+        """Total row count and the first max_rows rows of a finished job."""
+        result = job.result(max_results=max_rows)
+        return result.total_rows, [dict(row) for row in result]
+
     def validate_sql(self, sql: str) -> Dict[str, Any]:
         """Validate BigQuery SQL syntax."""
         try:
+            from google.cloud import bigquery
+
             # Use dry run to validate
             job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
             job = self._client.query(sql, job_config=job_config)
@@ -229,40 +363,88 @@ class BigQueryEngine(DatabaseEngine):
                 "error": str(e)
             }
 
-    async def get_schema_info(self, database: str) -> Dict[str, Any]:
-        """Get BigQuery dataset/table schema info."""
+    async def get_schema_info(self, database: str, refresh: bool = False) -> Dict[str, Any]:
+        """
+        Get BigQuery dataset/table schema info.
+
+        Tables and their columns, nested fields flattened to dotted paths,
+        come from a single INFORMATION_SCHEMA query and are cached per
+        connection for schema_cache.ttl_seconds. Nested fields are REPEATED
+        or NULLABLE, never REQUIRED, see SCHEMA_INFO_QUERY.
+        """
+        connection_key = config_hash(self.connection_config)
+        if not refresh:
+            cached = schema_cache.get(connection_key, database)
+            if cached is not None:
+                return cached
+
         try:
-            dataset = self._client.get_dataset(database)
-            tables = list(self._client.list_tables(dataset))
+            if "." in database:
+                project, dataset = database.rsplit(".", 1)
+            else:
+                project, dataset = self._client.project, database
+            if not PROJECT_ID_PATTERN.fullmatch(project):
+                return {"error": f"Invalid BigQuery project id: {project!r}"}
+            if not DATASET_ID_PATTERN.fullmatch(dataset):
+                return {"error": f"Invalid BigQuery dataset name: {dataset!r}"}
+
+            job = await run_blocking(
+                self._client.query,
+                SCHEMA_INFO_QUERY.format(project=project, dataset=dataset)
+            )
+            await self._wait_for_job(job)
+            rows = await run_blocking(lambda: list(job.result()))
+            schema_info = self._build_schema_info(database, rows)
 
-            schema_info = {
-                "database": database,
-                "tables": []
-            }
+        except Exception as e:
+            logger.error(f"Failed to get schema info: {e}")
+            return {"error": str(e)}
+
+        schema_cache.put(connection_key, database, schema_info)
+        return schema_info
 
-            for table in tables:
+    def _build_schema_info(self, database: str, rows) -> Dict[str, Any]:
+        """Group SCHEMA_INFO_QUERY rows, ordered by table, into schema info."""
+        schema_info = {
+            "database": database,
+            "tables": []
+        }
+
+        table_info = None
+        for row in rows:
+            if table_info is None or table_info["name"] != row["table_name"]:
                 table_info = {
-                    "name": table.table_id,
-                    "type": table.table_type,
+                    "name": row["table_name"],
+                    "type": row["table_type"].replace("BASE TABLE", "TABLE").replace(" ", "_"),
                     "schema": []
                 }
-
-                # Get table schema
-                full_table = self._client.get_table(table.reference)
-                for field in full_table.schema:
-                    table_info["schema"].append({
-                        "name": field.name,
-                        "type": field.field_type,
-                        "mode": field.mode
-                    })
-
                 schema_info["tables"].append(table_info)
 
-            return schema_info
+            if row["field_path"] is None:
+                # table without columns
+                continue
 
-        except Exception as e:
-            logger.error(f"Failed to get schema info: {e}")
-            return {"error": str(e)}
+            field_type, mode = self._field_type_and_mode(
+                row["data_type"], row["field_path"] == row["column_name"] and row["is_nullable"] == "NO"
+            )
+            table_info["schema"].append({
+                "name": row["field_path"],
+                "type": field_type,
+                "mode": mode
+            })
+
+        return schema_info
+
+    def _field_type_and_mode(self, data_type: str, required: bool) -> Tuple[str, str]:
+        """Map an INFORMATION_SCHEMA data type to the type and mode get_table reports."""
+        mode = "REQUIRED" if required else "NULLABLE"
+        if data_type.startswith("ARRAY<"):
+            data_type = data_type[len("ARRAY<"):-1]
+            mode = "REPEATED"
+        if data_type.startswith("STRUCT<"):
+            return "RECORD", mode
+        base_type = data_type.split("(")[0].split("<")[0]
+        return LEGACY_TYPE_NAMES.get(base_type, base_type), mode
 
     def _format_parameters(self, params: Dict) -> List:
         """Format parameters for BigQuery."""
@@ -320,7 +502,7 @@ class SnowflakeEngine(DatabaseEngine):
     def validate_sql(self, sql: str) -> Dict[str, Any]:
         raise NotImplementedError("Snowflake engine not yet implemented")
 
-    async def get_schema_info(self, database: str) -> Dict[str, Any]:
+    async def get_schema_info(self, database: str, refresh: bool = False) -> Dict[str, Any]:
         raise NotImplementedError("Snowflake engine not yet implemented")
 
 
@@ -333,4 +515,75 @@ def create_engine(engine_type: DatabaseType, connection_config: Dict[str, Any])
     elif engine_type == DatabaseType.SNOWFLAKE:
         return SnowflakeEngine(connection_config)
     else:
-        raise ValueError(f"Unsupported database type: {engine_type}")
\ No newline at end of file
+        raise ValueError(f"Unsupported database type: {engine_type}")
+
+
+class EnginePool:
+    """
+    Process-wide pool of engines keyed by connection id, type and config hash.
+
+    Reusing an engine reuses its client, with its HTTP session and
+    credentials, so only the first request of a connection pays for
+    building them. The least recently used engines are dropped beyond
+    max_engines. Thread safe.
+    """
+
+    def __init__(self, max_engines: int = 64):
+        self.max_engines = max_engines
+        self._engines: "OrderedDict[Tuple[str, DatabaseType, str], DatabaseEngine]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        connection_id: str,
+        engine_type: DatabaseType,
+        connection_config: Any,
+    ) -> DatabaseEngine:
+        """
+        Engine for a connection, created on first use.
+
+        connection_config may be the stored JSON string, which is then only
+        parsed when a new engine has to be created.
+        """
+        if isinstance(connection_config, str):
+            digest = hashlib.sha256(connection_config.encode("utf-8")).hexdigest()
+        else:
+            digest = config_hash(connection_config)
+        key = (connection_id, engine_type, digest)
+
+        with self._lock:
+            engine = self._engines.get(key)
+            if engine is not None:
+                self._engines.move_to_end(key)
+                return engine
+
+        if isinstance(connection_config, str):
+            connection_config = json.loads(connection_config)
+        engine = create_engine(engine_type, connection_config)
+
+        with self._lock:
+            # keep the engine another request may have created meanwhile
+            engine = self._engines.setdefault(key, engine)
+            self._engines.move_to_end(key)
+            # engines are dropped, not closed, as requests may still use them
+            while len(self._engines) > self.max_engines:
+                self._engines.popitem(last=False)
+        return engine
+
+    def invalidate(self, connection_id: str):
+        """Drop every engine of a connection, i.e. after its config changed."""
+        with self._lock:
+            for key in [k for k in self._engines if k[0] == connection_id]:
+                del self._engines[key]
+
+
+engine_pool = EnginePool(max_engines=int(os.environ.get("ENGINE_POOL_SIZE", "64")))
+
+
+def get_engine(
+    connection_id: str,
+    engine_type: DatabaseType,
+    connection_config: Any,
+) -> DatabaseEngine:
+    """Pooled engine for a stored connection, see EnginePool."""
+    return engine_pool.get(connection_id, engine_type, connection_config)
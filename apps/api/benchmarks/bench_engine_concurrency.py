@@ -0,0 +1,89 @@
+"""
+Run N queries at once through BigQueryEngine.execute_query and compare
+the wall time with waiting on each job in the event loop, as the engine
+used to.
+
+No request leaves the machine: the BigQuery client is replaced by one
+whose jobs finish after the given number of seconds and whose API calls
+take a few milliseconds.
+
+    python benchmarks/bench_engine_concurrency.py [queries] [seconds]
+"""
+import asyncio
+import os
+import sys
+import time
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app", "services"))
+
+import database_engines  # noqa: E402
+from database_engines import BigQueryEngine, QueryStatus  # noqa: E402
+
+API_LATENCY_SECONDS = 0.005
+
+
+class FakeRows(list):
+    total_rows = 1
+
+
+class FakeJob:
+    def __init__(self, seconds):
+        self.finishes_at = time.monotonic() + seconds
+
+    def done(self, *args, **kwargs):
+        time.sleep(API_LATENCY_SECONDS)
+        return time.monotonic() >= self.finishes_at
+
+    def result(self, *args, **kwargs):
+        time.sleep(max(0, self.finishes_at - time.monotonic()) + API_LATENCY_SECONDS)
+        return FakeRows([{"x": 1}])
+
+
+class FakeClient:
+    project = "benchmark"
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def query(self, sql, **kwargs):
+        time.sleep(API_LATENCY_SECONDS)
+        return FakeJob(self.seconds)
+
+
+def make_engine(seconds):
+    with mock.patch.object(BigQueryEngine, "_setup_client"):
+        engine = BigQueryEngine({"project_id": "benchmark"})
+    engine._client = FakeClient(seconds)
+    return engine
+
+
+async def blocking_execute(engine, sql):
+    """What execute_query used to do: wait on the job in the event loop."""
+    job = engine._client.query(sql)
+    return job.result()
+
+
+async def run(queries, execute):
+    started = time.monotonic()
+    results = await asyncio.gather(*[execute("SELECT %d" % i) for i in range(queries)])
+    return time.monotonic() - started, results
+
+
+def main():
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 0.5
+    engine = make_engine(seconds)
+
+    blocking, _ = asyncio.run(run(queries, lambda sql: blocking_execute(engine, sql)))
+    pooled, results = asyncio.run(run(queries, engine.execute_query))
+    assert all(r.status == QueryStatus.COMPLETED for r in results), \
+        [r.error_message for r in results]
+
+    print("%d queries of %.2fs (%d IO workers): blocking %.2fs, non-blocking %.2fs (%.1fx)"
+          % (queries, seconds, database_engines.ENGINE_IO_WORKERS,
+             blocking, pooled, blocking / pooled))
+
+
+if __name__ == "__main__":
+    main()
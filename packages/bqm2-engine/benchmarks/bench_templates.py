@@ -0,0 +1,62 @@
+"""
+Compare rendering a many variant union table query with str.format
+against tmplhelper.compileTemplate.
+
+    python benchmarks/bench_templates.py [variants]
+"""
+import os
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import tmplhelper  # noqa: E402
+
+
+def makeTemplate(columns=200):
+    select = ",\n".join("  {prefix}_col%d" % i for i in range(columns))
+    return ("SELECT\n" + select +
+            "\nFROM `{project}.{dataset}.{table}_{region}_{yyyymmdd}`"
+            "\nWHERE product = '{product}'")
+
+
+def makeVariants(n):
+    return [{"prefix": "p", "project": "proj", "dataset": "ds",
+             "table": "events", "region": "r%d" % (i % 20),
+             "yyyymmdd": str(20230101 + i % 365),
+             "product": "prod%d" % (i % 5)} for i in range(n)]
+
+
+def renderWithFormat(template, variants):
+    for v in variants:
+        needed = set(x[1] for x in string.Formatter().parse(template)
+                     if x[1])
+        assert needed.issubset(v.keys())
+        template.format(**v)
+
+
+def renderCompiled(template, variants):
+    for v in variants:
+        compiled = tmplhelper.compileTemplate(template)
+        assert compiled.keys.issubset(v.keys())
+        compiled.format(v)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    template = makeTemplate()
+    variants = makeVariants(n)
+    assert [template.format(**v) for v in variants] == \
+        [tmplhelper.compileTemplate(template).format(v) for v in variants]
+
+    formatted = min(timeit.repeat(
+        lambda: renderWithFormat(template, variants), number=1, repeat=3))
+    compiled = min(timeit.repeat(
+        lambda: renderCompiled(template, variants), number=1, repeat=3))
+    print("%d variants: str.format %.3fs, compiled %.3fs (%.1fx)" %
+          (n, formatted, compiled, formatted / compiled))
+
+
+if __name__ == "__main__":
+    main()
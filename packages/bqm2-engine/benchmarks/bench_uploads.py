@@ -0,0 +1,84 @@
+"""
+Compare uploading a .localdata file as is against gzipping it first.
+
+No request leaves the machine: the client's load_table_from_file is
+replaced by one that reads the file it is given and charges the
+transfer at the given bandwidth, so the wall time is the time to
+prepare the upload plus the time to send its bytes.
+
+    python benchmarks/bench_uploads.py [rows] [megabits per second]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from google.cloud.bigquery.table import Table  # noqa: E402
+from google.cloud.exceptions import NotFound  # noqa: E402
+
+import resource  # noqa: E402
+
+
+class MeteredClient:
+    """ stands in for a bigquery Client, counting the bytes uploaded """
+
+    def __init__(self, megabitsPerSecond):
+        self.bytesPerSecond = megabitsPerSecond * 10**6 / 8
+        self.sent = 0
+        self.sendSeconds = 0
+
+    def get_table(self, table):
+        raise NotFound("benchmark")
+
+    def load_table_from_file(self, source, table, job_config, job_id,
+                             size):
+        sent = 0
+        while True:
+            buf = source.read(2**20)
+            if not buf:
+                break
+            sent += len(buf)
+        self.sent += sent
+        self.sendSeconds += sent / self.bytesPerSecond
+        return None
+
+
+def writeExtract(path, rows):
+    with open(path, "w") as f:
+        f.write("id\tcustomer\tcountry\tamount\tcreated\n")
+        for i in range(rows):
+            f.write("%d\tcustomer-%d\t%s\t%d.%02d\t2023-01-%02d 12:00:00\n"
+                    % (i, i % 5000, ["GB", "US", "DE", "FR"][i % 4],
+                       i % 977, i % 100, 1 + i % 28))
+
+
+def upload(path, compression, megabitsPerSecond):
+    client = MeteredClient(megabitsPerSecond)
+    rsrc = resource.BqDataLoadTableResource(
+        path, Table("p.d.t"), (), client, None,
+        uploadCompression=compression)
+    started = time.time()
+    rsrc.create()
+    prepare = time.time() - started
+    return (client.sent, prepare, prepare + client.sendSeconds)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    megabitsPerSecond = float(sys.argv[2]) if len(sys.argv) > 2 else 100
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "extract.localdata")
+        writeExtract(path, rows)
+        print("%d rows, %.1f MB on disk, %g Mbit/s" %
+              (rows, os.path.getsize(path) / 10**6, megabitsPerSecond))
+        for compression in resource.UPLOAD_COMPRESSIONS:
+            (sent, prepare, wall) = upload(path, compression,
+                                           megabitsPerSecond)
+            print("%-5s sent %8.1f MB, prepared in %.2fs, wall %.2fs" %
+                  (compression, sent / 10**6, prepare, wall))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
 #!/usr/bin/env python
+import asyncio
+import contextlib
+import heapq
+import itertools
 import json
 import os
 import logging
@@ -8,9 +12,13 @@ from kvoption import KVOption
 from genericpath import isfile
 from os import listdir
 import re
+import threading
+import time
 from time import sleep
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    wait
 
 import yaml
 from google.cloud import storage
@@ -19,12 +27,113 @@ from google.cloud.bigquery.client import Client
 from loader import DelegatingFileSuffixLoader, \
     BqQueryTemplatingFileLoader, BqDataFileLoader, \
     TableType
-from resource import BqJobs
+from resource import BqJobs, BqTables, JobTracker, GcsListings, \
+    ResourceKeyIndex, UPLOAD_COMPRESSIONS
 from google.cloud import bigquery
 
-from google.api_core.exceptions import PreconditionFailed
+from google.api_core.exceptions import GoogleAPIError, PreconditionFailed
 import datetime
 import tmplhelper
+from render_cache import RenderCache
+from job_history import JobHistory
+from local_state import LocalState
+from file_hashes import FileHashes
+
+
+class DependencyPlan:
+    """
+    Topological plan of a dependency graph.
+
+    Runs Kahn's algorithm once over the graph using in-degree counters.
+    levels[0] holds the keys with no dependencies, levels[i] the keys
+    whose last dependency is in levels[i - 1].  Keys which can never run
+    (they are on or behind a cycle) end up in blocked, and cycles holds
+    the actual cycle paths found among them.
+    """
+
+    def __init__(self, dependencies: dict):
+        """ dependencies: a dict keys point to sets of keys forming a graph """
+        self.dependencies = dependencies
+        self.dependents = defaultdict(set)
+        inDegree = {}
+        for (key, deps) in dependencies.items():
+            inDegree[key] = len(deps)
+            for dep in deps:
+                self.dependents[dep].add(key)
+
+        self.levels = []
+        level = sorted([key for (key, n) in inDegree.items() if n == 0])
+        while level:
+            self.levels.append(level)
+            nextLevel = []
+            for key in level:
+                for dependent in self.dependents[key]:
+                    inDegree[dependent] -= 1
+                    if inDegree[dependent] == 0:
+                        nextLevel.append(dependent)
+            level = sorted(nextLevel)
+
+        self.blocked = set([key for (key, n) in inDegree.items() if n > 0])
+        self.cycles = self._findCycles()
+
+    def _findCycles(self) -> list:
+        """ walk dependency edges between blocked keys.  Each walk either
+        closes a loop on itself, which is a cycle, or runs into a key an
+        earlier walk already visited.  Every key is visited once. """
+        cycles = []
+        visited = set()
+        for start in sorted(self.blocked):
+            path = []
+            onPath = {}
+            key = start
+            while key is not None and key not in visited:
+                visited.add(key)
+                onPath[key] = len(path)
+                path.append(key)
+                nextKeys = sorted(self.dependencies[key] & self.blocked)
+                key = nextKeys[0] if nextKeys else None
+            if key is not None and key in onPath:
+                cycles.append(path[onPath[key]:] + [key])
+        return cycles
+
+    def order(self) -> list:
+        """ all runnable keys, dependencies first """
+        return [key for level in self.levels for key in level]
+
+    def priorities(self, durations: dict = None) -> dict:
+        """
+        Rank runnable keys for scheduling, higher first.
+
+        The critical path of a key is its own duration plus the longest
+        critical path among its dependents.  Keys without a recorded
+        duration weigh the mean of the recorded ones.  With no history
+        at all every path is 0 and keys fall back to ranking by their
+        number of (transitive) descendants.
+
+        :param durations: dict of key to seconds from past runs
+        :return: dict of key to (critical path seconds, descendants)
+        """
+        durations = durations or {}
+        order = self.order()
+        known = [durations[k] for k in order if k in durations]
+        default = sum(known) / len(known) if known else 0
+        position = {key: i for (i, key) in enumerate(order)}
+
+        descendants = {}
+        criticalPath = {}
+        for key in reversed(order):
+            mask = 0
+            longest = 0
+            for dependent in self.dependents[key]:
+                if dependent in self.blocked:
+                    continue
+                mask |= descendants[dependent] | (1 << position[dependent])
+                longest = max(longest, criticalPath[dependent])
+            descendants[key] = mask
+            criticalPath[key] = durations.get(key, default) + longest
+
+        return {key: (criticalPath[key], bin(descendants[key]).count("1"))
+                for key in order}
 
 
 def find_cycles(dependencies: dict):
@@ -32,25 +141,66 @@ def find_cycles(dependencies: dict):
         dependencies: a dict keys point to sets of keys forming a graph
         return sub keys of dependencies which contain a cycle
     """
-    while len(dependencies):
-        torm = set()
-        for key in dependencies.keys():
-            if not len(dependencies[key]):
-                torm.add(key)
+    return DependencyPlan(dependencies).blocked
 
-        if not torm:
-            # these keys have a cycle
-            return set(dependencies.keys())
 
-        # remove keys with no dependencies
-        for key in torm:
-            del dependencies[key]
+DEFAULT_POOL = "default"
+DEFAULT_MAX_CONCURRENT = 10
 
-        # remove removed keys from anyone that depends on it
-        for key in dependencies.keys():
-            dependencies[key] = dependencies[key] - torm
 
-    return set()
+def parseMaxConcurrent(value: str, pools=None) -> dict:
+    """
+    Parse --maxConcurrent.  Either a single number shared by every
+    resource or comma separated pool=number pairs, i.e.
+    query=20,load=50,extract=10,process=4.  A bare number in the list
+    is the limit of pools not named.
+
+    :param pools: the pools resources use.  Naming any other is an
+    error, most likely a typo
+    :return: dict of pool name to its maximum concurrent jobs
+    """
+    limits = {}
+    for item in value.split(","):
+        (pool, _, n) = item.strip().rpartition("=")
+        try:
+            limits[pool or DEFAULT_POOL] = int(n)
+        except ValueError:
+            raise Exception("maxConcurrent must be a number or "
+                            "pool=number pairs, not " + value)
+        if pools is not None and pool and pool != DEFAULT_POOL \
+                and pool not in pools:
+            raise Exception("maxConcurrent names pool " + pool +
+                            " which no resource uses, not one of " +
+                            ", ".join(sorted(pools)))
+    return limits
+
+
+def concurrencyLimits(maxConcurrent) -> dict:
+    """ :param maxConcurrent: an int shared by every pool or a dict as
+    returned by parseMaxConcurrent
+    :return: dict of pool to limit, always holding DEFAULT_POOL """
+    if isinstance(maxConcurrent, dict):
+        return {DEFAULT_POOL: DEFAULT_MAX_CONCURRENT, **maxConcurrent}
+    return {DEFAULT_POOL: maxConcurrent}
+
+
+def buildDependencies(resources: dict) -> dict:
+    """
+        resources: a dict of resources keyed by their key
+        return a dict of keys pointing to the set of keys each resource
+        depends on.  Candidates are looked up through a ResourceKeyIndex
+        so we only call dependsOn for pairs which may actually match.
+    """
+    index = ResourceKeyIndex(resources.values())
+    resourceDependencies = {key: set() for key in resources}
+    for rsrc in resources.values():
+        candidates = {osrc.key(): osrc
+                      for osrc in rsrc.dependencyCandidates(index)}
+        for osrc in candidates.values():
+            if rsrc.dependsOn(osrc):
+                resourceDependencies[rsrc.key()].add(osrc.key())
+
+    return resourceDependencies
 
 
 class DependencyBuilder:
@@ -58,77 +208,175 @@ class DependencyBuilder:
     Dependency builder loads resources from the folders specified.
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, renderWorkers=1):
+        """
+        :param renderWorkers: when > 1 the pure template rendering work
+        of the loader is fanned out to a pool of this many processes.
+        Resources are still built here, in file order.
+        """
         self.loader = loader
+        self.renderWorkers = renderWorkers
+        self.plan = None
 
     def buildDepend(self, folders, dryrun) -> tuple:
         """ folders arg is an array of strings which should point
         at folders containing resource descriptions loadable by
         self.loader """
-        resources = {}
+        files = []
         for folder in folders:
             folder = re.sub("/$", "", folder)
             for name in listdir(folder):
                 file = "/".join([folder, name])
                 if isfile(file) and self.loader.handles(file):
-                    for rsrc in self.loader.load(file, dryrun):
-                        resources[rsrc.key()] = rsrc
+                    files.append(file)
 
-        resourceDependencies = {rsrc.key(): set() for rsrc in resources.values()}
+        resources = {}
+        for rsrc in self.loadFiles(files, dryrun):
+            resources[rsrc.key()] = rsrc
 
-        for rsrc in resources.values():
-            for osrc in resources.values():
-                if rsrc.dependsOn(osrc):
-                    resourceDependencies[rsrc.key()].add(osrc.key())
+        resourceDependencies = buildDependencies(resources)
 
-        copy = {key: set([x for x in resourceDependencies[key]]) for key in resourceDependencies}
-        cycles = find_cycles(copy)
-        if cycles:
+        self.plan = DependencyPlan(resourceDependencies)
+        if self.plan.blocked:
+            paths = "\n".join([" -> ".join(cycle)
+                               for cycle in self.plan.cycles])
             raise Exception("There are cycles in your templates.  Please make sure "
-                            "your recent changes have not introduced any cycles")
+                            "your recent changes have not introduced any cycles:\n"
+                            + paths)
 
         return (resources, resourceDependencies)
 
 
+    def loadFiles(self, files, dryrun):
+        if self.renderWorkers <= 1:
+            for file in files:
+                yield from self.loader.load(file, dryrun)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.renderWorkers) as pool:
+            rendered = {}
+            for file in files:
+                renderer = self.loader.renderer(file)
+                if renderer is not None:
+                    (func, args) = renderer
+                    rendered[file] = pool.submit(func, *args)
+
+            for file in files:
+                if file in rendered:
+                    yield from self.loader.loadRendered(
+                        file, rendered[file].result(), dryrun)
+                else:
+                    yield from self.loader.load(file, dryrun)
+
+
+def prefetchFileHashes(fileHashes: FileHashes, resources: dict,
+                       workers: int = 16):
+    """ hash the local files of all resources in parallel so planning
+    doesn't read them one at a time """
+    fileHashes.prefetch([f for rsrc in resources.values()
+                         for f in rsrc.localFiles()], workers)
+
+
+def adoptInFlightJobs(bqJobs: BqJobs, resources: dict):
+    """ Scan the running and pending jobs of the resources in the dag
+    and hand each resource the job creating it, if any """
+    prefixes = set([rsrc.jobPrefix() for rsrc in resources.values()])
+    prefixes.discard(None)
+    bqJobs.loadTableJobs(prefixes)
+    for rsrc in resources.values():
+        if rsrc.jobPrefix() is None or rsrc.trackedJob() is not None:
+            continue
+        job = bqJobs.getJob(rsrc.jobPrefix())
+        if job is not None:
+            print(f"found existing job: {job.job_id}")
+            rsrc.adoptJob(job)
+
+
 class DependencyExecutor:
     """ """
 
-    def __init__(self, resources, dependencies, maxRetry=2):
+    def __init__(self, resources, dependencies, maxRetry=2, plan=None,
+                 history=None, localState=None, trustLocalState=False,
+                 gcsListings=None):
+        """
+        :param history: optional JobHistory used to rank resources
+        :param localState: optional LocalState recording every resource
+        found up to date
+        :param trustLocalState: skip the resources localState says are
+        up to date without checking them against BigQuery
+        :param gcsListings: optional GcsListings shared by the resources,
+        reset whenever gcs may have changed since they were listed
+        """
         self.resources = resources
         self.dependencies = dependencies
         self.maxRetry = maxRetry
+        self.plan = plan or DependencyPlan(dependencies)
+        self.history = history
+        self.priorities = self.plan.priorities(
+            history.durations() if history else None)
+        self.localState = localState
+        self.trustLocalState = trustLocalState
+        # keys skipped on the word of localState and their update times
+        self.trusted = {}
+        self.gcsListings = gcsListings
 
-    def dump(self, folder):
-        """ dump expanded templates to a folder """
-        for (k, s) in sorted(self.dependencies.items()):
-            if len(s):
-                msg = " ".join([x for x in sorted(s)])
-            else:
-                msg = "nothing"
+    def rank(self, n):
+        """ sort key putting the longest critical path first """
+        (criticalPath, descendants) = self.priorities[n]
+        return (-criticalPath, -descendants, n)
 
-            print(k, "depends on", msg)
-        while len(self.dependencies):
-            todel = set([])
-            for n in sorted(self.dependencies.keys()):
-                if not len(self.dependencies[n]):
-                    todel.add(n)
-                    toWrite = folder + "/" \
-                        + self.resources[n].key().replace("/", "_") \
-                        + ".debug"
-                    with open(toWrite, "w") as f:
-                        f.write(self.resources[n].dump())
-                        f.close()
-                    del self.dependencies[n]
-
-            for n in sorted(self.dependencies.keys()):
-                torm = set([])
-                for k in self.dependencies[n]:
-                    if k not in self.dependencies:
-                        torm.add(k)
-
-                    self.dependencies[n] = self.dependencies[n] - torm
+    def poolLimit(self, n, limits):
+        pool = self.resources[n].concurrencyPool()
+        return (pool, limits.get(pool, limits[DEFAULT_POOL]))
 
-    def show(self):
+    def resetListings(self):
+        if self.gcsListings is not None:
+            self.gcsListings.reset()
+
+    def recordDuration(self, n, started):
+        if self.history is not None and started is not None:
+            self.history.record(n, time.time() - started)
+
+    def recordState(self, n, updateTime):
+        if self.localState is None or n in self.trusted:
+            return
+        rsrc = self.resources[n]
+        definitionHash = rsrc.definitionHash()
+        if definitionHash is None:
+            return
+        job = rsrc.trackedJob()
+        self.localState.record(n, definitionHash, updateTime,
+                               job.job_id if job is not None else None)
+
+    def planFromLocalState(self) -> dict:
+        """ Keys the local state says are up to date: their definition
+        hash is the one last materialized, they were materialized after
+        all of their dependencies and those are up to date too.
+
+        :return: dict of key to its recorded update time
+        """
+        states = self.localState.states()
+        trusted = {}
+        for n in self.plan.order():
+            state = states.get(n)
+            if state is None or \
+                    state.hash != self.resources[n].definitionHash():
+                continue
+            deps = self.dependencies[n]
+            if all(k in trusted and trusted[k] <= state.created
+                   for k in deps):
+                trusted[n] = state.created
+        return trusted
+
+    def loadTrusted(self):
+        """ skip probing the keys planFromLocalState says are up to
+        date.  BigQuery isn't asked about them at all """
+        if self.trustLocalState and self.localState is not None:
+            self.trusted = self.planFromLocalState()
+            print("trusting local state of", len(self.trusted), "of",
+                  len(self.plan.order()), "resources")
+
+    def printDependencies(self):
         for (k, s) in sorted(self.dependencies.items()):
             if len(s):
                 msg = " ".join([x for x in sorted(s)])
@@ -137,24 +385,27 @@ class DependencyExecutor:
 
             print(k, "depends on", msg)
 
-        while len(self.dependencies):
-            todel = set([])
-            for n in sorted(self.dependencies.keys()):
-                if not len(self.dependencies[n]):
-                    todel.add(n)
-                    print("would execute", n)
-                    del self.dependencies[n]
-
-            for n in sorted(self.dependencies.keys()):
-                torm = set([])
-                for k in self.dependencies[n]:
-                    if k not in self.dependencies:
-                        torm.add(k)
+    def dump(self, folder):
+        """ dump expanded templates to a folder """
+        self.printDependencies()
+        for n in self.plan.order():
+            toWrite = folder + "/" \
+                + self.resources[n].key().replace("/", "_") \
+                + ".debug"
+            with open(toWrite, "w") as f:
+                f.write(self.resources[n].dump())
 
-                    self.dependencies[n] = self.dependencies[n] - torm
+    def show(self):
+        self.printDependencies()
+        for n in self.plan.order():
+            print("would execute", n)
 
     def dotml(self):
         print("digraph g {\n")
+        for level in self.plan.levels:
+            # keep each level of the plan on the same rank
+            print("{rank=same;",
+                  " ".join(["".join(['"', n, '"']) for n in level]), "}")
         for (k, s) in sorted(self.dependencies.items()):
             if not len(s):
                 continue
@@ -170,9 +421,137 @@ class DependencyExecutor:
             raise Exception("Maximum retries hit for resource",
                             rsrcKey)
 
-    def execute(self, checkFrequency=10, maxConcurrent=10):
+    def reasonToCreate(self, n, depUpdateTime):
+        """ Decide whether resource n must be (re)created.
+
+        :param n: key of the resource
+        :param depUpdateTime: max update time of the resources n
+        depends on
+        :return: why n should be created or None if it is up to date
+        """
+        # check if it doesn't exist in bq
+        if not self.resources[n].exists():
+            return "because it doesn't exist"
+        # check if the query hash has changed
+        # by checking the description for it
+        if self.resources[n].shouldUpdate():
+            return "because our definition has changed"
+        # check if dependencies were updated more recently than resource
+        # if so, we should regenerate resource since dependencies
+        #     may have changed.
+        if self.resources[n].updateTime() < depUpdateTime:
+            return "because our dependencies have changed since we last ran"
+        return None
+
+    def inspectState(self, n):
+        """ :return: (whether n exists, shouldUpdate, updateTime) """
+        rsrc = self.resources[n]
+        if not rsrc.exists():
+            return (False, None, None)
+        return (True, rsrc.shouldUpdate(), rsrc.updateTime())
+
+    def planRebuilds(self, probes) -> dict:
+        """ Work out which resources an execute run would (re)create
+        without creating anything or writing table metadata.  A
+        resource is rebuilt for the same reasons as in reasonToCreate or
+        because one of its dependencies will be.
+
+        :return: dict of key to why it would be created
+        """
+        for rsrc in self.resources.values():
+            rsrc.writeMetadata = False
+        try:
+            inspected = {n: probes.submit(self.inspectState, n)
+                         for n in self.plan.order()}
+            wait(inspected.values())
+        finally:
+            for rsrc in self.resources.values():
+                rsrc.writeMetadata = True
+
+        updateTimes = {}
+        reasons = {}
+        for n in self.plan.order():
+            (exists, shouldUpdate, updateTime) = inspected[n].result()
+            deps = self.dependencies[n]
+            updateTimes[n] = updateTime or 0
+            if not exists:
+                reasons[n] = "because it doesn't exist"
+            elif shouldUpdate:
+                reasons[n] = "because our definition has changed"
+            elif any(k in reasons for k in deps):
+                reasons[n] = "because a dependency will be rebuilt"
+            elif updateTimes[n] < max([0] + [updateTimes[k]
+                                             for k in deps]):
+                reasons[n] = "because our dependencies have changed " \
+                             "since we last ran"
+        return reasons
+
+    def estimate(self, probeWorkers=16, pricePerTiB=6.25) -> tuple:
+        """ Dry run the queries of every resource an execute run would
+        (re)create and report the bytes they would process.
+
+        :param pricePerTiB: on demand price used to estimate the cost
+        :return: (total bytes of the resources we could estimate,
+        keys of those we couldn't)
+        """
+        total = 0
+        unknown = []
+        with ThreadPoolExecutor(max_workers=probeWorkers) as probes:
+            reasons = self.planRebuilds(probes)
+            estimates = {n: probes.submit(self.resources[n].estimateBytes)
+                         for n in reasons}
+            for n in sorted(reasons):
+                try:
+                    estimated = estimates[n].result()
+                except GoogleAPIError as e:
+                    # i.e. reads a table this run is yet to create
+                    print("estimate:", n, "unknown bytes", reasons[n], e)
+                    unknown.append(n)
+                    continue
+                if estimated is None:
+                    print("estimate:", n, "runs no query", reasons[n])
+                    continue
+                print("estimate:", n, estimated, "bytes", reasons[n])
+                total += estimated
+
+        print("estimate:", len(reasons), "of", len(self.resources),
+              "resources would be built processing", total, "bytes,",
+              "about $%.2f" % (total / 2 ** 40 * pricePerTiB))
+        if unknown:
+            print("estimate: could not estimate", len(unknown),
+                  "resources:", " ".join(unknown))
+        return (total, unknown)
+
+    def probe(self, n, depUpdateTime):
+        """ Gather the status of resource n without changing anything.
+        Only makes (blocking) client calls so it may run in a thread.
+
+        :return: (whether it is running, reasonToCreate, its update time
+        if it is up to date) """
+        if n in self.trusted:
+            return (False, None, self.trusted[n])
+        if self.resources[n].isRunning():
+            return (True, None, None)
+        reason = self.reasonToCreate(n, depUpdateTime)
+        if reason is not None:
+            return (False, reason, None)
+        return (False, None, self.resources[n].updateTime())
+
+    def execute(self, checkFrequency=10,
+                maxConcurrent=DEFAULT_MAX_CONCURRENT, probeWorkers=16):
+        """ :param maxConcurrent: an int or a dict of pool name to the
+        jobs which may run at once in that pool
+        :param probeWorkers: threads probing the status of ready
+        resources at the start of each pass """
+        with ThreadPoolExecutor(max_workers=probeWorkers) as probes:
+            self.loadTrusted()
+            self._execute(checkFrequency, maxConcurrent, probes)
+
+    def _execute(self, checkFrequency, maxConcurrent, probes):
         retries = defaultdict(lambda: self.maxRetry)
+        limits = concurrencyLimits(maxConcurrent)
         running = set([])
+        started = {}
 
         # def update times is a dict of maximum of the update
         # times of the dependencies of a resource
@@ -182,118 +561,258 @@ class DependencyExecutor:
            "table_that_table1_depends_on": {},
         }
 
-        We loop through this and execute keys with no dependencies.
-        When each finishes, we remove that from the values
-            of all other keys that contain it
+        We loop through the ready keys, those with no pending dependencies,
+        starting with the first level of self.plan.
+        When each finishes, we decrement the pending count of the keys
+            which depend on it and those reaching zero become ready
         """
 
         depUpdateTimes = defaultdict(lambda: 0)
-        while len(self.dependencies):
-            todel = set([])
-            completed = set([])
-            for n in sorted(self.dependencies.keys()):
-                if not len(self.dependencies[n]):
-                    todel.add(n)
+        pending = {n: len(deps) for (n, deps) in self.dependencies.items()}
+        ready = set(self.plan.levels[0] if self.plan.levels else [])
+        while ready:
+            completed = {}
+            fullPools = set([])
+            # jobs may have written to gcs since the last pass
+            self.resetListings()
 
             """ flag to capture if anything was running.  If so,
             we will pause before looping again.
-            Check running tasks first to clear them, then others"""
-            for n in sorted(todel, key=lambda k: (int(k not in running), k)):
+            Check running tasks first to clear them, then others
+            by the length of their critical path"""
+            order = sorted(ready, key=lambda k: (int(k not in running),
+                                                 self.rank(k)))
+            # probe every ready resource concurrently then decide
+            # what to submit from the results, in order
+            probed = {n: probes.submit(self.probe, n, depUpdateTimes[n])
+                      for n in order}
+            for n in order:
                 try:
+                    (isRunning, reason, updateTime) = probed[n].result()
                     # check if it's already running
-                    if (self.resources[n].isRunning()):
+                    if isRunning:
                         print(self.resources[n], "already running")
                         running.add(n)
                         # continue so we can check other resource statuses
                         continue
                     else:
                         running.discard(n)
-                    # check if it doesn't exist in bq
-                    if not self.resources[n].exists():
-                        # break on max concurrency
-                        if len(running) >= maxConcurrent:
-                            print("max concurrent running already")
-                            # continue so we can check other resource statuses
-                            break
+
+                    (pool, limit) = self.poolLimit(n, limits)
+                    if pool in fullPools:
+                        continue
+
+                    if reason is not None:
+                        # skip the rest of this pool on max concurrency
+                        if sum(1 for k in running if
+                               self.resources[k].concurrencyPool() ==
+                               pool) >= limit:
+                            print("max concurrent running already in",
+                                  pool)
+                            fullPools.add(pool)
+                            # continue so other pools still fill up
+                            continue
                         self.handleRetries(retries, n)
-                        # try to create resource
-                        print("executing: because it doesn't exist ", n)
+                        print("executing:", reason, n, self.resources[n])
+                        # (re)create resource
+                        started[n] = time.time()
                         self.resources[n].create()
+                        self.resources[n].invalidateMetadata()
                         # confirm resource is actually running
                         # this prints <job_id> <status> <response>
                         if (self.resources[n].isRunning()):
                             running.add(n)
                         # continue so we can check other resource statuses
                         continue
-                    # check if the query hash has changed
-                    # by checking the description for it
-                    elif self.resources[n].shouldUpdate():
-                        # break on max concurrency
-                        if len(running) >= maxConcurrent:
-                            print("max concurrent running already")
-                            # continue so we can check other resource statuses
-                            break
-                        self.handleRetries(retries, n)
-                        print("executing: because our definition has changed",
-                              n, self.resources[n])
-                        # recreate resource again
-                        self.resources[n].create()
-                        # confirm resource is running
-                        if (self.resources[n].isRunning()):
-                            running.add(n)
-                        # continue so we can check other resource statuses
-                        continue
-                    # check if dependencies were updated more recently than resource
-                    # if so, we should regenerate resource since dependencies
-                    #     may have changed.
-                    elif self.resources[n].updateTime() < depUpdateTimes[n]:
-                        # break on max concurrency
-                        if len(running) >= maxConcurrent:
-                            print("max concurrent running already")
-                            # continue so we can check other resource statuses
-                            break
-                        self.handleRetries(retries, n)
-                        print("executing: because our dependencies have "
-                              "changed since we last ran",
-                              n, self.resources[n])
-                        # recreate resource again
-                        self.resources[n].create()
-                        # confirm resource is running
-                        if (self.resources[n].isRunning()):
-                            running.add(n)
-                        # continue so we can check other resource statuses
-                        continue
                     # otherwise, nothing to do but cleanup
                     else:
                         print(self.resources[n],
                               " resource exists and is up to date")
-                        # delete from dependency dict
-                        del self.dependencies[n]
                         # remove from running set (if in there)
                         running.discard(n)
-                        completed.add(n)
+                        completed[n] = updateTime
+                        self.recordDuration(n, started.pop(n, None))
+                        self.recordState(n, updateTime)
                 except PreconditionFailed as e:
                     print("trapping precondition fail error")
                     print(e)
                     self.handleRetries(retries, n)
                     continue
 
-            # less n-squared
-            if completed:
-                for n in sorted(self.dependencies.keys()):
-                    intersect = set.intersection(self.dependencies[n], completed)
-                    if intersect:
-                        newDepUpdateTime = max(
-                            depUpdateTimes[n],
-                            *[self.resources[k].updateTime() for k in intersect],
-                        )
-                        depUpdateTimes[n] = newDepUpdateTime
-                        self.dependencies[n] = self.dependencies[n] - intersect
+            # release the dependents of whatever completed
+            ready -= completed.keys()
+            for (k, updateTime) in sorted(completed.items()):
+                for n in self.plan.dependents[k]:
+                    depUpdateTimes[n] = max(depUpdateTimes[n], updateTime)
+                    pending[n] -= 1
+                    if not pending[n]:
+                        ready.add(n)
 
             # sleep if there is still work AND things are still running
-            if len(self.dependencies) and len(running):
+            if len(ready) and len(running):
                 sleep(checkFrequency)
 
+    def executeAsync(self, maxConcurrent=DEFAULT_MAX_CONCURRENT):
+        """ Event driven alternative to execute.
+
+        Every resource gets its own task which waits on the tasks of
+        its dependencies, so a resource is evaluated the moment its last
+        dependency completes rather than on the next checkFrequency pass.
+        Each job is awaited in a thread of its own, see _jobDone.
+        Blocking client calls run in the default thread pool executor.
+        """
+        self.loadTrusted()
+        asyncio.run(self._executeAsync(maxConcurrent))
+
+    async def _executeAsync(self, maxConcurrent):
+        retries = defaultdict(lambda: self.maxRetry)
+        limits = concurrencyLimits(maxConcurrent)
+        pools = {}
+        for n in self.plan.order():
+            (pool, limit) = self.poolLimit(n, limits)
+            if pool not in pools:
+                pools[pool] = PrioritySlots(limit)
+        tasks = {}
+        for n in self.plan.order():
+            tasks[n] = asyncio.ensure_future(
+                self._materialize(n, tasks, retries, pools))
+
+        try:
+            if tasks:
+                done, pending = await asyncio.wait(
+                    tasks.values(), return_when=asyncio.FIRST_EXCEPTION)
+                for task in done:
+                    # re-raise the first failure (i.e. max retries hit)
+                    task.result()
+        finally:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+    async def _materialize(self, n, tasks, retries, pools):
+        deps = sorted(self.dependencies[n])
+        if deps:
+            await asyncio.gather(*[tasks[k] for k in deps])
+        rsrc = self.resources[n]
+        if n in self.trusted:
+            print(rsrc, " resource is up to date according to local state")
+            return
+        depUpdateTime = max([0] + [
+            self.trusted[k] if k in self.trusted else
+            await _inThread(self.resources[k].updateTime) for k in deps])
+
+        slots = pools[rsrc.concurrencyPool()]
+        started = None
+        while True:
+            try:
+                if await _inThread(rsrc.isRunning):
+                    print(rsrc, "already running")
+                    async with slots.slot(self.rank(n)):
+                        await _jobDone(rsrc.trackedJob())
+                    # it may have written to gcs
+                    self.resetListings()
+                    continue
+
+                reason = await _inThread(self.reasonToCreate, n,
+                                         depUpdateTime)
+                if reason is None:
+                    print(rsrc, " resource exists and is up to date")
+                    self.recordDuration(n, started)
+                    if self.localState is not None:
+                        self.recordState(n, await _inThread(rsrc.updateTime))
+                    return
+
+                async with slots.slot(self.rank(n)):
+                    self.handleRetries(retries, n)
+                    print("executing:", reason, n, rsrc)
+                    started = time.time()
+                    await _inThread(rsrc.create)
+                    rsrc.invalidateMetadata()
+                    await _jobDone(rsrc.trackedJob())
+                self.resetListings()
+            except PreconditionFailed as e:
+                print("trapping precondition fail error")
+                print(e)
+                self.handleRetries(retries, n)
+
+
+class PrioritySlots:
+    """ asyncio semaphore handing free slots to the waiter with the
+    lowest rank first instead of the one which asked first """
+
+    def __init__(self, size: int):
+        self.free = size
+        self.waiters = []
+        self.counter = itertools.count()
+
+    async def acquire(self, rank):
+        if self.free > 0 and not self.waiters:
+            self.free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (rank, next(self.counter), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # we were handed the slot just as we got cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            (_, _, waiter) = heapq.heappop(self.waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.free += 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, rank):
+        await self.acquire(rank)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+async def _inThread(func, *args):
+    """ run a blocking call in the loop's default executor """
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def _jobDone(job):
+    """ wait for a job to finish.  Returns at once if job is None.
+
+    Waits in a daemon thread of its own on job.result(timeout=None).
+    add_done_callback can't be used: google's polling thread gives up
+    on load and extract jobs after its default 900s timeout without
+    ever calling back.  Own threads keep long jobs from tying up the
+    default executor and from holding up exit after a failure """
+    if job is None:
+        return
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+
+    def setDone():
+        if not done.done():
+            done.set_result(None)
+
+    def wait():
+        try:
+            job.result(timeout=None)
+        except Exception:
+            # failed jobs are seen (and retried) through reasonToCreate
+            pass
+        try:
+            loop.call_soon_threadsafe(setDone)
+        except RuntimeError:
+            # the loop closed after another resource failed
+            pass
+
+    threading.Thread(target=wait, daemon=True).start()
+    await done
+
 
 if __name__ == "__main__":
     parser = OptionParser("[options] folder[ folder2[...]]")
@@ -314,6 +833,12 @@ if __name__ == "__main__":
                       "Renders the templates found in those folders "
                       "and executes them in proper order "
                            "of their dependencies")
+    parser.add_option("--async", dest="asyncExecute",
+                      action="store_true", default=False,
+                      help="Relevant to 'execute' mode.  Wait on each job "
+                           "individually and start dependents as soon as "
+                           "their last dependency completes instead of "
+                           "polling every checkFrequency seconds")
     parser.add_option("--dotml", dest="dotml",
                       action="store_true", default=False,
                       help="Generate dot ml graph of dag of execution.  "
@@ -335,9 +860,78 @@ if __name__ == "__main__":
                            "file definitions don't specify one.  This "
                            "will be automatically created during "
                            "'execute' mode")
-    parser.add_option("--maxConcurrent", dest="maxConcurrent", type=int,
-                      default=10, help="The maximum number of bq or "
-                                       "other jobs to run in parallel.")
+    parser.add_option("--maxConcurrent", dest="maxConcurrent", type=str,
+                      default=str(DEFAULT_MAX_CONCURRENT),
+                      help="The maximum number of bq or "
+                           "other jobs to run in parallel.  Either one "
+                           "number or limits per pool of resources, "
+                           "i.e. query=20,load=50,extract=10,process=4. "
+                           "A bare number in the list applies to pools "
+                           "not named")
+    parser.add_option("--jobHistory", dest="jobHistory", type=str,
+                      default=None,
+                      help="Path to a sqlite file recording how long each "
+                           "resource took to materialize.  'execute' mode "
+                           "uses it to start the longest chains of "
+                           "dependencies first")
+    parser.add_option("--estimate", dest="estimate",
+                      action="store_true", default=False,
+                      help="Dry run the queries of the resources "
+                           "'execute' mode would build and report the "
+                           "bytes they would process and their cost")
+    parser.add_option("--maxBytes", dest="maxBytes", type=int,
+                      default=None,
+                      help="Relevant to 'execute' mode.  Estimate the run "
+                           "first and abort before submitting any job "
+                           "if it would process more bytes than this or "
+                           "if some resources can't be estimated")
+    parser.add_option("--allowUnestimated", dest="allowUnestimated",
+                      action="store_true", default=False,
+                      help="Relevant to --maxBytes.  Run even if some "
+                           "resources can't be estimated, i.e. because "
+                           "they read tables the run is yet to create.  "
+                           "Those aren't counted against --maxBytes")
+    parser.add_option("--pricePerTiB", dest="pricePerTiB", type=float,
+                      default=6.25,
+                      help="On demand price per TiB used by --estimate")
+    parser.add_option("--localState", dest="localState", type=str,
+                      default=None,
+                      help="Path to a sqlite file recording the definition "
+                           "hash, update time and job of every resource "
+                           "'execute' mode finds up to date")
+    parser.add_option("--trustLocalState", dest="trustLocalState",
+                      action="store_true", default=False,
+                      help="Relevant to 'execute' mode with --localState. "
+                           "Plan the run from the local state and skip "
+                           "the resources it records as up to date "
+                           "without checking them against BigQuery")
+    parser.add_option("--probeWorkers", dest="probeWorkers", type=int,
+                      default=16,
+                      help="Relevant to 'execute' mode.  The number of "
+                           "threads checking the status of ready "
+                           "resources at once on every pass")
+    parser.add_option("--renderWorkers", dest="renderWorkers", type=int,
+                      default=1,
+                      help="The number of processes used to render "
+                           "templates.  Resources are still built in "
+                           "this process in the same order")
+    parser.add_option("--renderCache", dest="renderCache", type=str,
+                      default=None,
+                      help="Path to a sqlite file caching rendered "
+                           "templates between runs.  Entries are keyed "
+                           "by the content of the template, its vars, "
+                           "global vars and the effective date")
+    parser.add_option("--fileHashCache", dest="fileHashCache", type=str,
+                      default=None,
+                      help="Path to a sqlite file caching the hashes of "
+                           "local data files between runs.  Entries are "
+                           "keyed by path, size, mtime and inode")
+    parser.add_option("--uploadCompression", dest="uploadCompression",
+                      type="choice", choices=UPLOAD_COMPRESSIONS,
+                      default="none",
+                      help="How .localdata files are sent to BigQuery. "
+                           "gzip compresses them before uploading, which "
+                           "sends fewer bytes for text heavy files")
     parser.add_option("--defaultProject", dest="defaultProject",
                       help="The default project which will be used if "
                            "file definitions don't specify one")
@@ -414,6 +1008,13 @@ if __name__ == "__main__":
     gcsClient = None
     client = None
     bqJobs = None
+    bqTables = None
+    jobTracker = None
+    gcsListings = None
+    renderCache = None
+    if options.renderCache:
+        renderCache = RenderCache(options.renderCache)
+    fileHashes = FileHashes(options.fileHashCache)
 
     dryrun = False
     if options.dumpToFolder:
@@ -427,55 +1028,127 @@ if __name__ == "__main__":
             client = Client(**additional_args)
             globalVars["project"] = client.project
         bqJobs = BqJobs(client)
-        if options.execute:
-            bqJobs.loadTableJobs()
+        bqTables = BqTables(loadClient)
+        jobTracker = JobTracker(client)
+        gcsListings = GcsListings(gcsClient)
 
     builder = DependencyBuilder(
         DelegatingFileSuffixLoader(
             uniontable=BqQueryTemplatingFileLoader(client, gcsClient,
-                                                   bqJobs,
                                                    TableType.UNION_TABLE,
-                                                   globalVars),
+                                                   globalVars,
+                                                   bqTables=bqTables,
+                                                   renderCache=renderCache,
+                                                   jobTracker=jobTracker,
+                                                   gcsListings=gcsListings),
+            partitiontable=BqQueryTemplatingFileLoader(client, gcsClient,
+                                                       TableType.PARTITION_TABLE,
+                                                       globalVars,
+                                                       bqTables=bqTables,
+                                                       renderCache=renderCache,
+                                                       jobTracker=jobTracker,
+                                                       gcsListings=gcsListings),
             unionview=BqQueryTemplatingFileLoader(client, gcsClient,
-                                                  bqJobs,
                                                   TableType.UNION_VIEW,
-                                                  globalVars),
+                                                  globalVars,
+                                                  bqTables=bqTables,
+                                                  renderCache=renderCache,
+                                                  jobTracker=jobTracker,
+                                                  gcsListings=gcsListings),
             querytemplate=BqQueryTemplatingFileLoader(client, gcsClient,
-                                                      bqJobs,
                                                       TableType.TABLE,
-                                                      globalVars),
+                                                      globalVars,
+                                                      bqTables=bqTables,
+                                                      renderCache=renderCache,
+                                                      jobTracker=jobTracker,
+                                                      gcsListings=gcsListings),
             view=BqQueryTemplatingFileLoader(client, gcsClient,
-                                             bqJobs,
                                              TableType.VIEW,
-                                             globalVars),
+                                             globalVars,
+                                             bqTables=bqTables,
+                                             renderCache=renderCache,
+                                             jobTracker=jobTracker,
+                                             gcsListings=gcsListings),
             # TODO: give better control over where localdata files end up
             localdata=BqDataFileLoader(loadClient,
                                        globalVars['dataset'],
                                        globalVars['project'],
-                                       bqJobs),
+                                       bqTables=bqTables,
+                                       jobTracker=jobTracker,
+                                       fileHashes=fileHashes,
+                                       uploadCompression=options.uploadCompression),
             gcsdata=BqQueryTemplatingFileLoader(client, gcsClient,
-                                                bqJobs,
                                                 TableType.TABLE_GCS_LOAD,
-                                                globalVars),
+                                                globalVars,
+                                                bqTables=bqTables,
+                                                renderCache=renderCache,
+                                                jobTracker=jobTracker,
+                                                gcsListings=gcsListings),
             bashtemplate=BqQueryTemplatingFileLoader(loadClient, gcsClient,
-                                                     bqJobs,
                                                      TableType.BASH_TABLE,
-                                                     globalVars),
+                                                     globalVars,
+                                                     bqTables=bqTables,
+                                                     renderCache=renderCache,
+                                                     jobTracker=jobTracker,
+                                                     gcsListings=gcsListings),
             externaltable=BqQueryTemplatingFileLoader(loadClient, gcsClient,
-                                                      bqJobs,
                                                       TableType.EXTERNAL_TABLE,
-                                                      globalVars))
+                                                      globalVars,
+                                                      bqTables=bqTables,
+                                                      renderCache=renderCache,
+                                                      jobTracker=jobTracker,
+                                                      gcsListings=gcsListings)),
+        renderWorkers=options.renderWorkers
     )
     (resources, dependencies) = builder.buildDepend(args, dryrun=dryrun)
+    if options.execute and bqJobs is not None:
+        adoptInFlightJobs(bqJobs, resources)
+    if options.execute:
+        prefetchFileHashes(fileHashes, resources, options.probeWorkers)
+    jobHistory = None
+    if options.jobHistory:
+        jobHistory = JobHistory(options.jobHistory)
+    localState = None
+    if options.localState:
+        localState = LocalState(options.localState)
     executor = DependencyExecutor(resources, dependencies,
-                                  maxRetry=options.maxRetry)
+                                  maxRetry=options.maxRetry,
+                                  plan=builder.plan,
+                                  history=jobHistory,
+                                  localState=localState,
+                                  trustLocalState=options.trustLocalState,
+                                  gcsListings=gcsListings)
 
     if options.print_global_args:
         print(json.dumps(globalVars))
         exit(0)
 
-    if options.execute:
-        executor.execute(checkFrequency=options.checkFrequency, maxConcurrent=options.maxConcurrent)
+    maxConcurrent = parseMaxConcurrent(
+        options.maxConcurrent,
+        set([rsrc.concurrencyPool() for rsrc in resources.values()]))
+
+    if options.execute and options.maxBytes is not None:
+        (estimated, unknown) = executor.estimate(
+            probeWorkers=options.probeWorkers,
+            pricePerTiB=options.pricePerTiB)
+        if estimated > options.maxBytes:
+            raise Exception("Estimated bytes processed", estimated,
+                            "exceed --maxBytes", options.maxBytes)
+        if unknown and not options.allowUnestimated:
+            raise Exception("Unable to estimate the bytes processed by",
+                            unknown, "for --maxBytes, pass "
+                            "--allowUnestimated to run anyway")
+
+    if options.estimate:
+        executor.estimate(probeWorkers=options.probeWorkers,
+                          pricePerTiB=options.pricePerTiB)
+    elif options.execute and options.asyncExecute:
+        executor.executeAsync(maxConcurrent=maxConcurrent)
+    elif options.execute:
+        executor.execute(
+            checkFrequency=options.checkFrequency,
+            maxConcurrent=maxConcurrent,
+            probeWorkers=options.probeWorkers)
     elif options.show:
         executor.show()
     elif options.dotml:
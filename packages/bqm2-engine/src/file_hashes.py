@@ -0,0 +1,120 @@
+"""
+Cache of the content hashes of local files.
+
+BqDataLoadTableResource hashes its data file and .schema to decide
+whether the table is stale, and asks for the hash more than once per
+run.  Hashes are keyed on the path, size, modification time and inode
+of the file so an unchanged file is read at most once per run, or never
+again when the cache is backed by a sqlite file.
+"""
+import hashlib
+import mmap
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlite_store import SqliteStore
+
+HASHES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    used REAL NOT NULL)
+"""
+
+
+def mmapFileMd5(filename, blocksize=2**24) -> str:
+    """ md5 of a file read through mmap, avoiding a copy of every block
+    into a python buffer """
+    m = hashlib.md5()
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return m.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(view), blocksize):
+                    m.update(view[offset:offset + blocksize])
+            finally:
+                view.release()
+    return m.hexdigest()
+
+
+def fileSignature(filename) -> tuple:
+    """ :return: (size, mtime in ns, inode) of filename """
+    st = os.stat(filename)
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+class FileHashes:
+    """ map of file path to the md5 of its content.
+
+    Hashes are kept in memory and, given a path, in a sqlite file so
+    later runs reuse them.  A hash is only served while the file's
+    size, mtime and inode are those it was computed for. """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.memo = {}
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = SqliteStore(path, HASHES_SCHEMA)
+
+    def md5(self, filename) -> str:
+        """ :return: md5 of filename, computed only if the file changed
+        since it was last hashed """
+        path = os.path.abspath(filename)
+        signature = fileSignature(path)
+        cached = self.__lookup__(path, signature)
+        if cached is not None:
+            return cached
+
+        with self.lock:
+            self.misses += 1
+        digest = mmapFileMd5(path)
+        self.__store__(path, signature, digest)
+        return digest
+
+    def prefetch(self, filenames, workers: int = 8):
+        """ hash filenames on a thread pool so later md5 calls are
+        served from the cache """
+        filenames = sorted(set(filenames))
+        if not filenames:
+            return
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(self.md5, filenames))
+
+    def __lookup__(self, path, signature):
+        with self.lock:
+            entry = self.memo.get(path)
+            if entry is None and self.db is not None:
+                row = self.db.fetchone("SELECT size, mtime_ns, inode, md5 "
+                                       "FROM hashes WHERE path = ?",
+                                       (path,))
+                if row is not None:
+                    entry = (tuple(row[:3]), row[3])
+            if entry is None or entry[0] != signature:
+                return None
+            self.hits += 1
+            self.memo[path] = entry
+            return entry[1]
+
+    def __store__(self, path, signature, digest):
+        with self.lock:
+            self.memo[path] = (signature, digest)
+            if self.db is not None:
+                self.db.write("INSERT OR REPLACE INTO hashes "
+                              "(path, size, mtime_ns, inode, md5, used) "
+                              "VALUES (?, ?, ?, ?, ?, ?)",
+                              (path,) + signature + (digest, time.time()))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
@@ -0,0 +1,46 @@
+"""
+Local history of how long each resource took to materialize.
+
+DependencyExecutor records the seconds between creating a resource and
+finding it complete.  The next run uses them to weigh the critical path
+of the dependency graph so the longest chains start first.
+"""
+import time
+
+from sqlite_store import SqliteStore
+
+DURATIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS durations (
+    key TEXT PRIMARY KEY,
+    seconds REAL NOT NULL,
+    updated REAL NOT NULL)
+"""
+
+
+class JobHistory:
+    """ sqlite backed map of resource key to its recent duration.
+
+    Durations are smoothed so one slow or fast run only moves the
+    estimate part of the way. """
+
+    def __init__(self, path: str, smoothing: float = 0.5):
+        self.path = path
+        self.smoothing = smoothing
+        self.db = SqliteStore(path, DURATIONS_SCHEMA)
+
+    def durations(self) -> dict:
+        """ :return: dict of resource key to its estimated seconds """
+        return dict(self.db.fetchall("SELECT key, seconds FROM durations"))
+
+    def record(self, key: str, seconds: float):
+        row = self.db.fetchone("SELECT seconds FROM durations WHERE key = ?",
+                               (key,))
+        if row is not None:
+            seconds = self.smoothing * seconds + \
+                (1 - self.smoothing) * row[0]
+        self.db.write("INSERT OR REPLACE INTO durations "
+                      "(key, seconds, updated) VALUES (?, ?, ?)",
+                      (key, seconds, time.time()))
+
+    def close(self):
+        self.db.close()
@@ -17,11 +17,14 @@ from google.cloud.bigquery.dataset import Dataset
 import tmplhelper
 from resource import BqExternalTableBasedResource
 from resource import Resource, _buildDataSetKey_, BqDatasetBackedResource, \
-    BqJobs, BqQueryBackedTableResource, _buildDataSetTableKey_, \
-    BqViewBackedTableResource, BqDataLoadTableResource, \
-    BqExtractTableResource, BqGcsTableLoadResource, BqProcessTableResource
-from tmplhelper import evalTmplRecurse, explodeTemplate
+    BqTables, BqQueryBackedTableResource, _buildDataSetTableKey_, \
+    JobTracker, GcsListings, BqViewBackedTableResource, BqDataLoadTableResource, \
+    BqExtractTableResource, BqGcsTableLoadResource, BqProcessTableResource, \
+    BqPartitionedTableResource, MAX_CONCURRENT_PARTITIONS
+from tmplhelper import evalTmplRecurse, iterExplodeTemplate
 from date_formatter_helper import helpers
+from render_cache import RenderCache, renderCacheKey
+from file_hashes import FileHashes
 
 
 class FileLoader:
@@ -39,6 +42,17 @@ class FileLoader:
         """
         pass
 
+    def renderer(self, file):
+        """ A picklable (function, args) pair which does the pure
+        rendering work of loading file so it may run in another process,
+        or None if there is none.  The result of function(*args) is
+        handed to loadRendered """
+        return None
+
+    def loadRendered(self, file, rendered, dryrun):
+        """ load file given the result of its renderer """
+        return self.load(file, dryrun)
+
 
 class DelegatingFileSuffixLoader(FileLoader):
     """ Manages a map of loader keyed by file suffix """
@@ -52,6 +66,15 @@ class DelegatingFileSuffixLoader(FileLoader):
             self.loaders = kwargs
 
     def load(self, file, dryrun):
+        return self.loader(file).load(file, dryrun)
+
+    def renderer(self, file):
+        return self.loader(file).renderer(file)
+
+    def loadRendered(self, file, rendered, dryrun):
+        return self.loader(file).loadRendered(file, rendered, dryrun)
+
+    def loader(self, file):
         suffixParts = file.split("/")[-1].split(".")
         if len(suffixParts) == 1:
             raise ValueError(file +
@@ -59,7 +82,7 @@ class DelegatingFileSuffixLoader(FileLoader):
                              str(self.loaders.keys()) + " to be processed"
                              )
         try:
-            return self.loaders[suffixParts[-1]].load(file, dryrun)
+            return self.loaders[suffixParts[-1]]
         except KeyError:
             raise ValueError("No loader associated with suffix: " +
                              suffixParts[-1])
@@ -156,6 +179,7 @@ class TableType(Enum):
     UNION_VIEW = 6
     BASH_TABLE = 7
     EXTERNAL_TABLE = 8
+    PARTITION_TABLE = 9
 
 
 class BqQueryTemplatingFileLoader(FileLoader):
@@ -182,20 +206,31 @@ class BqQueryTemplatingFileLoader(FileLoader):
     """
 
     def __init__(self, bqClient: Client, gcsClient: storage.Client,
-                 bqJobs: BqJobs, tableType:
-                 TableType, defaultVars={}):
+                 tableType: TableType, defaultVars={},
+                 bqTables: BqTables = None,
+                 renderCache: RenderCache = None,
+                 jobTracker: JobTracker = None,
+                 gcsListings: GcsListings = None):
         """
 
         :param bqClient: The big query client to use
         :param gcsClient: THe gcs client to use
-        :param bqJobs: An initialized BqJobs
         :param tableType Either TABLE or VIEW
         :param defaultDataset: A default dataset to use in templates
+        :param bqTables: Optional shared table metadata snapshot
+        :param renderCache: Optional persistent cache of rendered templates
+        :param jobTracker: Optional tracker answering whether jobs are
+        running
+        :param gcsListings: Optional shared cache of gcs listings
         """
         self.bqClient = bqClient
+        self.bqTables = bqTables
+        self.jobTracker = jobTracker
+        self.gcsListings = gcsListings
+        self.renderCache = renderCache
+        self.renderCacheKeys = {}
         self.gcsClient = gcsClient
         self.defaultVars = defaultVars
-        self.bqJobs = bqJobs
         self.datasets = {}
         self.tableType = tableType
         self.cachedFileLoads = {}
@@ -207,7 +242,16 @@ class BqQueryTemplatingFileLoader(FileLoader):
                                  filename: str,
                                  localVars: dict,
                                  defaultVars: dict):
-        ret = []
+        return list(BqQueryTemplatingFileLoader.iterExplodeTemplateVarsArray(
+            rawTemplates, folder, filename, localVars, defaultVars))
+
+    def iterExplodeTemplateVarsArray(rawTemplates: list,
+                                     folder: str,
+                                     filename: str,
+                                     localVars: dict,
+                                     defaultVars: dict):
+        """ :return: generator of the evaluated template vars for every
+        expansion of rawTemplates """
         for t in rawTemplates:
             copy = t.copy()
             copy['folder'] = folder
@@ -217,9 +261,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
 
             copy = {**defaultVars, **localVars, **copy}
 
-            ret += [evalTmplRecurse(t) for t in explodeTemplate(copy)]
-
-        return ret
+            for exploded in iterExplodeTemplate(copy):
+                yield evalTmplRecurse(exploded)
 
     def cached_file_read(self, file):
         if file in self.cachedFileLoads:
@@ -246,20 +289,17 @@ class BqQueryTemplatingFileLoader(FileLoader):
         Datasets are ok.
         :return: void
         """
-        templateVarsCopy = templateVars.copy()
-        helpers.format_all_date_keys(templateVarsCopy)
-
-        if 'dataset' not in templateVars:
-            raise Exception("Missing dataset in template vars for " +
-                            filePath + ".vars")
+        query = renderQuery(templateVars, template, filePath)
+        self.processRenderedQuery(templateVars, query, filePath, mtime,
+                                  out, dryrun)
+
+    def processRenderedQuery(self, templateVars: dict, query: str,
+                             filePath: str, mtime: int, out: dict,
+                             dryrun=False):
+        """ The part of processTemplateVar which builds resources from
+        an already rendered query.  Same arguments except query is
+        template formatted with templateVars """
         dataset = templateVars['dataset']
-        needed = tmplhelper.keysOfTemplate(template)
-        if not needed.issubset(templateVars.keys()):
-            missing = str(needed - templateVars.keys())
-            raise Exception("Please define values for " +
-                            missing + " in a file: ",
-                            filePath + ".vars")
-        query = template.format(**templateVars)
         legacySql = "#legacysql" in query.lower()
 
         table = templateVars['table']
@@ -296,43 +336,40 @@ class BqQueryTemplatingFileLoader(FileLoader):
 
         if self.tableType == TableType.TABLE:
             qjobconfig = None
-            jT = None
             if not dryrun:
-                jT = self.bqJobs.getJobForTable(bqTable, "create")
                 qjobconfig = load_query_job_config(bqTable,
                                                    filePath + ".queryjobconfig",
                                                    templateVars)
                 qjobconfig.use_legacy_sql = legacySql
             arsrc = BqQueryBackedTableResource([query], bqTable,
                                                self.bqClient,
-                                               queryJob=jT,
+                                               queryJob=None,
                                                queryJobConfig=qjobconfig,
                                                expiration=expiration,
-                                               location=templateVars.get('location', None))
+                                               location=templateVars.get('location', None),
+                                               bqTables=self.bqTables,
+                                               jobTracker=self.jobTracker)
             out[key] = arsrc
             # check if there is extraction logic
             # todo: we need to populate the extraction job
             if 'extract' in templateVars:
-                extract_job = None
-                if not dryrun:
-                    extract_job = self.bqJobs.getJobForTable(bqTable, "extract")
                 extractRsrc \
                     = BqExtractTableResource(bqTable,
                                              self.bqClient,
-                                             self.gcsClient, extract_job,
+                                             self.gcsClient, None,
                                              templateVars['extract'],
-                                             templateVars)
+                                             templateVars,
+                                             bqTables=self.bqTables,
+                                             jobTracker=self.jobTracker,
+                                             gcsListings=self.gcsListings)
                 out[extractRsrc.key()] = extractRsrc
         elif self.tableType == TableType.VIEW:
             arsrc = BqViewBackedTableResource([query], bqTable,
-                                              self.bqClient)
+                                              self.bqClient,
+                                              bqTables=self.bqTables)
             out[key] = arsrc
 
         elif self.tableType == TableType.TABLE_GCS_LOAD:
-            jT = None
-            if not dryrun:
-                jT = self.bqJobs.getJobForTable(bqTable, "create")
-
             schema = None
             if "source_format" not in templateVars:
                 raise Exception("source_format not found in template vars")
@@ -345,8 +382,11 @@ class BqQueryTemplatingFileLoader(FileLoader):
             rsrc = BqGcsTableLoadResource(bqTable,
                                           self.bqClient,
                                           self.gcsClient,
-                                          jT, query, schema,
-                                          templateVars)
+                                          None, query, schema,
+                                          templateVars,
+                                          bqTables=self.bqTables,
+                                          jobTracker=self.jobTracker,
+                                          gcsListings=self.gcsListings)
             out[key] = rsrc
         elif self.tableType == TableType.UNION_TABLE:
             # disallow scripts
@@ -359,20 +399,56 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 arsrc.addQuery(query)
             else:
                 qjobconfig = None
-                jT = None
                 if not dryrun:
                     qjobconfig = load_query_job_config(bqTable,
                                                        filePath
                                                        + ".queryjobconfig",
                                                        templateVars)
                     qjobconfig.use_legacy_sql = legacySql
-                    jT = self.bqJobs.getJobForTable(bqTable, "create")
                 arsrc = BqQueryBackedTableResource([query], bqTable,
                                                    self.bqClient,
-                                                   queryJob=jT,
+                                                   queryJob=None,
                                                    queryJobConfig=qjobconfig,
                                                    expiration=expiration,
-                                                   location=templateVars.get('location', None))
+                                                   location=templateVars.get('location', None),
+                                                   bqTables=self.bqTables,
+                                                   jobTracker=self.jobTracker)
+                out[key] = arsrc
+
+        elif self.tableType == TableType.PARTITION_TABLE:
+            if templateVars.get(IS_SCRIPT_KEY, False) is True:
+                raise Exception(f"{IS_SCRIPT_KEY} is not allowed "
+                                f"for partition tables")
+            partition = str(templateVars.get('partition',
+                                             templateVars.get('yyyymmdd',
+                                                              '')))
+            if not partition:
+                raise Exception("Please define a partition or yyyymmdd "
+                                "var for " + filePath)
+
+            if key in out:
+                arsrc = out[key]
+                arsrc.addPartition(partition, query)
+            else:
+                qjobconfig = None
+                if not dryrun:
+                    qjobconfig = load_query_job_config(bqTable,
+                                                       filePath
+                                                       + ".queryjobconfig",
+                                                       templateVars)
+                    qjobconfig.use_legacy_sql = legacySql
+                arsrc = BqPartitionedTableResource(
+                    {partition: query}, bqTable, self.bqClient,
+                    queryJob=None,
+                    queryJobConfig=qjobconfig,
+                    location=templateVars.get('location', None),
+                    partitionField=templateVars.get('partition_field',
+                                                    None),
+                    bqTables=self.bqTables,
+                    jobTracker=self.jobTracker,
+                    maxConcurrentPartitions=int(templateVars.get(
+                        'max_concurrent_partitions',
+                        MAX_CONCURRENT_PARTITIONS)))
                 out[key] = arsrc
 
         elif self.tableType == TableType.UNION_VIEW:
@@ -381,18 +457,18 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 arsrc.addQuery(query)
             else:
                 arsrc = BqViewBackedTableResource([query], bqTable,
-                                                  self.bqClient)
+                                                  self.bqClient,
+                                                  bqTables=self.bqTables)
                 out[key] = arsrc
 
         elif self.tableType == TableType.BASH_TABLE:
-            jT = None
-            if not dryrun:
-                jT = self.bqJobs.getJobForTable(bqTable, "create")
             stripped = self.cached_file_read(filePath + ".schema").strip()
             schema = loadSchemaFromString(stripped)
             # with open(filePath + ".schema") as schemaFile:
             #     schema = loadSchemaFromString(schemaFile.read().strip())
-            arsrc = BqProcessTableResource(query, bqTable, schema, self.bqClient, job=jT)
+            arsrc = BqProcessTableResource(query, bqTable, schema, self.bqClient, job=None,
+                                           bqTables=self.bqTables,
+                                           jobTracker=self.jobTracker)
             out[key] = arsrc
         elif self.tableType == TableType.EXTERNAL_TABLE:
             from google.cloud.bigquery import ExternalConfig
@@ -416,7 +492,8 @@ class BqQueryTemplatingFileLoader(FileLoader):
                 project = "default"
             bqTable = Table(".".join([project, dataset, table]), schema)
             arsrc = BqExternalTableBasedResource(self.bqClient, bqTable,
-                                                 ext_config)
+                                                 ext_config,
+                                                 bqTables=self.bqTables)
             out[key] = arsrc
 
         dsetKey = _buildDataSetKey_(bqTable)
@@ -430,88 +507,190 @@ class BqQueryTemplatingFileLoader(FileLoader):
                             "tables outputs for " + filePath)
 
     def load(self, filePath, dryrun):
+        return self.buildResources(filePath, self.render(filePath), dryrun)
+
+    def renderCacheKey(self, filePath):
+        if filePath not in self.renderCacheKeys:
+            self.renderCacheKeys[filePath] = renderCacheKey(
+                filePath, self.defaultVars, tmplhelper.start_time)
+        return self.renderCacheKeys[filePath]
+
+    def render(self, filePath):
+        """ renderTemplateFile through the render cache if we have one.
+        Without one the queries are rendered lazily as they're built """
+        if self.renderCache is None:
+            return iterRenderTemplateFile(filePath, self.defaultVars)
+
+        key = self.renderCacheKey(filePath)
+        rendered = self.renderCache.get(key)
+        if rendered is None:
+            rendered = renderTemplateFile(filePath, self.defaultVars)
+            self.renderCache.put(key, rendered)
+        return rendered
+
+    def renderer(self, filePath):
+        # cached renders are cheaper to load here than in a worker
+        if self.renderCache is not None \
+                and self.renderCache.contains(self.renderCacheKey(filePath)):
+            return None
+        return (renderTemplateFile,
+                (filePath, self.defaultVars, tmplhelper.start_time))
+
+    def loadRendered(self, filePath, rendered, dryrun):
+        if self.renderCache is not None:
+            self.renderCache.put(self.renderCacheKey(filePath), rendered)
+        return self.buildResources(filePath, rendered, dryrun)
+
+    def buildResources(self, filePath, rendered, dryrun):
+        """
+        :param rendered: iterable of (templateVars, query) as returned by
+        iterRenderTemplateFile for filePath
+        """
         mtime = getmtime(filePath)
         ret = {}
-        with open(filePath) as f:
-            template = f.read()
-            try:
-                filename = filePath.split("/")[-1].split(".")[-2]
-                localVarsPath = os.path.join(os.path.dirname(filePath), "local.vars")
-                folder = filePath.split("/")[-2]
-                templateVars = \
-                    BqQueryTemplatingFileLoader.explodeTemplateVarsArray(
-                        self.loadTemplateVars(filePath + ".vars"),
-                        folder,
-                        filename,
-                        self.loadLocalVars(localVarsPath),
-                        self.defaultVars
-                    )
-
-            except FileNotFoundError:
-                raise Exception("Please define template vars in a file "
-                                "called " + filePath + ".vars")
-            for v in templateVars:
-                self.processTemplateVar(v, template, filePath, mtime, ret, dryrun)
+        for (v, query) in rendered:
+            self.processRenderedQuery(v, query, filePath, mtime, ret, dryrun)
         return ret.values()
 
     def loadLocalVars(self, filePath):
-        local_vars = dict()
-        if filePath \
-            and os.path.exists(filePath) \
-                and os.path.isfile(filePath):
-            with open(filePath) as f:
-                local_vars = yaml.safe_load(f)
-                if not isinstance(local_vars, dict):
-                    raise Exception(
-                        "Must be single json or yaml object in "
-                        + filePath)
-        return local_vars
+        return loadLocalVars(filePath)
 
     def loadTemplateVars(self, filePath) -> list:
-        try:
-            with open(filePath) as f:
-                template_vars_list = yaml.safe_load(f)
-                if not isinstance(template_vars_list, list):
+        return loadTemplateVars(filePath)
+
+
+def renderQuery(templateVars: dict, template: str, filePath: str) -> str:
+    """ format template with templateVars, checking every key it
+    needs is defined """
+    templateVarsCopy = templateVars.copy()
+    helpers.format_all_date_keys(templateVarsCopy)
+
+    if 'dataset' not in templateVars:
+        raise Exception("Missing dataset in template vars for " +
+                        filePath + ".vars")
+    compiled = tmplhelper.compileTemplate(template)
+    needed = compiled.keys
+    if not needed.issubset(templateVars.keys()):
+        missing = str(needed - templateVars.keys())
+        raise Exception("Please define values for " +
+                        missing + " in a file: ",
+                        filePath + ".vars")
+    return compiled.format(templateVars)
+
+
+def renderTemplateFile(filePath: str, defaultVars: dict,
+                       startTime=None) -> list:
+    """
+    iterRenderTemplateFile collected into a list, which can be stored
+    in the render cache or returned from a worker process.
+
+    :return: list of (templateVars, query)
+    """
+    return list(iterRenderTemplateFile(filePath, defaultVars, startTime))
+
+
+def iterRenderTemplateFile(filePath: str, defaultVars: dict,
+                           startTime=None):
+    """
+    The pure part of BqQueryTemplatingFileLoader.load.  Reads the
+    template and its vars, explodes them and formats the template once
+    per exploded variant.  Touches no clients so it may run in a worker
+    process.
+
+    :param startTime: pins tmplhelper.start_time in worker processes
+    :return: generator of (templateVars, query), rendering each query
+    as it's consumed
+    """
+    if startTime is not None:
+        tmplhelper.start_time = startTime
+
+    with open(filePath) as f:
+        template = f.read()
+    try:
+        filename = filePath.split("/")[-1].split(".")[-2]
+        localVarsPath = os.path.join(os.path.dirname(filePath), "local.vars")
+        folder = filePath.split("/")[-2]
+        templateVars = \
+            BqQueryTemplatingFileLoader.iterExplodeTemplateVarsArray(
+                loadTemplateVars(filePath + ".vars"),
+                folder,
+                filename,
+                loadLocalVars(localVarsPath),
+                defaultVars
+            )
+
+    except FileNotFoundError:
+        raise Exception("Please define template vars in a file "
+                        "called " + filePath + ".vars")
+    return ((v, renderQuery(v, template, filePath)) for v in templateVars)
+
+
+def loadLocalVars(filePath):
+    local_vars = dict()
+    if filePath \
+        and os.path.exists(filePath) \
+            and os.path.isfile(filePath):
+        with open(filePath) as f:
+            local_vars = yaml.safe_load(f)
+            if not isinstance(local_vars, dict):
+                raise Exception(
+                    "Must be single json or yaml object in "
+                    + filePath)
+    return local_vars
+
+
+def loadTemplateVars(filePath) -> list:
+    try:
+        with open(filePath) as f:
+            template_vars_list = yaml.safe_load(f)
+            if not isinstance(template_vars_list, list):
+                raise Exception(
+                    "Must be json or yaml list of objects in " + filePath)
+            for definition in template_vars_list:
+                if not isinstance(definition, dict):
                     raise Exception(
-                        "Must be json or yaml list of objects in " + filePath)
-                for definition in template_vars_list:
-                    if not isinstance(definition, dict):
-                        raise Exception(
-                            "Must be json list of objects in " + filePath)
+                        "Must be json list of objects in " + filePath)
 
-                return template_vars_list
-        except FileNotFoundError:
-            return [{}]
-        except (JSONDecodeError, YAMLError) as e:
-            raise Exception("Problem reading json or yaml var list from file: ",
-                            filePath, e)
+            return template_vars_list
+    except FileNotFoundError:
+        return [{}]
+    except (JSONDecodeError, YAMLError) as e:
+        raise Exception("Problem reading json or yaml var list from file: ",
+                        filePath, e)
 
 
 class BqDataFileLoader(FileLoader):
     def __init__(self, bqClient: Client, defaultDataset=None,
-                 defaultProject=None, bqJobs=None):
+                 defaultProject=None,
+                 bqTables: BqTables = None,
+                 jobTracker: JobTracker = None,
+                 fileHashes: FileHashes = None,
+                 uploadCompression: str = "none"):
         self.bqClient = bqClient
+        self.uploadCompression = uploadCompression
+        self.bqTables = bqTables
+        self.jobTracker = jobTracker
+        self.fileHashes = fileHashes
         self.defaultDataset = defaultDataset
         self.defaultProject = defaultProject
         self.datasets = {}
-        self.bqJobs = bqJobs
 
     def load(self, filePath, dryrun=False):
         schemaFilePath = filePath + ".schema"
         with open(schemaFilePath) as schemaFile:
             schema = loadSchemaFromString(schemaFile.read().strip())
 
-        jT = None
         bqTable = parseDatasetTable(filePath, self.defaultDataset,
                                     self.defaultProject)
         bqDataset = cacheDataSet(self.bqClient, bqTable,
                                  self.datasets)
-        if not dryrun:
-            jT = self.bqJobs.getJobForTable(bqTable, "create")
 
         ret = []
-        ret.append(BqDataLoadTableResource(filePath, bqTable, schema,
-                                           self.bqClient, jT))
+        ret.append(BqDataLoadTableResource(
+            filePath, bqTable, schema, self.bqClient, None,
+            bqTables=self.bqTables, jobTracker=self.jobTracker,
+            fileHashes=self.fileHashes,
+            uploadCompression=self.uploadCompression))
         ret.append(bqDataset)
 
         return ret
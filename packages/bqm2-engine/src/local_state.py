@@ -0,0 +1,55 @@
+"""
+Local record of what each resource looked like when we last saw it
+materialized.
+
+DependencyExecutor writes the definition hash, update time and job id
+of every resource it finds up to date.  With --trustLocalState a run is
+planned from these records and the resources they show up to date
+are skipped without asking BigQuery.
+"""
+import time
+from collections import namedtuple
+
+from sqlite_store import SqliteStore
+
+ResourceState = namedtuple("ResourceState", ["hash", "created", "jobId"])
+
+RESOURCES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS resources (
+    key TEXT PRIMARY KEY,
+    hash TEXT NOT NULL,
+    created INTEGER,
+    job_id TEXT,
+    updated REAL NOT NULL)
+"""
+
+
+class LocalState:
+    """ sqlite backed map of resource key to its ResourceState """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = SqliteStore(path, RESOURCES_SCHEMA)
+
+    def states(self) -> dict:
+        """ :return: dict of resource key to ResourceState """
+        return {key: ResourceState(hash, created, jobId)
+                for (key, hash, created, jobId) in self.db.fetchall(
+                    "SELECT key, hash, created, job_id FROM resources")}
+
+    def get(self, key: str) -> ResourceState:
+        row = self.db.fetchone("SELECT hash, created, job_id "
+                               "FROM resources WHERE key = ?", (key,))
+        return ResourceState(*row) if row is not None else None
+
+    def record(self, key: str, hash: str, created, jobId: str = None):
+        self.db.write("INSERT OR REPLACE INTO resources "
+                      "(key, hash, created, job_id, updated) "
+                      "VALUES (?, ?, ?, ?, ?)",
+                      (key, hash, created, jobId, time.time()))
+
+    def forget(self, key: str):
+        self.db.write("DELETE FROM resources WHERE key = ?", (key,))
+
+    def close(self):
+        self.db.close()
@@ -13,9 +13,16 @@ Create a manifest file (see structure below)
 """
 import argparse
 import json
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 from google.cloud import storage
 
+# names are split into key ranges where they first differ, but never
+# looking further than this many characters past the prefix
+MAX_SPLIT_DEPTH = 256
+
 
 def split_uri(uri: str = None):
     """
@@ -53,24 +60,19 @@ def create_entries(blobs, suffix):
     return out
 
 
-def generate_manifest(
-    source_prefix: str = None,
-    filematch_suffix: str = None,
-    target_prefix: str = None,
-    manifest_path: str = None,
-    dry_run: bool = True,
-):
-    """
-    DO NOT write to stdout (or print) any data besides
-    the manifest json in the form of a string
-    """
-    output_dict = {
-        "entries": []
+def create_entry(blob, target_prefix: str) -> dict:
+    tail = blob.name.split("/")[-1]
+    return {
+        "meta": {
+            "content_length": blob.size
+        },
+        "mandatory": True,
+        "url": f"{target_prefix}{tail}"
     }
 
-    data_bucket, data_prefix = split_uri(source_prefix)
-    manifest_bucket, manifest_prefix = split_uri(manifest_path)
 
+def check_paths(data_prefix: str, target_prefix: str,
+                manifest_prefix: str):
     if manifest_prefix.endswith("/"):
         raise Exception(
             f"""
@@ -95,18 +97,31 @@ def generate_manifest(
             """
         )
 
+
+def generate_manifest(
+    source_prefix: str = None,
+    filematch_suffix: str = None,
+    target_prefix: str = None,
+    manifest_path: str = None,
+    dry_run: bool = True,
+):
+    """
+    DO NOT write to stdout (or print) any data besides
+    the manifest json in the form of a string
+    """
+    output_dict = {
+        "entries": []
+    }
+
+    data_bucket, data_prefix = split_uri(source_prefix)
+    manifest_bucket, manifest_prefix = split_uri(manifest_path)
+    check_paths(data_prefix, target_prefix, manifest_prefix)
+
     blobs = list_blobs(bucket=data_bucket, prefix=data_prefix)
     for blob in blobs:
         if blob.name.endswith(filematch_suffix):
-            tail = blob.name.split("/")[-1]
-            entry = {
-                "meta": {
-                    "content_length": blob.size
-                },
-                "mandatory": True,
-                "url": f"{target_prefix}{tail}"
-            }
-            output_dict["entries"].append(entry)
+            output_dict["entries"].append(
+                create_entry(blob, target_prefix))
 
     if not len(output_dict["entries"]):
         raise Exception(
@@ -128,6 +143,161 @@ def generate_manifest(
     print(output_dict_string)
 
 
+def first_name(bucket, stem: str, start: str):
+    """
+    The first blob name under stem which is not before start
+    """
+    for blob in bucket.list_blobs(prefix=stem, start_offset=start,
+                                  max_results=1):
+        return blob.name
+    return None
+
+
+def next_characters(bucket, stem: str) -> list:
+    """
+    The distinct characters following stem in the names under it,
+    skipping from one to the next with single result listings
+    """
+    characters = []
+    start = stem
+    while True:
+        name = first_name(bucket, stem, start)
+        if name is None:
+            return characters
+        if name == stem:
+            start = stem + "\0"
+            continue
+        character = name[len(stem)]
+        characters.append(character)
+        start = stem + chr(ord(character) + 1)
+
+
+def split_ranges(bucket, prefix: str) -> list:
+    """
+    Split the names directly under prefix into key ranges at the first
+    character where they differ.  i.e. extract shards t-000000000000.csv
+    to t-000001999999.csv are split on the highest changing digit.
+
+    :return: list of (start_offset, end_offset), None for open ends,
+    covering every name in order
+    """
+    stem = prefix
+    characters = next_characters(bucket, stem)
+    while len(characters) == 1 and characters[0] != "/" and \
+            len(stem) - len(prefix) < MAX_SPLIT_DEPTH:
+        stem += characters[0]
+        characters = next_characters(bucket, stem)
+
+    bounds = [stem + character for character in characters[1:]]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def spool_range(bucket, prefix: str, start_offset: str, end_offset: str,
+                filematch_suffix: str, target_prefix: str):
+    """
+    List one key range and write its entries, comma separated, to a
+    temporary file
+
+    :return: (temporary file positioned at its start, entry count)
+    """
+    spool = tempfile.TemporaryFile()
+    count = 0
+    for blob in bucket.list_blobs(prefix=prefix, delimiter='/',
+                                  start_offset=start_offset,
+                                  end_offset=end_offset):
+        if blob.name.endswith(filematch_suffix):
+            if count:
+                spool.write(b", ")
+            spool.write(json.dumps(create_entry(blob, target_prefix),
+                                   sort_keys=True).encode("utf-8"))
+            count += 1
+    spool.seek(0)
+    return (spool, count)
+
+
+def stream_manifest(
+    source_prefix: str = None,
+    filematch_suffix: str = None,
+    target_prefix: str = None,
+    manifest_path: str = None,
+    dry_run: bool = True,
+    workers: int = 8,
+):
+    """
+    Same output as generate_manifest for prefixes too large to hold in
+    memory.  Key ranges of the prefix are listed concurrently, each to
+    its own temporary file, and the files are streamed in order to
+    stdout and to a resumable upload of the manifest.
+
+    DO NOT write to stdout (or print) any data besides
+    the manifest json in the form of a string
+    """
+    data_bucket, data_prefix = split_uri(source_prefix)
+    manifest_bucket, manifest_prefix = split_uri(manifest_path)
+    check_paths(data_prefix, target_prefix, manifest_prefix)
+
+    client = storage.Client()
+    bucket = client.get_bucket(bucket_or_name=data_bucket)
+    ranges = split_ranges(bucket, data_prefix)
+
+    outputs = []
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        spools = [pool.submit(spool_range, bucket, data_prefix, start, end,
+                              filematch_suffix, target_prefix)
+                  for (start, end) in ranges]
+        try:
+            for future in spools:
+                (spool, spooled) = future.result()
+                with spool:
+                    if not spooled:
+                        continue
+                    if not outputs:
+                        # only start the upload once we know there are
+                        # entries so an empty listing writes nothing
+                        outputs.append(sys.stdout.buffer)
+                        if not dry_run:
+                            outputs.append(client.get_bucket(manifest_bucket)
+                                           .blob(f"{manifest_prefix}")
+                                           .open("wb",
+                                                 content_type="text/plain"))
+                        write_all(outputs, b'{"entries": [')
+                    elif count:
+                        write_all(outputs, b", ")
+                    count += spooled
+                    copy_all(spool, outputs)
+        finally:
+            for future in spools:
+                future.cancel()
+
+    if not count:
+        raise Exception(
+            f"""
+            No files matching the suffix {filematch_suffix}
+            under the prefix {data_prefix}
+            """
+        )
+
+    write_all(outputs, b"]}")
+    sys.stdout.buffer.write(b"\n")
+    sys.stdout.buffer.flush()
+    for output in outputs[1:]:
+        output.close()
+
+
+def write_all(outputs: list, data: bytes):
+    for output in outputs:
+        output.write(data)
+
+
+def copy_all(readable, outputs: list, blocksize=2**20):
+    while True:
+        buf = readable.read(blocksize)
+        if not buf:
+            return
+        write_all(outputs, buf)
+
+
 if __name__ == "__main__":
     """
     DO NOT write to stdout (or print) any data besides
@@ -144,13 +314,29 @@ if __name__ == "__main__":
     argument_parser.add_argument("--target-prefix", type=str, required=True)
     argument_parser.add_argument("--manifest-path", type=str, required=True)
     argument_parser.add_argument("--dry-run", action='store_true')
+    argument_parser.add_argument("--stream", action='store_true',
+                                 help="list key ranges of the prefix "
+                                      "concurrently and stream the "
+                                      "manifest instead of building it "
+                                      "in memory")
+    argument_parser.add_argument("--workers", type=int, default=8)
 
     args = argument_parser.parse_args()
 
-    generate_manifest(
-        args.source_prefix,
-        args.filematch_suffix,
-        args.target_prefix,
-        args.manifest_path,
-        args.dry_run
-    )
+    if args.stream:
+        stream_manifest(
+            args.source_prefix,
+            args.filematch_suffix,
+            args.target_prefix,
+            args.manifest_path,
+            args.dry_run,
+            args.workers
+        )
+    else:
+        generate_manifest(
+            args.source_prefix,
+            args.filematch_suffix,
+            args.target_prefix,
+            args.manifest_path,
+            args.dry_run
+        )
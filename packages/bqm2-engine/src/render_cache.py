@@ -0,0 +1,119 @@
+"""
+Persistent cache of rendered templates.
+
+Rendering a template (reading its vars, exploding them and formatting
+the query for every variant) only depends on the files next to the
+template, the global vars and tmplhelper.start_time.  We key the
+rendered output on a hash of all of those so unchanged folders skip
+rendering on the next run.  Rendered output is stored as JSON.
+"""
+import hashlib
+import json
+import os
+import time
+
+from sqlite_store import SqliteStore
+
+# bump whenever the format of rendered output changes
+CACHE_VERSION = "2"
+
+# sibling files of a template which feed its rendering
+RENDER_INPUT_SUFFIXES = ["", ".vars", ".queryjobconfig", ".schema"]
+
+RENDERS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS renders (
+    key TEXT PRIMARY KEY,
+    rendered TEXT NOT NULL,
+    used REAL NOT NULL)
+"""
+
+
+def generate_file_sha256(filename, blocksize=2**20):
+    m = hashlib.sha256()
+    with open(filename, "rb") as f:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            m.update(buf)
+    return m.hexdigest()
+
+
+def renderCacheKey(filePath: str, defaultVars: dict, startTime) -> str:
+    """
+    :return: hash of the template, its .vars, .queryjobconfig and
+    .schema siblings, the folder's local.vars, the global vars and
+    the start time used to compute relative dates
+    """
+    inputs = [filePath + suffix for suffix in RENDER_INPUT_SUFFIXES]
+    inputs.append(os.path.join(os.path.dirname(filePath), "local.vars"))
+
+    m = hashlib.sha256()
+    m.update(CACHE_VERSION.encode("utf-8"))
+    for path in inputs:
+        m.update(path.encode("utf-8"))
+        if os.path.isfile(path):
+            m.update(generate_file_sha256(path).encode("utf-8"))
+        else:
+            m.update(b"missing")
+    m.update(json.dumps(defaultVars, sort_keys=True,
+                        default=str).encode("utf-8"))
+    m.update(str(startTime).encode("utf-8"))
+    return m.hexdigest()
+
+
+class RenderCache:
+    """ sqlite backed map of renderCacheKey to rendered output.
+
+    Entries remember when they were last used.  Those unused for
+    maxAgeDays, and the least recently used beyond maxEntries, are
+    evicted when the cache is opened. """
+
+    def __init__(self, path: str, maxEntries: int = 10000,
+                 maxAgeDays: int = 30):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.maxAgeDays = maxAgeDays
+        self.hits = 0
+        self.misses = 0
+        self.db = SqliteStore(path, RENDERS_SCHEMA)
+        self.evict()
+
+    def get(self, key: str):
+        """ :return: the rendered output stored under key or None.
+        Tuples put in come back as lists """
+        row = self.db.fetchone("SELECT rendered FROM renders WHERE key = ?",
+                               (key,))
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.write("UPDATE renders SET used = ? WHERE key = ?",
+                      (time.time(), key))
+        return json.loads(row[0])
+
+    def contains(self, key: str) -> bool:
+        return self.db.fetchone("SELECT 1 FROM renders WHERE key = ?",
+                                (key,)) is not None
+
+    def put(self, key: str, rendered):
+        """ store rendered under key.  Output JSON can't hold, i.e. vars
+        yaml parsed into dates, isn't cached and is rendered every run """
+        try:
+            encoded = json.dumps(rendered)
+        except TypeError:
+            return
+        self.db.write("INSERT OR REPLACE INTO renders "
+                      "(key, rendered, used) VALUES (?, ?, ?)",
+                      (key, encoded, time.time()))
+
+    def evict(self):
+        oldest = time.time() - self.maxAgeDays * 24 * 60 * 60
+        self.db.write("DELETE FROM renders WHERE used < ?", (oldest,))
+        self.db.write("DELETE FROM renders WHERE key NOT IN "
+                      "(SELECT key FROM renders "
+                      "ORDER BY used DESC LIMIT ?)",
+                      (self.maxEntries,))
+
+    def close(self):
+        self.db.close()
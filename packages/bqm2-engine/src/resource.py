@@ -1,10 +1,19 @@
+import contextlib
+import gzip
 import hashlib
 import json
 import logging
+import os
 import re
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import uuid
-from datetime import datetime, timedelta
+from collections import defaultdict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from json.decoder import JSONDecodeError
 import sys
 
@@ -16,9 +25,13 @@ from google.cloud.bigquery.dataset import Dataset
 from google.cloud.bigquery.job import WriteDisposition, \
     QueryPriority, QueryJob, SourceFormat, \
     Compression, DestinationFormat, _AsyncJob, LoadJob, ExtractJob
-from google.cloud.bigquery.table import Table, TableReference
+from google.cloud.bigquery.table import Table, TableReference, \
+    TimePartitioning, TimePartitioningType
+from google.api_core.exceptions import GoogleAPIError
 from google.cloud.exceptions import NotFound
 
+from file_hashes import FileHashes
+
 # max length of description allowed by biquery
 # https://cloud.google.com/bigquery/quotas - found this by updating
 # a single table description.
@@ -27,6 +40,10 @@ MAX_DESCRIPTION_LEN = 16384
 
 
 class Resource:
+    # exists, updateTime and shouldUpdate of some resources also write
+    # table metadata.  Turned off to look at them without changing them
+    writeMetadata = True
+
     def exists(self):
         raise Exception("Please implement")
 
@@ -39,12 +56,60 @@ class Resource:
     def shouldUpdate(self):
         raise Exception("Please implement")
 
+    def estimateBytes(self):
+        """ Bytes a (re)build of this resource would process according
+        to a dry run.  None for resources which don't run queries """
+        return None
+
+    def definitionHash(self):
+        """ Hash of the current definition, as recorded in the remote
+        table when it is (re)created.  Lets the executor compare it to
+        the local state.  None when we can't tell """
+        return None
+
+    def localFiles(self):
+        """ Local files whose content feeds the definition hash, so
+        they can be hashed ahead of planning """
+        return []
+
     def key(self):
         raise Exception("Please implement")
 
     def dependsOn(self, resource):
         raise Exception("Please implement")
 
+    def dependencyCandidates(self, index):
+        """ Resources from a ResourceKeyIndex which dependsOn may
+        answer true for.  Defaults to every indexed resource """
+        return index.resources()
+
+    def trackedJob(self):
+        """ The background job (if any) creating this resource.  Must
+        have a job_id and a result(timeout=None) blocking until it is
+        done, as google's jobs do.  None for resources which are
+        created synchronously """
+        return None
+
+    def concurrencyPool(self):
+        """ Name of the pool of executor slots this resource's jobs
+        count against.  i.e. query, load, extract or process """
+        return "default"
+
+    def jobPrefix(self):
+        """ Prefix of the ids of the jobs creating this resource, see
+        build_jobid_prefix_from_type_and_table.  None for resources
+        created without jobs """
+        return None
+
+    def adoptJob(self, job):
+        """ Track an in flight job found creating this resource """
+        pass
+
+    def invalidateMetadata(self):
+        """ Called by the executor right after create so any cached
+        metadata about this resource is dropped """
+        pass
+
     def dump(self):
         return ""
 
@@ -54,53 +119,201 @@ class Resource:
 
 class BqJobs:
     def __init__(self, bqClient: Client,
-                 tableToJobMap: dict = {},
-                 pageSize: int = 1000, page_limit: int = 1):
+                 tableToJobMap: dict = None,
+                 pageSize: int = 1000, page_limit: int = None,
+                 maxJobAge: timedelta = timedelta(days=1)):
+        """
+        :param page_limit: maximum pages of jobs scanned per state, no
+        limit when None
+        :param maxJobAge: only jobs created this recently are scanned
+        """
         self.bqClient = bqClient
-        self.tableToJobMap = tableToJobMap
+        self.tableToJobMap = {} if tableToJobMap is None else tableToJobMap
         self.page_limit = page_limit
         self.pageSize = pageSize
+        self.maxJobAge = maxJobAge
+        self.pagesScanned = 0
+        self.jobsScanned = 0
 
     def jobs(self, state_filter=None):
         return self.bqClient.list_jobs(state_filter=state_filter)
 
-    def __loadTableJobs__(self, state):
-        logging.info("starting jobs load for ", state)
-        """ scans through 5k previous jobs and puts into
-        a map keyed by project/dataset/table/ the first job
-        encountered for that any table.
+    def __loadTableJobs__(self, state, prefixes=None,
+                          minCreationTime=None):
+        """ scans through the jobs in state, newest first, and maps
+        each job id prefix (type-dataset-table) to the first job
+        encountered for it.  Only prefixes in prefixes are kept when
+        it is given.
+
+        :return: (dict of prefix to job, pages scanned, jobs scanned)
         """
-        jiter = self.bqClient.list_jobs(max_results=self.pageSize,
-                                        state_filter=state)
-        while True:
-            for t in jiter:
-                # print("looking at: ", t.job_id)
+        logging.info("starting jobs load for %s", state)
+        found = {}
+        pages = 0
+        jobs = 0
+        jiter = self.bqClient.list_jobs(page_size=self.pageSize,
+                                        state_filter=state,
+                                        min_creation_time=minCreationTime)
+        for page in jiter.pages:
+            pages += 1
+            for t in page:
+                jobs += 1
                 jobid_prefix = build_jobid_prefix_key_from_jobid(t.job_id)
-                if not jobid_prefix:
+                if not jobid_prefix or jobid_prefix in found:
                     continue
-
-                if jobid_prefix in self.tableToJobMap:
+                if prefixes is not None and jobid_prefix not in prefixes:
                     continue
-                # print("adding key to map: ", jobid_prefix)
-                self.tableToJobMap[jobid_prefix] = t
-
-            if not jiter.next_page_token:
-                break
-            if iter.page_number > self.page_limit:
+                found[jobid_prefix] = t
+            if self.page_limit is not None and pages >= self.page_limit:
                 break
-            jiter = self.bqClient.list_jobs(max_results=self.pageSize,
-                                            page_token=jiter.next_page_token,
-                                            state_filter=state)
         print("finished jobs load for ", state)
+        return (found, pages, jobs)
 
-    def loadTableJobs(self):
-        [self.__loadTableJobs__(state) for state in ['running', 'pending']]
+    def loadTableJobs(self, prefixes: set = None):
+        """ Scan running and pending jobs concurrently.  Running jobs
+        win when both states hold a job for the same prefix.
+
+        :param prefixes: job id prefixes of the resources we care
+        about, see build_jobid_prefix_from_type_and_table
+        """
+        minCreationTime = datetime.now(timezone.utc) - self.maxJobAge
+        states = ['running', 'pending']
+        with ThreadPoolExecutor(max_workers=len(states)) as pool:
+            results = list(pool.map(
+                lambda state: self.__loadTableJobs__(state, prefixes,
+                                                     minCreationTime),
+                states))
+        for (found, pages, jobs) in results:
+            for (jobid_prefix, job) in found.items():
+                self.tableToJobMap.setdefault(jobid_prefix, job)
+            self.pagesScanned += pages
+            self.jobsScanned += jobs
+        print("scanned", self.jobsScanned, "jobs in", self.pagesScanned,
+              "pages")
 
     def getJobForTable(self, table: Table, type: str):
-        key = build_jobid_prefix_from_type_and_table(type, table)
-        if key in self.tableToJobMap:
-            return self.tableToJobMap[key]
-        return None
+        return self.getJob(build_jobid_prefix_from_type_and_table(type,
+                                                                  table))
+
+    def getJob(self, jobid_prefix: str):
+        return self.tableToJobMap.get(jobid_prefix, None)
+
+
+GcsObject = namedtuple("GcsObject", ["name", "size", "updated"])
+
+
+class GcsListings:
+    """ Cache of the objects under gcs prefixes.  Extracts may write
+    thousands of shards and exists and updateTime both need to list
+    them, as may several checks in the same executor pass.
+
+    A listing is served until reset, which the executor calls at the
+    start of every pass.  Resources writing to a prefix invalidate the
+    listings which overlap it when they start writing.  Thread safe. """
+
+    def __init__(self, gcsClient: storage.Client):
+        self.gcsClient = gcsClient
+        self.listings = {}  # (bucket, prefix) -> [GcsObject]
+        self.listed = 0
+        self.lock = threading.Lock()
+
+    def list(self, bucket: str, prefix: str) -> list:
+        """ :return: GcsObjects directly under prefix in bucket """
+        key = (bucket, prefix)
+        with self.lock:
+            cached = self.listings.get(key)
+        if cached is not None:
+            return cached
+
+        objs = listGcsObjects(self.gcsClient, bucket, prefix)
+        with self.lock:
+            self.listed += 1
+            self.listings[key] = objs
+        return objs
+
+    def reset(self):
+        """ drop every listing """
+        with self.lock:
+            self.listings = {}
+
+    def invalidate(self, bucket: str, prefix: str):
+        """ drop every listing of bucket which may include objects
+        written under prefix """
+        with self.lock:
+            for key in [k for k in self.listings if k[0] == bucket and
+                        (k[1].startswith(prefix) or
+                         prefix.startswith(k[1]))]:
+                del self.listings[key]
+
+
+class JobTracker:
+    """ Answers whether jobs are running from one listing of the
+    running jobs per project instead of reloading every job on every
+    pass.
+
+    A job missing from the latest listing (because it finished, is
+    still pending or was only just created) is reloaded on its own.
+    That way API calls scale with the number of jobs changing state,
+    not the number in flight.  Listings older than maxStaleness seconds
+    are refreshed on the next question. """
+
+    def __init__(self, bqClient: Client, maxStaleness: float = 1.0):
+        self.bqClient = bqClient
+        self.maxStaleness = maxStaleness
+        self.lock = threading.Lock()
+        self.tracked = {}
+        self.runningIds = set()
+        self.sweptAt = None
+        self.sweeps = 0
+        self.reloads = 0
+
+    def isRunning(self, job) -> bool:
+        with self.lock:
+            firstSeen = job.job_id not in self.tracked
+            self.tracked[job.job_id] = job
+            # done is final, no need to ask again
+            if not firstSeen and job.state == "DONE":
+                return False
+        if not firstSeen:
+            self.__sweepIfStale__()
+            with self.lock:
+                if job.job_id in self.runningIds:
+                    return True
+        with self.lock:
+            self.reloads += 1
+        return isJobRunning(job)
+
+    def __sweepIfStale__(self):
+        """ list the running jobs if the last listing is stale.  Only
+        the bookkeeping holds the lock, others asking meanwhile are
+        answered from the previous listing """
+        with self.lock:
+            now = time.time()
+            if self.sweptAt is not None and \
+                    now - self.sweptAt < self.maxStaleness:
+                return
+            self.sweptAt = now
+            self.sweeps += 1
+
+            created = defaultdict(list)
+            for job in self.tracked.values():
+                if job.state != "DONE":
+                    created[job.project].append(job.created)
+
+        runningIds = set()
+        try:
+            for (project, times) in sorted(created.items()):
+                times = [t for t in times if t is not None]
+                for job in self.bqClient.list_jobs(
+                        project=project, state_filter="running",
+                        min_creation_time=min(times) if times else None):
+                    runningIds.add(job.job_id)
+        except GoogleAPIError as e:
+            # reload jobs one by one until the next sweep
+            logging.warning("unable to list running jobs: %s", e)
+            runningIds = set()
+        with self.lock:
+            self.runningIds = runningIds
 
 
 def build_jobid_prefix_from_type_and_table(type: str, table: Table):
@@ -134,43 +347,140 @@ def _buildDataSetTableKey_(table: TableReference) -> str:
     return ":".join([_buildDataSetKey_(table), table.table_id])
 
 
+TABLES_METADATA_QUERY = """
+SELECT t.table_name,
+       UNIX_MILLIS(t.creation_time) AS creation_time,
+       o.option_value AS description
+FROM `{project}.{dataset}`.INFORMATION_SCHEMA.TABLES t
+LEFT JOIN `{project}.{dataset}`.INFORMATION_SCHEMA.TABLE_OPTIONS o
+ON o.table_name = t.table_name AND o.option_name = 'description'
+"""
+
+OPTION_VALUE_ESCAPES = {"n": "\n", "t": "\t", "r": "\r"}
+
+
+def _unquoteOptionValue_(value: str) -> str:
+    """ TABLE_OPTIONS.option_value holds a quoted sql string literal
+    i.e. "a \\"quoted\\" description".  Strip the quotes and the escapes
+    we care about. """
+    if value is None:
+        return None
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'":
+        value = value[1:-1]
+    return re.sub(r"\\(.)",
+                  lambda m: OPTION_VALUE_ESCAPES.get(m.group(1), m.group(1)),
+                  value)
+
+
 class BqTables:
     """ Basically a helper class whose purpose is
     to speed up the answer to questions such as
     does table x or view x exist and when was it updated.
     We lazily load the tables by waiting for a request for a table.
-    Then we load that dataset of tables """
+    Then we load that dataset of tables with a single
+    INFORMATION_SCHEMA query and answer from memory.
+
+    Tables which we (re)create during a run are invalidated and from
+    then on always fetched with get_table.  Thread safe. """
     def __init__(self, bqClient: Client):
         self.bqClient = bqClient
-        self.datasetTableMap = {}  # a map to of tables
+        # (project, dataset) -> Future of {table_id: Table}
+        self.datasetTableMap = {}
+        self.invalidated = set()
+        self.lock = threading.Lock()
+
+    def _dsetkey_(self, table: Table) -> tuple:
+        return (table.project, table.dataset_id)
 
-    def exists(self, bqTable: Table):
-        return bqTable.exists()
+    def _tablekey_(self, table: Table) -> tuple:
+        return (table.project, table.dataset_id, table.table_id)
 
-    def _dsetkey_(self, table: Table) -> str:
-        return _buildDataSetKey_(table)
+    def _loadDataset_(self, project: str, dataset: str):
+        """ :return: map of table_id to Table for the dataset, empty if
+        the dataset doesn't exist or None if we couldn't query it """
+        query = TABLES_METADATA_QUERY.format(project=project, dataset=dataset)
+        try:
+            rows = self.bqClient.query(query).result()
+        except NotFound:
+            return {}
+        except GoogleAPIError as e:
+            logging.warning("unable to snapshot tables of %s.%s: %s",
+                            project, dataset, e)
+            return None
+
+        dsetMap = {}
+        for row in rows:
+            dsetMap[row["table_name"]] = Table.from_api_repr({
+                "tableReference": {
+                    "projectId": project,
+                    "datasetId": dataset,
+                    "tableId": row["table_name"]
+                },
+                "creationTime": str(row["creation_time"]),
+                "description": _unquoteOptionValue_(row["description"])
+            })
+        return dsetMap
+
+    def _dataset_(self, dsetKey: tuple):
+        """ :return: the snapshot of a dataset, loading it on first use.
+        The first caller queries bq outside the lock, callers asking
+        for the same dataset meanwhile wait on its future """
+        with self.lock:
+            future = self.datasetTableMap.get(dsetKey, None)
+            loading = future is None
+            if loading:
+                future = Future()
+                self.datasetTableMap[dsetKey] = future
+        if loading:
+            try:
+                future.set_result(self._loadDataset_(*dsetKey))
+            except BaseException as e:
+                # let the next caller try again
+                with self.lock:
+                    del self.datasetTableMap[dsetKey]
+                future.set_exception(e)
+        return future.result()
 
     def _get_table_(self, table: Table):
-        key = self.__dsetkey_(table)
-        if key in self.datasetTableMap:
-            dsetMap = self.datasetTableMap[key]
-            if table.table_id in dsetMap:
-                return dsetMap[table.table_id]
-            else:
-                return None
-        else:  # load dataset
-            iter = self.bqClient.dataset(table.dataset_id).list_tables()
-            dsetMap = {}
-            self.datasetTableMap[key] = dsetMap
-            while True:
-                for t in iter:
-                    dsetMap[t.name] = t
-                if not iter.next_page_token:
-                    break
-            if table.friendly_name in dsetMap:
-                return table
-            else:
-                return None
+        """ :return: Table from the snapshot, None if it doesn't exist
+        or False if the snapshot can't answer for this table """
+        with self.lock:
+            if self._tablekey_(table) in self.invalidated:
+                return False
+        dsetMap = self._dataset_(self._dsetkey_(table))
+        if dsetMap is None:
+            return False
+        return dsetMap.get(table.table_id, None)
+
+    def get_table(self, table: Table) -> Table:
+        """ same contract as Client.get_table - raises NotFound """
+        cached = self._get_table_(table)
+        if cached is False:
+            return self.bqClient.get_table(table)
+        if cached is None:
+            raise NotFound(_buildFullyQualifiedTableName_(table))
+        # hand out a copy so callers can't mutate the snapshot
+        return Table.from_api_repr(cached.to_api_repr())
+
+    def exists(self, table: Table) -> bool:
+        try:
+            self.get_table(table)
+            return True
+        except NotFound:
+            return False
+
+    def put(self, table: Table):
+        """ record metadata we changed ourselves i.e. a description """
+        with self.lock:
+            future = self.datasetTableMap.get(self._dsetkey_(table), None)
+            # failed loads are never left in the map
+            if future is not None and future.done() and \
+                    future.result() is not None:
+                future.result()[table.table_id] = table
+
+    def invalidate(self, table: Table):
+        with self.lock:
+            self.invalidated.add(self._tablekey_(table))
 
 
 class BqDatasetBackedResource(Resource):
@@ -221,9 +531,15 @@ class BqDatasetBackedResource(Resource):
     def dependsOn(self, resource):
         return False
 
+    def dependencyCandidates(self, index):
+        return []
+
     def isRunning(self):
         return False
 
+    def definitionHash(self):
+        return "dataset"
+
     def shouldUpdate(self):
         return False
 
@@ -246,21 +562,43 @@ def makeJobName(parts: list):
 # base resource class for all table back resources
 class BqTableBasedResource(Resource):
     """ Base class of query based big query actions """
-    def __init__(self, table: Table, bqClient: Client):
+    # shared BqTables snapshot.  None means always ask bq directly
+    bqTables = None
+
+    def __init__(self, table: Table, bqClient: Client,
+                 bqTables: BqTables = None):
         self.table = table
         self.bqClient = bqClient
+        self.bqTables = bqTables
+
+    def getTable(self) -> Table:
+        """ metadata of self.table - raises NotFound.  May be a snapshot
+        copy with only the creation time and description so never
+        assign it to self.table, which create builds from """
+        if self.bqTables is not None:
+            return self.bqTables.get_table(self.table)
+        return self.bqClient.get_table(self.table)
+
+    def updateTable(self, table: Table, fields: list) -> Table:
+        table = self.bqClient.update_table(table, fields)
+        if self.bqTables is not None:
+            self.bqTables.put(table)
+        return table
+
+    def invalidateMetadata(self):
+        if self.bqTables is not None:
+            self.bqTables.invalidate(self.table)
 
     def exists(self):
         try:
-            self.bqClient.get_table(self.table)
+            self.getTable()
             return True
         except NotFound:
             return False
 
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
-        createdTime = self.table.created
+        createdTime = self.getTable().created
 
         if createdTime:
             return int(createdTime.strftime("%s")) * 1000
@@ -285,6 +623,27 @@ class BqTableBasedResource(Resource):
                          self.table.table_id, "${query}"])
 
 
+# ways BqDataLoadTableResource can send a local file to BigQuery
+UPLOAD_COMPRESSIONS = ["none", "gzip"]
+
+# BigQuery only loads gzipped CSV and JSON files of up to 4GB
+MAX_GZIP_UPLOAD_BYTES = 4 * 2**30
+
+
+def gzipSpool(readable, compresslevel=1, blocksize=2**20):
+    """ gzip readable into an anonymous temporary file one block at a
+    time.
+
+    :return: the temporary file positioned at its start
+    """
+    spool = tempfile.TemporaryFile()
+    with gzip.GzipFile(fileobj=spool, mode="wb",
+                       compresslevel=compresslevel) as compressed:
+        shutil.copyfileobj(readable, compressed, blocksize)
+    spool.seek(0)
+    return spool
+
+
 def generate_file_md5(filename, blocksize=2**20):
     m = hashlib.md5()
     with open(filename, "rb") as f:
@@ -296,34 +655,139 @@ def generate_file_md5(filename, blocksize=2**20):
     return m.hexdigest()
 
 
+class ProcessPipeline:
+    """
+    Runs the script of a bash table in the background and loads what it
+    writes to stdout.
+
+    stdout is gzipped into a temporary spool as it is produced and the
+    spool is handed to load_table_from_file once the script exits.  It
+    stands in for the load job until that is submitted: running() is
+    true until the script exits and result() waits for the load job.
+    """
+
+    def __init__(self, script: str, bqClient: Client, table: Table,
+                 schema: tuple, jobId: str):
+        self.script = script
+        self.bqClient = bqClient
+        self.table = table
+        self.schema = schema
+        self.job_id = jobId
+        self.loadJob = None
+        self.returncode = None
+        self.finished = False
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.__run__, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def running(self) -> bool:
+        with self.lock:
+            return not self.finished
+
+    def wait(self, timeout=None):
+        self.thread.join(timeout)
+
+    def result(self, timeout=None):
+        """ block until the script exited and its load job is done.
+        timeout applies to each in turn, None waits for ever
+
+        :return: the load job's result, None if nothing was loaded """
+        self.thread.join(timeout)
+        if self.running():
+            raise TimeoutError("script still running: " + self.script)
+        if self.loadJob is None:
+            return None
+        return self.loadJob.result(timeout=timeout)
+
+    def __run__(self):
+        try:
+            self.__pipe__()
+        except Exception as e:
+            logging.error(e)
+        finally:
+            with self.lock:
+                self.finished = True
+
+    def __pipe__(self):
+        with open(self.script + ".error", 'w') as errors, \
+                tempfile.TemporaryFile() as spool:
+            try:
+                process = subprocess.Popen(self.script,
+                                           stdout=subprocess.PIPE,
+                                           stderr=errors)
+            except OSError as ose:
+                logging.error(ose)
+                return
+
+            with process.stdout:
+                firstLine = process.stdout.readline()
+                with gzip.GzipFile(fileobj=spool, mode="wb",
+                                   compresslevel=1) as compressed:
+                    compressed.write(firstLine)
+                    shutil.copyfileobj(process.stdout, compressed)
+            self.returncode = process.wait()
+
+            if self.returncode != 0:
+                err = open(self.script + ".error").read()
+                print("exit status != 0, got " + str(self.returncode)
+                      + "error:" + err)
+                return
+
+            # todo - allow caller to specify file delimiter
+            fieldDelimiter = '\t'
+            srcFormat = BqDataLoadTableResource.detectSourceFormat(
+                firstLine.decode("utf-8"))
+            if srcFormat != SourceFormat.CSV:
+                fieldDelimiter = None
+
+            # TODO: allow separate file for declaration as with
+            # queryjobconfig
+            job_config = bigquery.LoadJobConfig(
+                source_format=srcFormat,
+                field_delimiter=fieldDelimiter, ignore_unknown_values=True,
+                write_disposition=WriteDisposition.WRITE_TRUNCATE,
+                schema=self.schema)
+
+            spool.seek(0)
+            self.loadJob = \
+                self.bqClient.load_table_from_file(spool, self.table,
+                                                   job_config=job_config,
+                                                   job_id=self.job_id)
+
+
 class BqProcessTableResource(BqTableBasedResource):
-    """ todo: currently we block during the creation of this
-    table but we should probably treat this just like any table
-    create and put it in the background
+    """ A table loaded from what a local script writes to stdout.  The
+    script runs in the background, see ProcessPipeline, so several can
+    run at once next to the rest of the DAG.
     """
     def __init__(self, query: str, table: Table,
                  schema: tuple, bqClient: Client,
-                 job: _AsyncJob):
+                 job: _AsyncJob, bqTables: BqTables = None,
+                 jobTracker: JobTracker = None):
         """ """
-        super(BqProcessTableResource, self).__init__(table, bqClient)
+        super(BqProcessTableResource, self).__init__(table, bqClient,
+                                                     bqTables)
         self.query = query
         self.table = table
         self.bqClient = bqClient
         self.schema = schema
         self.job = job
+        self.jobTracker = jobTracker
+        self.pipeline = None
         if self.job:
             print(f"found existing job: {self.job.job_id}")
 
-    def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
-
     def dependsOn(self, other: Resource):
         return self.legacyBqQueryDependsOn(other)
 
+    def dependencyCandidates(self, index):
+        if not hasattr(self, "filtered"):
+            self.filtered = getFiltered(self.query)
+        return index.keysInFiltered(self.filtered) \
+            + index.datasetsInKey(self.key())
+
     def legacyBqQueryDependsOn(self, other: Resource):
         if self == other:
             return False
@@ -350,16 +814,16 @@ class BqProcessTableResource(BqTableBasedResource):
     def updateTime(self):
         """ time in milliseconds.  None if not created """
         # self.table.reload() # reload was pre-sdk update
-        self.table = self.bqClient.get_table(self.table)
+        table = self.getTable()
 
-        createdTime = self.table.created
+        createdTime = table.created
         hashtag = self.makeHashTag()
 
         if createdTime:
             # hijack this step to update description - ugh - debt supreme
-            if not self.table.description:
-                self.table.description = "\n".join(["Do not edit", hashtag])
-                self.bqClient.update_table(self.table, ["description"])
+            if not table.description and self.writeMetadata:
+                table.description = "\n".join(["Do not edit", hashtag])
+                self.updateTable(table, ["description"])
             return int(createdTime.strftime("%s")) * 1000
         return None
 
@@ -370,9 +834,6 @@ class BqProcessTableResource(BqTableBasedResource):
             table_id = _buildFullyQualifiedTableName_(self.table)
             self.bqClient.delete_table(table_id, not_found_ok=True)
 
-        # we exec
-        import os
-
         # pump the script into a file
         # script name
         script = "/tmp/" + _buildDataSetTableKey_(table=self.table)
@@ -381,50 +842,34 @@ class BqProcessTableResource(BqTableBasedResource):
 
         os.chmod(script, 0o744)
 
-        datascript = script + ".data"
-        with open(datascript, 'wb') as writable:
-            with open(datascript + ".error", 'w') as errors:
-                try:
-                    fHandle = subprocess.Popen(script, stdout=writable,
-                                               stderr=errors)
-                except OSError as ose:
-                    logging.error(ose)
-                    return None
-
-                fHandle.wait()
-
-        if fHandle.returncode != 0:
-            err = open(datascript + ".error").read()
-            print("exit status != 0, got " + str(fHandle.returncode)
-                  + "error:" + err)
-            return None
+        self.job = None
+        self.pipeline = ProcessPipeline(
+            script, self.bqClient, self.table, self.schema,
+            makeJobName(["create", self.table.dataset_id,
+                         self.table.table_id]))
+        self.pipeline.start()
 
-        # todo - allow caller to specify file delimiter
-        fieldDelimiter = '\t'
-        with open(datascript, 'r') as readable:
-            srcFormat = BqDataLoadTableResource.detectSourceFormat(
-                                                readable.readline())
-            if srcFormat != SourceFormat.CSV:
-                fieldDelimiter = None
+    def isRunning(self):
+        if self.pipeline is not None:
+            if self.pipeline.running():
+                return True
+            self.job = self.pipeline.loadJob
+            self.pipeline = None
+        return isJobRunning(self.job, self.jobTracker)
 
-        # TODO: allow separate file for declaration as with queryjobconfig
-        job_config = bigquery.LoadJobConfig(
-            source_format=srcFormat,
-            field_delimiter=fieldDelimiter, ignore_unknown_values=True,
-            write_disposition=WriteDisposition.WRITE_TRUNCATE,
-            schema=self.schema)
-
-        with open(datascript, "rb") as source_file:
-            job_id = makeJobName(["create", self.table.dataset_id,
-                                  self.table.table_id])
-            self.job \
-                = self.bqClient.load_table_from_file(source_file,
-                                                     self.table,
-                                                     job_config=job_config,
-                                                     job_id=job_id)
+    def trackedJob(self):
+        if self.pipeline is not None:
+            return self.pipeline
+        return self.job
 
-    def isRunning(self):
-        return isJobRunning(self.job)
+    def concurrencyPool(self):
+        return "process"
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def adoptJob(self, job):
+        self.job = job
 
     def __str__(self):
         return "localdata:" + ".".join([self.table.dataset_id,
@@ -443,9 +888,15 @@ class BqProcessTableResource(BqTableBasedResource):
         except Exception:
             return False
 
+    def definitionHash(self):
+        return self.makeHashTag()
+
     def shouldUpdate(self):
         self.updateTime()
-        if not self.makeHashTag() in self.table.description:
+        # only missing if updateTime wasn't allowed to write it, in
+        # which case it would have been our hash
+        description = self.getTable().description
+        if description and self.makeHashTag() not in description:
             return True
         return False
 
@@ -459,40 +910,51 @@ class BqDataLoadTableResource(BqTableBasedResource):
     """
     def __init__(self, file: str, table: Table,
                  schema: tuple, bqClient: Client,
-                 job: _AsyncJob):
-        """ """
-        super(BqDataLoadTableResource, self).__init__(table, bqClient)
+                 job: _AsyncJob, bqTables: BqTables = None,
+                 jobTracker: JobTracker = None,
+                 fileHashes: FileHashes = None,
+                 uploadCompression: str = "none"):
+        """
+        :param uploadCompression: one of UPLOAD_COMPRESSIONS.  gzip
+        compresses the file into a temporary spool before uploading it
+        """
+        super(BqDataLoadTableResource, self).__init__(table, bqClient,
+                                                      bqTables)
+        if uploadCompression not in UPLOAD_COMPRESSIONS:
+            raise Exception("unknown upload compression", uploadCompression,
+                            "expected one of", UPLOAD_COMPRESSIONS)
+        self.uploadCompression = uploadCompression
         self.file = file
         self.table = table
         self.bqClient = bqClient
         self.schema = schema
         self.job = job
+        self.jobTracker = jobTracker
+        self.fileHashes = fileHashes if fileHashes is not None \
+            else FileHashes()
         if self.job:
             print(f"found existing job: {self.job.job_id}")
 
-    def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
-
     def makeHashTag(self):
-        schemahash = generate_file_md5(self.file + ".schema")
-        return "filehash:" + generate_file_md5(self.file) + ":" + schemahash
+        schemahash = self.fileHashes.md5(self.file + ".schema")
+        return "filehash:" + self.fileHashes.md5(self.file) + ":" \
+            + schemahash
+
+    def localFiles(self):
+        return [self.file, self.file + ".schema"]
 
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
-        createdTime = self.table.created
+        table = self.getTable()
+        createdTime = table.created
 
         hashtag = self.makeHashTag()
 
         if createdTime:
             # hijack this step to update description - ugh - debt supreme
-            if not self.table.description:
-                self.table.description = "\n".join(["Do not edit", hashtag])
-                self.bqClient.update_table(self.table, ["description"])
+            if not table.description and self.writeMetadata:
+                table.description = "\n".join(["Do not edit", hashtag])
+                self.updateTable(table, ["description"])
             return int(createdTime.strftime("%s")) * 1000
         return None
 
@@ -522,20 +984,46 @@ class BqDataLoadTableResource(BqTableBasedResource):
 
         job_id = makeJobName(["create", self.table.dataset_id,
                               self.table.table_id])
-        with open(self.file, 'rb') as readable:
+        with contextlib.ExitStack() as stack:
+            source = stack.enter_context(open(self.file, 'rb'))
+            if self.uploadCompression == "gzip":
+                spool = stack.enter_context(gzipSpool(source))
+                # too big for BigQuery to load gzipped, send it as is
+                if os.fstat(spool.fileno()).st_size <= \
+                        MAX_GZIP_UPLOAD_BYTES:
+                    source = spool
+            source.seek(0)
+            # files over 5MB go up as a resumable upload in chunks, a
+            # failed chunk is retried from where the upload stopped
             job = self.bqClient.load_table_from_file(
-                readable,
+                source,
                 self.table,
                 job_config=job_config,
-                job_id=job_id
+                job_id=job_id,
+                size=os.fstat(source.fileno()).st_size
                 )
         self.job = job
 
     def dependsOn(self, resource: Resource):
         return self.table.dataset_id == resource.key()
 
+    def dependencyCandidates(self, index):
+        return index.lookup(self.table.dataset_id)
+
     def isRunning(self):
-        return isJobRunning(self.job)
+        return isJobRunning(self.job, self.jobTracker)
+
+    def trackedJob(self):
+        return self.job
+
+    def concurrencyPool(self):
+        return "load"
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def adoptJob(self, job):
+        self.job = job
 
     def __str__(self):
         return "localdata:" + ".".join([self.table.dataset_id,
@@ -554,9 +1042,15 @@ class BqDataLoadTableResource(BqTableBasedResource):
         except Exception:
             return False
 
+    def definitionHash(self):
+        return self.makeHashTag()
+
     def shouldUpdate(self):
         self.updateTime()
-        if not self.makeHashTag() in self.table.description:
+        # only missing if updateTime wasn't allowed to write it, in
+        # which case it would have been our hash
+        description = self.getTable().description
+        if description and self.makeHashTag() not in description:
             return True
         return False
 
@@ -647,10 +1141,16 @@ class BqGcsTableLoadResource(BqTableBasedResource):
                  job: LoadJob,
                  query: str,
                  schema: tuple,
-                 options: dict):
-        super(BqGcsTableLoadResource, self).__init__(table, bqClient)
+                 options: dict,
+                 bqTables: BqTables = None,
+                 jobTracker: JobTracker = None,
+                 gcsListings: GcsListings = None):
+        super(BqGcsTableLoadResource, self).__init__(table, bqClient,
+                                                     bqTables)
         self.job = job
+        self.jobTracker = jobTracker
         self.gcsClient = gcsClient
+        self.gcsListings = gcsListings
         self.query = query
         self.schema = schema
         self.options = options
@@ -670,14 +1170,27 @@ class BqGcsTableLoadResource(BqTableBasedResource):
                                 self.table.table_id)
 
     def isRunning(self):
-        return isJobRunning(self.job)
+        return isJobRunning(self.job, self.jobTracker)
+
+    def trackedJob(self):
+        return self.job
+
+    def concurrencyPool(self):
+        return "load"
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def adoptJob(self, job):
+        self.job = job
 
     def dump(self):
         return str(self.uris)
 
     def create(self):
         if self.require_exists is not None and \
-                not gcsBlobExists(self.gcsClient, self.require_exists):
+                not gcsBlobExists(self.gcsClient, self.require_exists,
+                                  self.gcsListings):
             print(
                 self.require_exists +
                 " required file does not exist. Unable to load: ",
@@ -702,12 +1215,15 @@ class BqGcsTableLoadResource(BqTableBasedResource):
 
     def exists(self):
         try:
-            self.table = self.bqClient.get_table(self.table)
-            # update expiration if not set
-            if self.expiration is not None and self.table.expires is None:
-                self.table.expires = datetime.now() + timedelta(
-                    days=self.expiration)
-                self.bqClient.update_table(self.table, ['expires'])
+            self.getTable()
+            # update expiration if not set.  The snapshot doesn't
+            # carry expiry so fetch the table itself
+            if self.expiration is not None and self.writeMetadata:
+                table = self.bqClient.get_table(self.table)
+                if table.expires is None:
+                    table.expires = datetime.now() + timedelta(
+                        days=self.expiration)
+                    self.bqClient.update_table(table, ['expires'])
 
             return True
         except NotFound:
@@ -734,6 +1250,14 @@ class BqGcsTableLoadResource(BqTableBasedResource):
 
         return False
 
+    def dependencyCandidates(self, index):
+        if not hasattr(self, "filtered"):
+            gcsremoved = re.sub('^gs:.*$', "\n", self.query)
+            self.filtered = getFiltered(gcsremoved)
+        return index.keysInFiltered(self.filtered) \
+            + index.datasetsInKey(self.key()) \
+            + index.extractsWritingTo(self.uris)
+
     def shouldUpdate(self):
         return False
 
@@ -759,13 +1283,17 @@ class BqGcsTableLoadResource(BqTableBasedResource):
 class BqQueryBasedResource(BqTableBasedResource):
     """ Base class of query based big query actions """
     def __init__(self, queries: list, table: Table,
-                 bqClient: Client):
+                 bqClient: Client, bqTables: BqTables = None):
         self.queries = queries
         self.table = table
         self.bqClient = bqClient
+        self.bqTables = bqTables
 
         if not isinstance(self.queries, list):
             raise Exception("queries must be of type list")
+        self.querySet = set(self.queries)
+        self.finalQuery = None
+        self.queryHashTag = None
 
     def __eq__(self, other):
         try:
@@ -775,22 +1303,23 @@ class BqQueryBasedResource(BqTableBasedResource):
             return False
 
     def makeQueryHashTag(self):
-        finalQuery = self.makeFinalQuery()
-        md5hash = "queryhash:" + hashlib.md5(
-            finalQuery.encode("utf-8")).hexdigest()
-        return md5hash
+        if self.queryHashTag is None:
+            finalQuery = self.makeFinalQuery()
+            self.queryHashTag = "queryhash:" + hashlib.md5(
+                finalQuery.encode("utf-8")).hexdigest()
+        return self.queryHashTag
 
     def updateTime(self):
         """ time in milliseconds.  None if not created """
-        self.table = self.bqClient.get_table(self.table)
+        table = self.getTable()
 
-        createdTime = self.table.created
+        createdTime = table.created
 
         if createdTime:
             # getting even more debt ridden
             final_query = self.makeFinalQuery()
             # hijack this step to update description
-            if not self.table.description:
+            if not table.description and self.writeMetadata:
                 # we use a create time + a missing description
                 # as a queue to update description with the state
                 # necessary to know if we should update / re-run next
@@ -807,11 +1336,8 @@ class BqQueryBasedResource(BqTableBasedResource):
                        "Do not edit", "",
                        self.makeQueryHashTag()]
 
-                self.table.description = "\n".join(msg)
-                self.table = self.bqClient.update_table(
-                        self.table,
-                        ["description"]
-                        )
+                table.description = "\n".join(msg)
+                self.updateTable(table, ["description"])
             return int(createdTime.strftime("%s")) * 1000
         return None
 
@@ -821,6 +1347,12 @@ class BqQueryBasedResource(BqTableBasedResource):
     def dependsOn(self, other: Resource):
         return self.legacyBqQueryDependsOn(other)
 
+    def dependencyCandidates(self, index):
+        if not hasattr(self, "filtered"):
+            self.filtered = getFiltered(self.makeFinalQuery())
+        return index.keysInFiltered(self.filtered) \
+            + index.datasetsInKey(self.key())
+
     def isRunning(self):
         raise Exception("implement this function")
 
@@ -842,17 +1374,30 @@ class BqQueryBasedResource(BqTableBasedResource):
         return False
 
     def addQuery(self, query):
-        s = set(self.queries)
-        if query not in s:
+        if query not in self.querySet:
+            self.querySet.add(query)
             self.queries.append(query)
+            # drop everything derived from the final query
+            self.finalQuery = None
+            self.queryHashTag = None
+            if hasattr(self, "filtered"):
+                del self.filtered
 
     def makeFinalQuery(self):
-        return "\nunion all\n".join(self.queries)
+        if self.finalQuery is None:
+            self.finalQuery = "\nunion all\n".join(self.queries)
+        return self.finalQuery
+
+    def definitionHash(self):
+        return self.makeQueryHashTag()
 
     def shouldUpdate(self):
         self.updateTime()
 
-        if not self.makeQueryHashTag() in self.table.description:
+        # only missing if updateTime wasn't allowed to write it, in
+        # which case it would have been our hash
+        description = self.getTable().description
+        if description and self.makeQueryHashTag() not in description:
             print("updating because query hash is not in the description")
             return True
 
@@ -903,14 +1448,68 @@ def strictSubstring(contained, container):
     return contained in container and len(contained) < len(container)
 
 
+class ResourceKeyIndex:
+    """ Inverted index of resources by key, dataset and extract uri.
+
+    Lets the dependency builder look up the handful of resources
+    another resource may depend on instead of calling dependsOn
+    for every pair.  Lookups return candidates only - a superset
+    of the real dependencies which dependsOn still has to confirm.
+    """
+    def __init__(self, resources):
+        self.byKey = {}
+        self.datasets = []
+        self.extractsByUri = defaultdict(list)
+        for rsrc in resources:
+            self.byKey[rsrc.key()] = rsrc
+            if isinstance(rsrc, BqDatasetBackedResource):
+                self.datasets.append(rsrc)
+            elif isinstance(rsrc, BqExtractTableResource):
+                for uri in rsrc.uris.split(","):
+                    self.extractsByUri[uri].append(rsrc)
+
+    def resources(self):
+        return list(self.byKey.values())
+
+    def lookup(self, key):
+        if key in self.byKey:
+            return [self.byKey[key]]
+        return []
+
+    def keysInFiltered(self, filtered):
+        """
+        :param filtered: text as returned by getFiltered
+        :return: resources whose key followed by a space occurs in
+        filtered, i.e. whose key is a suffix of one of its tokens
+        """
+        ret = []
+        for token in set(filtered.split()):
+            for i in range(len(token)):
+                if token[i:] in self.byKey:
+                    ret.append(self.byKey[token[i:]])
+        return ret
+
+    def datasetsInKey(self, key):
+        return [dset for dset in self.datasets if dset.key() in key]
+
+    def extractsWritingTo(self, uris):
+        ret = []
+        for uri in uris:
+            ret += self.extractsByUri.get(uri, [])
+        return ret
+
+
 class BqQueryBackedTableResource(BqQueryBasedResource):
     def __init__(self, query: str, table: Table,
                  bqClient: Client, queryJob: QueryJob,
                  queryJobConfig: QueryJobConfig,
-                 expiration: None, location: None):
+                 expiration: None, location: None,
+                 bqTables: BqTables = None,
+                 jobTracker: JobTracker = None):
         super(BqQueryBackedTableResource, self)\
-            .__init__(query, table, bqClient)
+            .__init__(query, table, bqClient, bqTables)
         self.queryJob = queryJob
+        self.jobTracker = jobTracker
         if self.queryJob:
             print(f"found running/pending job table: {self.queryJob}")
         self.expiration = expiration
@@ -955,12 +1554,336 @@ class BqQueryBackedTableResource(BqQueryBasedResource):
             self.queryJob.add_done_callback(done_callback)
 
     def isRunning(self):
-        return isJobRunning(self.queryJob)
+        return isJobRunning(self.queryJob, self.jobTracker)
+
+    def trackedJob(self):
+        return self.queryJob
+
+    def concurrencyPool(self):
+        return "query"
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def adoptJob(self, job):
+        self.queryJob = job
+
+    def estimateBytes(self):
+        return dryRunBytes(self.bqClient, self.makeFinalQuery(),
+                           self.queryJobConfig, self.location)
 
     def dump(self):
         return self.makeFinalQuery()
 
 
+PARTITION_TYPES = {4: TimePartitioningType.YEAR,
+                   6: TimePartitioningType.MONTH,
+                   8: TimePartitioningType.DAY,
+                   10: TimePartitioningType.HOUR}
+
+PARTITION_HASHES_TAG = "partitionhashes:"
+PARTITIONS_WRITTEN_TAG = "partitionswritten:"
+
+# partition jobs a BqPartitionedTableResource keeps in flight.  The
+# executor counts the whole table as one job of its pool
+MAX_CONCURRENT_PARTITIONS = 4
+
+
+class JobGroup:
+    """ Done once every job in it is done.  Lets the executor wait on
+    the jobs of all partitions like on a single job """
+
+    def __init__(self, jobs: list):
+        self.jobs = jobs
+        self.job_id = ",".join([job.job_id for job in jobs])
+
+    def result(self, timeout=None):
+        """ wait for every job, raising the first failure after all of
+        them are done """
+        errors = []
+        for job in self.jobs:
+            try:
+                job.result(timeout=timeout)
+            except GoogleAPIError as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+class BqPartitionedTableResource(BqQueryBasedResource):
+    """
+    A time partitioned table materialized one partition at a time.
+
+    Each exploded variant of a .partitiontable template is the query of
+    one partition and is written with WRITE_TRUNCATE to its partition
+    decorator i.e. table$20230101.  The hash of each partition's query
+    is kept in the table description so only partitions whose query
+    changed, or which were never written, are recomputed.  So is the
+    time the newest partition was written, our update time, as the
+    table's own modified time also moves with metadata updates.  When none
+    did, the rebuild is down to a dependency and every partition is
+    recomputed.  Partitions are queued and at most
+    maxConcurrentPartitions of their jobs run at once.
+    """
+
+    def __init__(self, partitions: dict, table: Table,
+                 bqClient: Client, queryJob: QueryJob,
+                 queryJobConfig: QueryJobConfig,
+                 location: None, partitionField: str = None,
+                 bqTables: BqTables = None,
+                 jobTracker: JobTracker = None,
+                 maxConcurrentPartitions: int = MAX_CONCURRENT_PARTITIONS):
+        """
+        :param partitions: dict of partition id (yyyy, yyyymm, yyyymmdd
+        or yyyymmddhh) to the query materializing it
+        :param partitionField: column the table is partitioned by.
+        Partitioned by ingestion time when None
+        :param maxConcurrentPartitions: partition jobs run at once
+        """
+        super(BqPartitionedTableResource, self)\
+            .__init__([partitions[p] for p in sorted(partitions)], table,
+                      bqClient, bqTables)
+        self.partitions = {}
+        for (partition, query) in partitions.items():
+            self.checkPartition(partition)
+            self.partitions[partition] = query
+        self.queryJobConfig = queryJobConfig
+        self.location = location
+        self.partitionField = partitionField
+        self.jobTracker = jobTracker
+        self.maxConcurrentPartitions = maxConcurrentPartitions
+        # partition to the job writing it, None for an adopted job
+        self.jobs = {}
+        # stale partitions waiting for a job
+        self.queued = []
+        if queryJob:
+            print(f"found running/pending job table: {queryJob}")
+            self.adoptJob(queryJob)
+
+    def checkPartition(self, partition: str):
+        if len(partition) not in PARTITION_TYPES or \
+                not partition.isdigit():
+            raise Exception("partition must be yyyy, yyyymm, yyyymmdd or "
+                            "yyyymmddhh for " + str(self) + " not " +
+                            partition)
+        if self.partitions and \
+                len(partition) != len(next(iter(self.partitions))):
+            raise Exception("all partitions of " + str(self) +
+                            " must have the same granularity")
+
+    def addPartition(self, partition: str, query: str):
+        if partition in self.partitions:
+            if self.partitions[partition] != query:
+                raise Exception("partition " + partition + " of " +
+                                str(self) + " defined twice")
+            return
+        self.checkPartition(partition)
+        self.partitions[partition] = query
+        self.addQuery(query)
+
+    def partitionHash(self, partition: str) -> str:
+        return hashlib.md5(self.partitions[partition].encode("utf-8"))\
+            .hexdigest()[:16]
+
+    def timePartitioning(self):
+        partitionType = PARTITION_TYPES[len(next(iter(self.partitions)))]
+        return TimePartitioning(type_=partitionType,
+                                field=self.partitionField)
+
+    def fullTable(self) -> Table:
+        """ metadata the BqTables snapshot doesn't carry, i.e. the last
+        modified time and time partitioning - raises NotFound """
+        return self.bqClient.get_table(self.table)
+
+    def descriptionTag(self, table: Table, tag: str) -> str:
+        """ :return: what follows tag in the table description, None
+        if it isn't there """
+        for line in (table.description or "").split("\n"):
+            if line.startswith(tag):
+                return line[len(tag):].strip()
+        return None
+
+    def recordedHashes(self, table: Table = None) -> dict:
+        """ :return: dict of partition to the hash of the query it was
+        last written with, read from the table description """
+        if table is None:
+            table = self.getTable()
+        hashes = self.descriptionTag(table, PARTITION_HASHES_TAG)
+        return dict([pair.split("=", 1) for pair in (hashes or "").split()])
+
+    def writtenTime(self, table: Table) -> int:
+        """ :return: time in milliseconds the newest partition was
+        written according to the description, None if not recorded """
+        written = self.descriptionTag(table, PARTITIONS_WRITTEN_TAG)
+        return int(written) if written else None
+
+    def stalePartitions(self, table: Table = None) -> list:
+        recorded = self.recordedHashes(table)
+        return [p for p in sorted(self.partitions)
+                if recorded.get(p) != self.partitionHash(p)]
+
+    def rebuiltPartitions(self, table: Table) -> list:
+        """ :return: the partitions a (re)create writes.  The stale ones
+        or, if there are none, all of them as the executor only asks
+        for a rebuild of a table whose definition is current when its
+        dependencies changed """
+        return self.stalePartitions(table) or sorted(self.partitions)
+
+    def __recordFinishedPartitions__(self):
+        """ Note the hash of every partition whose job succeeded in the
+        description.  Failed partitions are forgotten so they stay
+        stale and get retried.  Without writeMetadata nothing is noted
+        and their partitions still look stale
+
+        :return: the table metadata, with the description we wrote """
+        table = self.getTable()
+        if not self.writeMetadata:
+            return table
+        finished = []
+        written = self.writtenTime(table)
+        for (partition, job) in list(self.jobs.items()):
+            if job.state != "DONE":
+                continue
+            del self.jobs[partition]
+            if partition is not None and not job.error_result:
+                finished.append(partition)
+                if job.ended is not None:
+                    written = max(written or 0,
+                                  int(job.ended.timestamp() * 1000))
+        if not finished:
+            return table
+
+        recorded = self.recordedHashes(table)
+        for partition in finished:
+            recorded[partition] = self.partitionHash(partition)
+        # only keep partitions we still define to bound its size
+        hashes = " ".join(["=".join([p, recorded[p]])
+                           for p in sorted(recorded)
+                           if p in self.partitions])
+        table.description = "\n".join([
+            "This table is materialized one partition at a time",
+            "Edits to this description will not be saved",
+            "Do not edit", "",
+            PARTITION_HASHES_TAG + " " + hashes] +
+            ([PARTITIONS_WRITTEN_TAG + " " + str(written)]
+             if written is not None else []))
+        return self.updateTable(table, ["description"])
+
+    def updateTime(self):
+        """ time in milliseconds the newest partition was written.
+        None if not created """
+        written = self.writtenTime(self.__recordFinishedPartitions__())
+        if written is not None:
+            return written
+        # written before we recorded it, only the table's modified
+        # time is left to go by
+        modified = self.fullTable().modified
+        if modified:
+            return int(modified.strftime("%s")) * 1000
+        return None
+
+    def shouldUpdate(self):
+        stale = self.stalePartitions(self.__recordFinishedPartitions__())
+        if stale:
+            print("updating partitions", " ".join(stale), "of", self)
+            return True
+        return False
+
+    def definitionHash(self):
+        return self.makeQueryHashTag()
+
+    def create(self):
+        timePartitioning = self.timePartitioning()
+        try:
+            table = self.fullTable()
+        except NotFound:
+            table = None
+        if table is None or table.time_partitioning is None:
+            if table is not None:
+                self.bqClient.delete_table(table, not_found_ok=True)
+            if self.partitionField is None:
+                # decorators can only target an existing table
+                table = Table(_buildFullyQualifiedTableName_(self.table))
+                table.time_partitioning = timePartitioning
+                self.bqClient.create_table(table)
+            stale = sorted(self.partitions)
+        else:
+            stale = self.rebuiltPartitions(table)
+
+        # leave partitions an adopted job is still writing to it
+        running = [p for (p, job) in self.jobs.items()
+                   if isJobRunning(job, self.jobTracker)]
+        self.queued = [p for p in stale if p not in running]
+        self.__startQueued__(len(running))
+
+    def __startQueued__(self, running: int) -> int:
+        """ start jobs for queued partitions until
+        maxConcurrentPartitions are running
+
+        :param running: partition jobs running now
+        :return: partition jobs running afterwards """
+        while self.queued and running < self.maxConcurrentPartitions:
+            partition = self.queued.pop(0)
+            jobConfig = QueryJobConfig.from_api_repr(
+                self.queryJobConfig.to_api_repr())
+            jobConfig.destination = TableReference.from_string(
+                _buildFullyQualifiedTableName_(self.table) + "$" +
+                partition)
+            jobConfig.write_disposition = WriteDisposition.WRITE_TRUNCATE
+            jobConfig.time_partitioning = self.timePartitioning()
+            self.jobs[partition] = self.bqClient.query(
+                self.partitions[partition],
+                job_config=jobConfig,
+                job_id=makeJobName(["create", self.table.dataset_id,
+                                    self.table.table_id]),
+                location=self.location)
+            running += 1
+        return running
+
+    def isRunning(self):
+        running = len([job for job in self.jobs.values()
+                       if isJobRunning(job, self.jobTracker)])
+        # top up from the queue as earlier partitions finish
+        return self.__startQueued__(running) > 0
+
+    def trackedJob(self):
+        if not self.jobs:
+            return None
+        return JobGroup(list(self.jobs.values()))
+
+    def concurrencyPool(self):
+        return "query"
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("create", self.table)
+
+    def adoptJob(self, job):
+        """ keyed by the partition it writes when that is one of ours
+        with its current query, so it counts as writing it """
+        partition = None
+        destination = getattr(job, "destination", None)
+        if destination is not None and "$" in destination.table_id:
+            candidate = destination.table_id.split("$", 1)[1]
+            if getattr(job, "query", None) == \
+                    self.partitions.get(candidate):
+                partition = candidate
+        self.jobs[partition] = job
+
+    def estimateBytes(self):
+        try:
+            stale = self.rebuiltPartitions(self.getTable())
+        except NotFound:
+            stale = sorted(self.partitions)
+        return sum([dryRunBytes(self.bqClient, self.partitions[p],
+                                self.queryJobConfig, self.location)
+                    for p in stale])
+
+    def dump(self):
+        return "\n".join(["-- partition " + p + "\n" +
+                          self.partitions[p] + "\n"
+                          for p in sorted(self.partitions)])
+
+
 def processExtractTableOptions(options: dict):
     compressions = {
         "GZIP": Compression.GZIP,
@@ -1009,9 +1932,14 @@ class BqExtractTableResource(Resource):
                  gcsClient: storage.Client,
                  extractJob: ExtractJob,
                  uris: str,
-                 options: dict):
+                 options: dict,
+                 bqTables: BqTables = None,
+                 jobTracker: JobTracker = None,
+                 gcsListings: GcsListings = None):
 
         self.extractJob = extractJob
+        self.jobTracker = jobTracker
+        self.gcsListings = gcsListings
         if self.extractJob:
             print(f"found existing job: {self.extractJob.job_id}")
         self.table = table
@@ -1021,6 +1949,7 @@ class BqExtractTableResource(Resource):
         # check uris
         (self.bucket, self.pathPrefix) = self.parseBucketAndPrefix(uris)
         self.options = options
+        self.bqTables = bqTables
 
     def create(self):
         jobid = makeJobName(["extract", self.table.dataset_id,
@@ -1038,18 +1967,42 @@ class BqExtractTableResource(Resource):
         return self._key
 
     def isRunning(self):
-        return isJobRunning(self.extractJob)
+        running = isJobRunning(self.extractJob, self.jobTracker)
+        if running:
+            # shards are still being written, don't keep listing them
+            self.invalidateMetadata()
+        return running
+
+    def invalidateMetadata(self):
+        if self.gcsListings is not None:
+            (bucket, prefix) = parseBucketAndPrefix(self.uris)
+            self.gcsListings.invalidate(bucket, prefix.split('*')[0])
+
+    def trackedJob(self):
+        return self.extractJob
+
+    def concurrencyPool(self):
+        return "extract"
+
+    def jobPrefix(self):
+        return build_jobid_prefix_from_type_and_table("extract", self.table)
+
+    def adoptJob(self, job):
+        self.extractJob = job
 
     def __str__(self):
         return "extract:" + ".".join([self.table.dataset_id,
                                      self.table.table_id])
 
     def exists(self):
-        return gcsExists(self.gcsClient, self.uris)
+        return gcsExists(self.gcsClient, self.uris, self.gcsListings)
 
     def dependsOn(self, other: Resource):
         return "extract." + other.key() == self.key()
 
+    def dependencyCandidates(self, index):
+        return index.lookup(f"{self.table.dataset_id}.{self.table.table_id}")
+
     def dump(self):
         return ",".join(self.uris)
 
@@ -1060,7 +2013,7 @@ class BqExtractTableResource(Resource):
 
     def updateTime(self):
         objs = [int(o.updated.timestamp() * 1000) for o in
-                gcsUris(self.gcsClient, self.uris)]
+                gcsUris(self.gcsClient, self.uris, self.gcsListings)]
 
         if len(objs) == 0:
             # basically i've never been extracted
@@ -1069,17 +2022,36 @@ class BqExtractTableResource(Resource):
         return max(objs)
 
     def shouldUpdate(self):
-        self.table = self.bqClient.get_table(self.table)
-        createdTime = self.table.created
+        if self.bqTables is not None:
+            createdTime = self.bqTables.get_table(self.table).created
+        else:
+            createdTime = self.bqClient.get_table(self.table).created
         if not createdTime:
             return False
 
         return self.updateTime() < int(createdTime.strftime("%s")) * 1000
 
 
-def isJobRunning(job):
+def dryRunBytes(bqClient: Client, query: str,
+                queryJobConfig: QueryJobConfig = None, location=None) -> int:
+    """ :return: bytes processed by query according to a dry run """
+    jobConfig = QueryJobConfig(dry_run=True, use_query_cache=False)
+    if queryJobConfig is not None:
+        # whatever changes what the query reads, but not where it writes
+        jobConfig.use_legacy_sql = queryJobConfig.use_legacy_sql
+        if queryJobConfig.default_dataset is not None:
+            jobConfig.default_dataset = queryJobConfig.default_dataset
+        if queryJobConfig.query_parameters:
+            jobConfig.query_parameters = queryJobConfig.query_parameters
+    job = bqClient.query(query, job_config=jobConfig, location=location)
+    return job.total_bytes_processed or 0
+
+
+def isJobRunning(job, jobTracker: JobTracker = None):
     if not job:
         return False
+    if jobTracker is not None:
+        return jobTracker.isRunning(job)
 
     job.reload()
     log_stream = sys.stdout
@@ -1097,8 +2069,11 @@ def parseBucketAndPrefix(uris):
     return (bucket, prefix)
 
 
-def gcsBlobExists(gcsclient, gcsUri):
+def gcsBlobExists(gcsclient, gcsUri, gcsListings: GcsListings = None):
     bucket_name, blob_path = parseBucketAndBlobPath(gcsUri)
+    if gcsListings is not None:
+        return any([o.name == blob_path for o in
+                    gcsListings.list(bucket_name, blob_path)])
     bucket = gcsclient.bucket(bucket_name)
     blob = bucket.blob(blob_path)
     return blob.exists()
@@ -1110,11 +2085,18 @@ def parseBucketAndBlobPath(uri):
     return (bucket_name, blob_path)
 
 
-def gcsExists(gcsClient, uris):
-    return len(gcsUris(gcsClient, uris)) > 0
+def gcsExists(gcsClient, uris, gcsListings: GcsListings = None):
+    return len(gcsUris(gcsClient, uris, gcsListings)) > 0
 
 
-def gcsUris(gcsClient, uris):
+def listGcsObjects(gcsClient, bucket: str, prefix: str) -> list:
+    """ :return: GcsObjects directly under prefix in bucket """
+    bucket = gcsClient.get_bucket(bucket)
+    return [GcsObject(x.name, x.size, x.updated) for x in
+            bucket.list_blobs(prefix=prefix, delimiter='/')]
+
+
+def gcsUris(gcsClient, uris, gcsListings: GcsListings = None):
     (bucket, prefix) = parseBucketAndPrefix(uris)
     parts = prefix.split('*')
     if len(parts) > 2:
@@ -1122,13 +2104,12 @@ def gcsUris(gcsClient, uris):
                         "a single * char and provide file " +
                         "suffix info: {str(uris)}")
 
-    args = {'prefix': parts[0], 'delimiter': '/'}
+    if gcsListings is not None:
+        objs = gcsListings.list(bucket, parts[0])
+    else:
+        objs = listGcsObjects(gcsClient, bucket, parts[0])
 
-    bucket = gcsClient.get_bucket(bucket)
-    objs = [x for x in bucket.list_blobs(**args)
-            if len(parts) == 1 or x.name.endswith(parts[1])]
-
-    return objs
+    return [x for x in objs if len(parts) == 1 or x.name.endswith(parts[1])]
 
 
 # deliberately class level
@@ -1155,9 +2136,11 @@ def legacyBqQueryDependsOn(self, other: Resource):
 class BqExternalTableBasedResource(BqTableBasedResource):
     """ Base class of query based big query actions """
     def __init__(self, bqclient: Client, table: Table,
-                 external_config: ExternalConfig):
+                 external_config: ExternalConfig,
+                 bqTables: BqTables = None):
         self.table = table
         self.bqClient = bqclient
+        self.bqTables = bqTables
         self.external_config = external_config
         self.table.external_data_configuration = external_config
 
@@ -1170,32 +2153,32 @@ class BqExternalTableBasedResource(BqTableBasedResource):
         if not autodetect and not table.schema:
             raise Exception("you must not specify a schema in a .schema file")
 
-    def exists(self):
-        try:
-            self.bqClient.get_table(self.table)
-            return True
-        except NotFound:
-            return False
-
     def create(self):
         self.bqClient.delete_table(self.table, not_found_ok=True)
         self.table = self.bqClient.create_table(self.table)
         self.table.description = self.make_description()
         # update description - for some reason this can't be done
         # on create???
-        self.bqClient.update_table(self.table, ["description"])
+        self.updateTable(self.table, ["description"])
 
     def dependsOn(self, resource: Resource):
         if self.table.dataset_id == resource.key():
             return True
         return legacyBqQueryDependsOn(self, resource)
 
+    def dependencyCandidates(self, index):
+        return index.lookup(self.table.dataset_id) \
+            + index.datasetsInKey(self.key())
+
     def isRunning(self):
         # this is not an async operation
         return False
 
+    def definitionHash(self):
+        return self.makeHashTag()
+
     def shouldUpdate(self):
-        current_description = self.bqClient.get_table(self.table).description
+        current_description = self.getTable().description
         if not current_description:
             return True
         if not self.makeHashTag() in current_description:
@@ -0,0 +1,43 @@
+"""
+The sqlite files kept between runs: the render cache, job history,
+local state and file hash cache each hold a single table in one.
+"""
+import sqlite3
+import threading
+
+
+class SqliteStore:
+    """ A sqlite file and the table it holds.
+
+    Opened in WAL mode with relaxed syncing, losing the last writes to
+    a crash only costs recomputing them.  Statements run under a lock
+    so a store can be shared by threads. """
+
+    def __init__(self, path: str, schema: str):
+        """
+        :param schema: CREATE TABLE IF NOT EXISTS statement of the table
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.write(schema)
+
+    def fetchone(self, sql: str, params: tuple = ()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params: tuple = ()) -> list:
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def write(self, sql: str, params: tuple = ()):
+        """ run sql and commit it """
+        with self.lock:
+            self.conn.execute(sql, params)
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
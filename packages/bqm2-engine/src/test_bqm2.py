@@ -1,10 +1,15 @@
 import optparse
 import unittest
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch, mock_open
 
-from bqm2 import DependencyExecutor, find_cycles
+import pytest
+
+from bqm2 import DependencyExecutor, DependencyPlan, find_cycles, \
+    buildDependencies, parseMaxConcurrent
 from bqm2 import KVOption
+from resource import Resource
 
 
 class Test(unittest.TestCase):
@@ -35,4 +40,527 @@ def test_find_cycles_cycle_distance_two():
         'b': set('c'),
         'c': set('a'),
         'd': set()}
-    )
\ No newline at end of file
+    )
+
+
+def test_plan_levels():
+    plan = DependencyPlan({'a': set(), 'b': set('a'), 'c': set('a'),
+                           'd': set('bc'), 'e': set()})
+    assert plan.levels == [['a', 'e'], ['b', 'c'], ['d']]
+    assert plan.order() == ['a', 'e', 'b', 'c', 'd']
+    assert plan.dependents['a'] == {'b', 'c'}
+    assert not plan.blocked
+    assert plan.cycles == []
+
+
+def test_plan_reports_cycle_path():
+    plan = DependencyPlan({
+        'a': set('b'),
+        'b': set('c'),
+        'c': set('a'),
+        'd': set(),
+        'e': set('ad')})
+    assert plan.levels == [['d']]
+    assert plan.blocked == {'a', 'b', 'c', 'e'}
+    assert plan.cycles == [['a', 'b', 'c', 'a']]
+
+
+def test_plan_reports_each_cycle():
+    plan = DependencyPlan({'a': set('a'), 'b': set('c'), 'c': set('b')})
+    assert plan.cycles == [['a', 'a'], ['b', 'c', 'b']]
+
+
+def test_show_follows_plan(capsys):
+    de = DependencyExecutor({}, {'a': set(), 'b': set('a'), 'c': set()})
+    de.show()
+    out, err = capsys.readouterr()
+    assert out.splitlines()[-3:] == ["would execute a",
+                                     "would execute c",
+                                     "would execute b"]
+    # the executor's dependencies are no longer consumed
+    assert de.dependencies['b'] == set('a')
+
+def _bruteForceDependencies(resources):
+    return {rsrc.key(): set([osrc.key() for osrc in resources.values()
+                             if rsrc.dependsOn(osrc)])
+            for rsrc in resources.values()}
+
+
+def test_build_dependencies_matches_pairwise_scan():
+    from google.cloud.bigquery.dataset import Dataset
+    from google.cloud.bigquery.table import Table
+    from resource import BqDatasetBackedResource, BqQueryBackedTableResource, \
+        BqViewBackedTableResource, BqExtractTableResource, \
+        BqGcsTableLoadResource
+
+    def table(name):
+        return Table("p." + name)
+
+    rsrcs = [
+        BqDatasetBackedResource(Dataset("p.d"), None),
+        BqDatasetBackedResource(Dataset("p.other"), None),
+        BqQueryBackedTableResource(["select 1"], table("d.a"), None,
+                                   None, None, None, None),
+        BqQueryBackedTableResource(["select * from d.a join d.ab"],
+                                   table("d.b"), None, None, None, None,
+                                   None),
+        BqQueryBackedTableResource(["select * from `p.d.a`"],
+                                   table("other.ab"), None, None, None,
+                                   None, None),
+        BqViewBackedTableResource(["select * from xd.b, other.ab"],
+                                  table("d.v"), None),
+        BqExtractTableResource(table("d.b"), None, None, None,
+                               "gs://bucket/b/*.gz", {}),
+        BqGcsTableLoadResource(table("other.loaded"), None, None, None,
+                               "gs://bucket/b/*.gz\nselect d.v", None, {}),
+    ]
+    resources = {rsrc.key(): rsrc for rsrc in rsrcs}
+
+    actual = buildDependencies(resources)
+
+    assert actual == _bruteForceDependencies(resources)
+    assert actual["d.b"] == {"d", "d.a"}
+    assert actual["extract.d.b"] == {"d.b"}
+    assert "extract.d.b" in actual["other.loaded"]
+
+
+class FakeJob:
+    """ completes after delay seconds, like a google job """
+    def __init__(self, delay):
+        import threading
+        self.done = threading.Event()
+        self.finished = False
+        threading.Timer(delay, self.finish).start()
+
+    def finish(self):
+        self.finished = True
+        self.done.set()
+
+    def result(self, timeout=None):
+        self.done.wait(timeout)
+
+
+class FakeResource(Resource):
+    def __init__(self, name, log, delay=0.05, failures=0, pool="default"):
+        self.name = name
+        self.pool = pool
+        self.log = log
+        self.delay = delay
+        self.failures = failures
+        self.job = None
+        self.created = None
+        self.definition = "v1"
+        self.runningChecks = 0
+
+    def key(self):
+        return self.name
+
+    def isRunning(self):
+        self.runningChecks += 1
+        return self.job is not None and not self.job.finished
+
+    def definitionHash(self):
+        return self.definition
+
+    def trackedJob(self):
+        return self.job
+
+    def concurrencyPool(self):
+        return self.pool
+
+    def exists(self):
+        return self.created is not None and self.job.finished \
+            and self.failures < 0
+
+    def shouldUpdate(self):
+        return False
+
+    def updateTime(self):
+        return self.created
+
+    def create(self):
+        import time
+        self.failures -= 1
+        self.log.append(("start", self.name))
+        self.created = time.time()
+        self.job = FakeJob(self.delay)
+        self.job.job_id = "create-" + self.name
+
+
+def test_execute_async_respects_dependencies_and_concurrency():
+    log = []
+    resources = {k: FakeResource(k, log) for k in ["a", "b", "c", "d"]}
+    dependencies = {"a": set(), "b": set(), "c": {"a"}, "d": {"b", "c"}}
+    de = DependencyExecutor(resources, dependencies)
+
+    de.executeAsync(maxConcurrent=1)
+
+    order = [n for (_, n) in log]
+    assert sorted(order) == ["a", "b", "c", "d"]
+    assert order.index("c") > order.index("a")
+    assert order[-1] == "d"
+
+
+def test_execute_releases_dependents_in_plan_order():
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01)
+                 for k in ["a", "b", "c", "d"]}
+    dependencies = {"a": set(), "b": set(), "c": {"a"}, "d": {"b", "c"}}
+    de = DependencyExecutor(resources, dependencies)
+
+    de.execute(checkFrequency=0.01, maxConcurrent=1)
+
+    assert [n for (_, n) in log] == ["a", "b", "c", "d"]
+
+
+def test_execute_async_releases_dependents_without_polling():
+    import time
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01)
+                 for k in ["a", "b", "c"]}
+    dependencies = {"a": set(), "b": {"a"}, "c": {"b"}}
+    de = DependencyExecutor(resources, dependencies)
+
+    start = time.time()
+    de.executeAsync()
+
+    assert [n for (_, n) in log] == ["a", "b", "c"]
+    assert time.time() - start < 1
+
+
+def test_execute_async_retries_failures_then_gives_up():
+    log = []
+    resources = {"a": FakeResource("a", log, delay=0.01, failures=1),
+                 "b": FakeResource("b", log, delay=0.1, failures=5)}
+    de = DependencyExecutor(resources, {"a": set(), "b": set()},
+                            maxRetry=2)
+
+    try:
+        de.executeAsync()
+        assert False, "should have hit max retries for b"
+    except Exception as e:
+        assert "Maximum retries" in str(e)
+
+    assert log.count(("start", "a")) == 2
+    assert log.count(("start", "b")) == 2
+
+
+def test_job_done_waits_on_result_not_callbacks():
+    import asyncio
+    from unittest.mock import MagicMock
+    from bqm2 import _jobDone
+    job = MagicMock()
+    # like a long load job whose polling thread gave up
+    job.add_done_callback.side_effect = lambda callback: None
+    job.result.side_effect = Exception("load failed")
+
+    asyncio.run(asyncio.wait_for(_jobDone(job), 5))
+
+    job.result.assert_called_once_with(timeout=None)
+    job.add_done_callback.assert_not_called()
+
+
+def test_plan_priorities_fall_back_to_descendants():
+    plan = DependencyPlan({"a": set(), "b": {"a"}, "c": {"a"},
+                           "d": {"b", "c"}, "e": set()})
+
+    priorities = plan.priorities()
+
+    assert priorities == {"a": (0, 3), "b": (0, 1), "c": (0, 1),
+                          "d": (0, 0), "e": (0, 0)}
+
+
+def test_plan_priorities_follow_critical_path():
+    plan = DependencyPlan({"a": set(), "b": {"a"}, "c": set(),
+                           "d": {"c"}, "e": {"d"}})
+
+    priorities = plan.priorities({"a": 10, "b": 30, "c": 5})
+
+    # d and e have no history so weigh the mean of 15
+    assert priorities["a"] == (40, 1)
+    assert priorities["c"] == (35, 2)
+    assert priorities["e"] == (15, 0)
+
+
+def test_execute_starts_longest_chain_first():
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01)
+                 for k in ["a", "z", "z2"]}
+    dependencies = {"a": set(), "z": set(), "z2": {"z"}}
+    de = DependencyExecutor(resources, dependencies)
+
+    de.execute(checkFrequency=0.01, maxConcurrent=1)
+
+    assert [n for (_, n) in log] == ["z", "a", "z2"]
+
+
+def test_execute_async_ranks_by_history_and_records_it(tmp_path):
+    from job_history import JobHistory
+    history = JobHistory(str(tmp_path / "history.db"))
+    history.record("a", 100)
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01)
+                 for k in ["a", "z", "z2"]}
+    dependencies = {"a": set(), "z": set(), "z2": {"z"}}
+    de = DependencyExecutor(resources, dependencies, history=history)
+
+    de.executeAsync(maxConcurrent=1)
+
+    assert log[0] == ("start", "a")
+    durations = history.durations()
+    assert sorted(durations) == ["a", "z", "z2"]
+    assert durations["a"] < 100
+    assert durations["z"] < 1
+
+
+class SlowProbeResource(FakeResource):
+    """ up to date resource whose status checks take a while """
+    def __init__(self, name, log):
+        FakeResource.__init__(self, name, log)
+        self.created = 1
+
+    def exists(self):
+        import time
+        time.sleep(0.2)
+        return True
+
+
+def test_execute_probes_ready_resources_concurrently():
+    import time
+    log = []
+    resources = {k: SlowProbeResource(k, log) for k in "abcdefgh"}
+    de = DependencyExecutor(resources, {k: set() for k in resources})
+
+    start = time.time()
+    de.execute(checkFrequency=0.01, probeWorkers=8)
+
+    assert log == []
+    assert time.time() - start < 0.2 * len(resources) / 2
+
+
+def test_execute_trusts_local_state(tmp_path):
+    from local_state import LocalState
+    localState = LocalState(str(tmp_path / "state.db"))
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01) for k in "abc"}
+    dependencies = {"a": set(), "b": {"a"}, "c": set()}
+    DependencyExecutor(resources, dependencies,
+                       localState=localState).execute(checkFrequency=0.01)
+    assert sorted(localState.states()) == ["a", "b", "c"]
+    assert localState.get("b").created == resources["b"].created
+
+    # a changed definition invalidates it and everything downstream
+    resources["a"].definition = "v2"
+    for rsrc in resources.values():
+        rsrc.runningChecks = 0
+    de = DependencyExecutor(resources, dependencies, localState=localState,
+                            trustLocalState=True)
+    de.execute(checkFrequency=0.01)
+
+    assert sorted(de.trusted) == ["c"]
+    assert resources["c"].runningChecks == 0
+    assert resources["a"].runningChecks > 0
+    assert localState.get("a").hash == "v2"
+
+
+def test_execute_resets_gcs_listings_every_pass():
+    from unittest.mock import MagicMock
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.05) for k in "ab"}
+    dependencies = {"a": set(), "b": {"a"}}
+    listings = MagicMock()
+    DependencyExecutor(resources, dependencies, gcsListings=listings)\
+        .execute(checkFrequency=0.01)
+    assert listings.reset.call_count > 2
+
+    # without passes executeAsync resets whenever a job finishes
+    listings = MagicMock()
+    for rsrc in resources.values():
+        rsrc.created = None
+    DependencyExecutor(resources, dependencies, gcsListings=listings)\
+        .executeAsync()
+    assert listings.reset.call_count == 2
+
+
+def test_execute_async_trusts_local_state_without_probing(tmp_path):
+    from local_state import LocalState
+    localState = LocalState(str(tmp_path / "state.db"))
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01) for k in "ab"}
+    dependencies = {"a": set(), "b": {"a"}}
+    DependencyExecutor(resources, dependencies,
+                       localState=localState).executeAsync()
+
+    probed = []
+    for rsrc in resources.values():
+        for name in ["exists", "shouldUpdate", "updateTime"]:
+            setattr(rsrc, name,
+                    lambda name=name: probed.append(name))
+    de = DependencyExecutor(resources, dependencies, localState=localState,
+                            trustLocalState=True)
+    de.executeAsync()
+
+    assert sorted(de.trusted) == ["a", "b"]
+    assert probed == []
+    assert len(log) == 2
+
+
+def test_estimate_plans_rebuilds_and_sums_dry_runs(capsys):
+    from google.api_core.exceptions import NotFound
+    log = []
+    resources = {k: FakeResource(k, log, delay=0.01) for k in "abc"}
+    dependencies = {"a": set(), "b": {"a"}, "c": set()}
+    de = DependencyExecutor(resources, dependencies)
+    de.execute(checkFrequency=0.01)
+    del log[:]
+
+    resources["a"].created = None
+    resources["a"].estimateBytes = lambda: 2 ** 40
+    resources["b"].estimateBytes = lambda: (_ for _ in ()).throw(
+        NotFound("a"))
+    writes = []
+    resources["c"].shouldUpdate = \
+        lambda: writes.append(resources["c"].writeMetadata)
+
+    with ThreadPoolExecutor() as probes:
+        assert de.planRebuilds(probes) == {
+            "a": "because it doesn't exist",
+            "b": "because a dependency will be rebuilt"}
+    # probed without writing metadata, which is back on afterwards
+    assert writes == [False]
+    assert all(r.writeMetadata for r in resources.values())
+    assert de.estimate(pricePerTiB=5) == (2 ** 40, ["b"])
+    assert log == []
+    out = capsys.readouterr().out
+    assert "about $5.00" in out
+    assert "could not estimate 1 resources: b" in out
+
+
+def test_parse_max_concurrent():
+    assert parseMaxConcurrent("5") == {"default": 5}
+    assert parseMaxConcurrent("query=20,load=50, 3") == \
+        {"query": 20, "load": 50, "default": 3}
+    with pytest.raises(Exception):
+        parseMaxConcurrent("query=lots")
+
+    pools = {"query", "load"}
+    assert parseMaxConcurrent("query=20,default=5,3", pools) == \
+        {"query": 20, "default": 3}
+    with pytest.raises(Exception, match="qeury"):
+        parseMaxConcurrent("qeury=4", pools)
+
+
+def _pooledResources(log):
+    return {k: FakeResource(k, log, delay=0.05,
+                            pool="query" if k.startswith("q") else "load")
+            for k in ["l1", "l2", "q1", "q2"]}
+
+
+def test_execute_fills_each_pool_on_its_own():
+    log = []
+    resources = _pooledResources(log)
+    de = DependencyExecutor(resources, {k: set() for k in resources})
+
+    de.execute(checkFrequency=0.01, maxConcurrent={"query": 1, "load": 1})
+
+    assert [n for (_, n) in log[:2]] == ["l1", "q1"]
+    assert sorted(n for (_, n) in log[2:]) == ["l2", "q2"]
+
+
+def test_execute_async_fills_each_pool_on_its_own():
+    log = []
+    resources = _pooledResources(log)
+    de = DependencyExecutor(resources, {k: set() for k in resources})
+
+    de.executeAsync(maxConcurrent={"query": 1, "default": 0, "load": 1})
+
+    assert sorted(n for (_, n) in log[:2]) == ["l1", "q1"]
+    assert sorted(n for (_, n) in log[2:]) == ["l2", "q2"]
+
+
+def test_execute_rebuilds_partitions_when_upstream_changed():
+    import datetime
+    from unittest.mock import MagicMock
+    from google.cloud.bigquery import QueryJobConfig
+    from google.cloud.bigquery.table import Table
+    from resource import BqPartitionedTableResource
+    client = MagicMock()
+    rsrc = BqPartitionedTableResource(
+        {"20230101": "select 1", "20230102": "select 2"}, Table("p.d.t"),
+        client, None, QueryJobConfig(), None)
+    written = {"at": 1672531200000}
+    table = Table.from_api_repr({
+        "tableReference": {"projectId": "p", "datasetId": "d",
+                           "tableId": "t"},
+        "creationTime": "1000",
+        "timePartitioning": {"type": "DAY"},
+        "description": "partitionhashes: " + " ".join(
+            [p + "=" + rsrc.partitionHash(p) for p in rsrc.partitions])})
+
+    def getTable(_):
+        table._properties["lastModifiedTime"] = str(written["at"])
+        return table
+
+    def query(sql, **kwargs):
+        written["at"] += 1000
+        job = MagicMock()
+        job.job_id = kwargs["job_id"]
+        job.state = "DONE"
+        job.error_result = job.errors = None
+        job.running.return_value = False
+        job.ended = datetime.datetime.fromtimestamp(
+            written["at"] / 1000, tz=datetime.timezone.utc)
+        return job
+    client.get_table.side_effect = getTable
+    client.update_table.side_effect = lambda t, fields: t
+    client.query.side_effect = query
+
+    upstream = FakeResource("d.u", [])
+    upstream.exists = lambda: True
+    upstream.updateTime = lambda: 1672531200500
+    de = DependencyExecutor({"d.u": upstream, "d.t": rsrc},
+                            {"d.u": set(), "d.t": {"d.u"}})
+    de.execute(checkFrequency=0.01)
+
+    assert sorted(c[0][0] for c in client.query.call_args_list) == \
+        ["select 1", "select 2"]
+
+
+def _writeTemplates(folder):
+    (folder / "a.querytemplate").write_text(
+        "select * from {dataset}.src_{region}_{yyyymmdd}")
+    (folder / "a.querytemplate.vars").write_text(
+        '[{"table": "a_{region}_{yyyymmdd}", '
+        '"region": ["us", "eu"], "yyyymmdd": [-2, 0]}]')
+    (folder / "b.uniontable").write_text(
+        "select * from {dataset}.a_{region}_{yyyymmdd}")
+    (folder / "b.uniontable.vars").write_text(
+        '[{"region": ["us", "eu"], "yyyymmdd": [-2, 0]}]')
+
+
+def _dryrunBuilder(renderWorkers):
+    from loader import DelegatingFileSuffixLoader, \
+        BqQueryTemplatingFileLoader, TableType
+    from bqm2 import DependencyBuilder
+    defaults = {"dataset": "d", "project": "p"}
+    return DependencyBuilder(DelegatingFileSuffixLoader(
+        querytemplate=BqQueryTemplatingFileLoader(
+            None, None, TableType.TABLE, defaults),
+        uniontable=BqQueryTemplatingFileLoader(
+            None, None, TableType.UNION_TABLE, defaults)),
+        renderWorkers=renderWorkers)
+
+
+def test_build_depend_with_render_workers_matches_serial(tmp_path):
+    _writeTemplates(tmp_path)
+
+    (serial, serialDeps) = _dryrunBuilder(1).buildDepend(
+        [str(tmp_path)], dryrun=True)
+    (pooled, pooledDeps) = _dryrunBuilder(2).buildDepend(
+        [str(tmp_path)], dryrun=True)
+
+    assert list(serial.keys()) == list(pooled.keys())
+    assert len(serial) == 8
+    assert serialDeps == pooledDeps
+    assert serial["d.b"].makeFinalQuery() == pooled["d.b"].makeFinalQuery()
+    assert len(pooledDeps["d.b"]) == 7
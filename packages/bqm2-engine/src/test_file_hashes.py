@@ -0,0 +1,57 @@
+import hashlib
+import os
+
+from file_hashes import FileHashes, mmapFileMd5
+
+
+def test_mmap_md5_matches_hashlib(tmp_path):
+    data = os.urandom(3 * 1024 + 17)
+    path = tmp_path / "data"
+    path.write_bytes(data)
+    assert mmapFileMd5(str(path), blocksize=1024) == \
+        hashlib.md5(data).hexdigest()
+
+    empty = tmp_path / "empty"
+    empty.write_bytes(b"")
+    assert mmapFileMd5(str(empty)) == hashlib.md5(b"").hexdigest()
+
+
+def test_rehashes_only_changed_files(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(b"a\tb\n")
+    hashes = FileHashes()
+
+    assert hashes.md5(str(path)) == hashlib.md5(b"a\tb\n").hexdigest()
+    assert hashes.md5(str(path)) == hashlib.md5(b"a\tb\n").hexdigest()
+    assert (hashes.hits, hashes.misses) == (1, 1)
+
+    path.write_bytes(b"a\tb\nc\td\n")
+    assert hashes.md5(str(path)) == \
+        hashlib.md5(b"a\tb\nc\td\n").hexdigest()
+    assert hashes.misses == 2
+
+
+def test_serves_hashes_from_its_store(tmp_path):
+    path = tmp_path / "data"
+    path.write_bytes(b"x")
+    hashes = FileHashes(str(tmp_path / "hashes.db"))
+    hashes.md5(str(path))
+
+    hashes.memo.clear()
+    assert hashes.md5(str(path)) == hashlib.md5(b"x").hexdigest()
+    assert (hashes.hits, hashes.misses) == (1, 1)
+
+
+def test_prefetch_hashes_every_file_once(tmp_path):
+    paths = []
+    for i in range(20):
+        path = tmp_path / ("data%d" % i)
+        path.write_bytes(b"row %d\n" % i)
+        paths.append(str(path))
+    hashes = FileHashes()
+
+    hashes.prefetch(paths + paths, workers=4)
+    assert hashes.misses == 20
+    assert [hashes.md5(p) for p in paths] == \
+        [hashlib.md5(b"row %d\n" % i).hexdigest() for i in range(20)]
+    assert hashes.misses == 20
@@ -0,0 +1,12 @@
+from job_history import JobHistory
+
+
+def test_record_smooths_durations(tmp_path):
+    history = JobHistory(str(tmp_path / "history.db"))
+    assert history.durations() == {}
+
+    history.record("a", 10)
+    history.record("a", 20)
+    history.record("b", 4)
+
+    assert history.durations() == {"a": 15, "b": 4}
@@ -14,7 +14,7 @@ import date_formatter_helper
 from loader import DelegatingFileSuffixLoader, FileLoader, \
     parseDatasetTable, \
     parseDataset, BqQueryTemplatingFileLoader, TableType, loadSchemaFromString
-from resource import BqJobs, BqViewBackedTableResource, \
+from resource import BqViewBackedTableResource, \
     BqQueryBackedTableResource
 
 
@@ -22,24 +22,19 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def test_ToggleToTableForTemplatingLoader(self, bqClient: Client, gcsClient: GcsClient,
-                                                bqJobs: BqJobs):
-        self.toggleToTableOrViewForTemplatingLoader(bqClient, gcsClient, bqJobs,
+    def test_ToggleToTableForTemplatingLoader(self, bqClient: Client, gcsClient: GcsClient):
+        self.toggleToTableOrViewForTemplatingLoader(bqClient, gcsClient,
                                                     TableType.TABLE,
                                                     BqQueryBackedTableResource)
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def test_ToggleToViewForTemplatingLoader(self, bqClient: Client, gcsClient: GcsClient,
-                                                  bqJobs: BqJobs):
-        self.toggleToTableOrViewForTemplatingLoader(bqClient, gcsClient, bqJobs,
+    def test_ToggleToViewForTemplatingLoader(self, bqClient: Client, gcsClient: GcsClient):
+        self.toggleToTableOrViewForTemplatingLoader(bqClient, gcsClient,
                                                     TableType.VIEW,
                                                     BqViewBackedTableResource)
 
     def toggleToTableOrViewForTemplatingLoader(self, bqClient: Client, gcsClient: GcsClient,
-                                                    bqJobs: BqJobs,
                                                     tableType: TableType,
                                                     theType):
 
@@ -48,7 +43,7 @@ class Test(unittest.TestCase):
             'adataset'
         bqClient.dataset('adataset').table('atable').project = 'aproject'
 
-        ldr = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        ldr = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                           tableType,
                                           {"dataset": "dataset"})
         self.assertEqual(ldr.tableType, tableType)
@@ -63,16 +58,14 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def test_IdenticalButDuplicateDefinitionsAllowed(self, bqClient: Client, gcsClient: GcsClient,
-                                                     bqJobs: BqJobs):
+    def test_IdenticalButDuplicateDefinitionsAllowed(self, bqClient: Client, gcsClient: GcsClient):
 
         bqClient.dataset('adataset').table('atable').table_id = 'atable'
         bqClient.dataset('adataset').table('atable').dataset_id = \
             'adataset'
         bqClient.dataset('adataset').table('atable').project = 'aproject'
 
-        ldr = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        ldr = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                           TableType.VIEW,
                                           {"dataset": "dataset"})
         out = {}
@@ -84,9 +77,7 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def test_NotIdenticalButDuplicateKeysAreNotAllowed(self, bqClient: Client, gcsClient: GcsClient,
-                                                     bqJobs: BqJobs):
+    def test_NotIdenticalButDuplicateKeysAreNotAllowed(self, bqClient: Client, gcsClient: GcsClient):
 
         bqClient.dataset('adataset').table('atable').table_id = \
             'atable'
@@ -94,7 +85,7 @@ class Test(unittest.TestCase):
             'adataset'
         bqClient.dataset('adataset').table('atable').project = 'aproject'
 
-        ldr = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        ldr = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                           TableType.VIEW,
                                           {"dataset": "dataset"})
         out = {}
@@ -270,13 +261,12 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def testProcessTemplateVarUnionView(self, bqClient, bqJobs, gcsClient):
+    def testProcessTemplateVarUnionView(self, bqClient, gcsClient):
         bqClient.dataset('adataset').table('atable').table_id = 'atable'
         bqClient.dataset('adataset').table('atable').dataset_id = \
             'adataset'
         bqClient.dataset('adataset').table('atable').project = 'aproject'
-        unionViewLoader = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs, TableType.UNION_VIEW,
+        unionViewLoader = BqQueryTemplatingFileLoader(bqClient, gcsClient, TableType.UNION_VIEW,
                                             {'dataset': 'default', 'project': 'aproject'})
         templateVar1 = {
             'table': 'atable',
@@ -298,10 +288,33 @@ class Test(unittest.TestCase):
         arsrc = output["adataset:atable"]
         self.assertEqual(arsrc.makeFinalQuery(), """select * from bar1\nunion all\nselect * from bar2""")
 
+    def testProcessTemplateVarPartitionTable(self):
+        loader = BqQueryTemplatingFileLoader(None, None,
+                                             TableType.PARTITION_TABLE,
+                                             {'dataset': 'default',
+                                              'project': 'aproject'})
+        output = {}
+        for yyyymmdd in ["20230102", "20230101"]:
+            loader.processTemplateVar({'table': 'atable',
+                                       'dataset': 'adataset',
+                                       'yyyymmdd': yyyymmdd},
+                                      "select * from src_{yyyymmdd}",
+                                      "filepath", 0, output, dryrun=True)
+
+        arsrc = output["adataset:atable"]
+        self.assertEqual({"20230101": "select * from src_20230101",
+                          "20230102": "select * from src_20230102"},
+                         arsrc.partitions)
+
+        with self.assertRaises(Exception):
+            loader.processTemplateVar({'table': 'other',
+                                       'dataset': 'adataset'},
+                                      "select 1", "filepath", 0, output,
+                                      dryrun=True)
+
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def testProcessTemplateVarHappyPath(self, bqClient, bqJobs, gcsClient):
+    def testProcessTemplateVarHappyPath(self, bqClient, gcsClient):
 
         bqClient.dataset('adataset').table('atable').table_id = \
             'atable'
@@ -309,7 +322,7 @@ class Test(unittest.TestCase):
             'adataset'
         bqClient.dataset('adataset').table('atable').project = 'aproject'
 
-        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                              TableType.TABLE,
                                              {'dataset': 'default',
                                               'project': 'aproject'})
@@ -329,13 +342,12 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def testProcessTemplateVarMissingDataset(self, bqClient, bqJobs,
+    def testProcessTemplateVarMissingDataset(self, bqClient,
                                              gcsClient):
 
         # templateVars: dict, template: str,
         # filePath: str, mtime: int, out: dict
-        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                              TableType.TABLE,{})
         templateVar = {
             'table': 'atable',
@@ -350,14 +362,13 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def testProcessTemplateVarMissingTable(self, bqClient, bqJobs,
+    def testProcessTemplateVarMissingTable(self, bqClient,
                                            gcsClient):
 
         # templateVars: dict, template: str,
         # filePath: str, mtime: int, out: dict
 
-        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                              TableType.TABLE, 'default')
         templateVar = {
             'dataset': 'adataset',
@@ -409,8 +420,7 @@ class Test(unittest.TestCase):
 
     @mock.patch('google.cloud.bigquery.Client')
     @mock.patch('google.cloud.storage.Client')
-    @mock.patch('resource.BqJobs')
-    def testEmptyTableVar(self, bqClient, bqJobs, gcsClient):
+    def testEmptyTableVar(self, bqClient, gcsClient):
 
         bqClient.dataset('adataset').table('atable').table_id = \
             'atable'
@@ -418,7 +428,7 @@ class Test(unittest.TestCase):
             'adataset'
         bqClient.dataset('adataset').table('atable').project = 'aproject'
 
-        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient, bqJobs,
+        loader = BqQueryTemplatingFileLoader(bqClient, gcsClient,
                                              TableType.TABLE,
                                              {'dataset': 'default',
                                               'project': 'aproject'})
@@ -0,0 +1,19 @@
+from local_state import LocalState, ResourceState
+
+
+def test_record_and_get(tmp_path):
+    state = LocalState(str(tmp_path / "state.db"))
+    assert state.get("d:t") is None
+
+    state.record("d:t", "queryhash:1", 1000, "create-d-t-1")
+    state.record("d:u", "queryhash:2", 2000)
+    state.record("d:t", "queryhash:3", 3000, "create-d-t-2")
+
+    assert state.get("d:t") == ResourceState("queryhash:3", 3000,
+                                             "create-d-t-2")
+    assert state.states() == {
+        "d:t": ResourceState("queryhash:3", 3000, "create-d-t-2"),
+        "d:u": ResourceState("queryhash:2", 2000, None)}
+
+    state.forget("d:u")
+    assert sorted(state.states()) == ["d:t"]
@@ -1,3 +1,4 @@
+import io
 import json
 import logging
 import sys
@@ -68,6 +69,93 @@ class Test(unittest.TestCase):
         self.assertEqual(output_dict_string, '{"entries": [{"mandatory": true, "meta": 1, "url": "s3//bucket/manifest"}]}')
 
 
+class FakeBlob:
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+
+class FakeBucket:
+    """ list_blobs over sorted names, honouring prefix, delimiter,
+    offsets and max_results like gcs does """
+
+    def __init__(self, names):
+        self.blobs = [FakeBlob(name, len(name)) for name in sorted(names)]
+        self.listings = []
+
+    def list_blobs(self, prefix=None, delimiter=None, start_offset=None,
+                   end_offset=None, max_results=None):
+        self.listings.append((prefix, start_offset, end_offset))
+        out = []
+        for blob in self.blobs:
+            if not blob.name.startswith(prefix) or \
+                    (start_offset is not None and blob.name < start_offset) or \
+                    (end_offset is not None and blob.name >= end_offset):
+                continue
+            if delimiter and delimiter in blob.name[len(prefix):]:
+                continue
+            out.append(blob)
+        return out[:max_results] if max_results else out
+
+
+def _stream(mocker, bucket, capsysbinary, dry_run=True):
+    client = mocker.patch("manifest_generator.storage.Client").return_value
+    client.get_bucket.return_value = bucket
+    stream_manifest("gs://bucket/data/", ".csv", "s3://target/",
+                    "gs://bucket/manifest", dry_run, workers=4)
+    return (client, capsysbinary.readouterr().out)
+
+
+def _generate(mocker, fake, capsysbinary):
+    mocker.patch("manifest_generator.list_blobs",
+                 side_effect=lambda bucket=None, prefix=None: fake.list_blobs(
+                     prefix=prefix, delimiter="/"))
+    generate_manifest("gs://bucket/data/", ".csv", "s3://target/",
+                      "gs://bucket/manifest", True)
+    return capsysbinary.readouterr().out
+
+
+SHARDS = ["data/t-%012d.csv" % i for i in range(2500)] + \
+    ["data/t-000000000007.json", "data/a.csv", "data/sub/x.csv", "data/z"]
+
+
+def test_split_ranges_on_first_difference():
+    bucket = FakeBucket(["data/t-%012d.csv" % i for i in range(2500)])
+    assert split_ranges(bucket, "data/") == [
+        (None, "data/t-000000001"),
+        ("data/t-000000001", "data/t-000000002"),
+        ("data/t-000000002", None)]
+    assert split_ranges(FakeBucket([]), "data/") == [(None, None)]
+
+
+def test_stream_is_byte_identical(mocker, capsysbinary):
+    bucket = FakeBucket(SHARDS)
+    expected = _generate(mocker, bucket, capsysbinary)
+    (_, out) = _stream(mocker, bucket, capsysbinary)
+    assert out == expected
+    assert len(json.loads(out)["entries"]) == 2501
+
+
+def test_stream_uploads_what_it_prints(mocker, capsysbinary):
+    bucket = FakeBucket(SHARDS)
+    mocker.patch.object(bucket, "blob", create=True)
+    uploaded = io.BytesIO()
+    uploaded.close = lambda: None
+    bucket.blob.return_value.open.return_value = uploaded
+    (client, out) = _stream(mocker, bucket, capsysbinary, dry_run=False)
+    bucket.blob.assert_called_once_with("manifest")
+    assert uploaded.getvalue() + b"\n" == out
+
+
+def test_stream_without_matches_uploads_nothing(mocker, capsysbinary):
+    bucket = FakeBucket(["data/a.json", "data/b.json"])
+    mocker.patch.object(bucket, "blob", create=True)
+    with pytest.raises(Exception):
+        _stream(mocker, bucket, capsysbinary, dry_run=False)
+    bucket.blob.assert_not_called()
+    assert capsysbinary.readouterr().out == b""
+
+
 #if __name__ == '__main__':
 #    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 #    unittest.main()
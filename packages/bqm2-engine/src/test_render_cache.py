@@ -0,0 +1,100 @@
+import time
+from datetime import datetime
+from unittest import mock
+
+import loader
+from loader import BqQueryTemplatingFileLoader, TableType
+from render_cache import RenderCache, renderCacheKey
+
+
+def _writeTemplate(folder):
+    (folder / "a.querytemplate").write_text("select {n}")
+    (folder / "a.querytemplate.vars").write_text('[{"n": ["1", "2"]}]')
+    return str(folder / "a.querytemplate")
+
+
+def test_put_get(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache.db"))
+    assert cache.get("k") is None
+    cache.put("k", [({"a": "b"}, "select 1")])
+    assert cache.contains("k")
+    assert cache.get("k") == [[{"a": "b"}, "select 1"]]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_skips_output_json_cannot_hold(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache.db"))
+    cache.put("k", [({"day": datetime(2024, 1, 1)}, "select 1")])
+    assert not cache.contains("k")
+
+
+def test_evicts_least_recently_used(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = RenderCache(path)
+    for key in ["a", "b", "c"]:
+        cache.put(key, key)
+        time.sleep(0.01)
+    cache.get("a")
+    cache.close()
+
+    cache = RenderCache(path, maxEntries=2)
+    assert cache.contains("a")
+    assert not cache.contains("b")
+    assert cache.contains("c")
+
+
+def test_evicts_by_age(tmp_path):
+    cache = RenderCache(str(tmp_path / "cache.db"))
+    cache.put("old", 1)
+    cache.db.write("UPDATE renders SET used = 0")
+    cache.evict()
+    assert not cache.contains("old")
+
+
+def test_key_covers_inputs(tmp_path):
+    filePath = _writeTemplate(tmp_path)
+    start = datetime(2024, 1, 1)
+    key = renderCacheKey(filePath, {"dataset": "d"}, start)
+
+    assert key == renderCacheKey(filePath, {"dataset": "d"}, start)
+    assert key != renderCacheKey(filePath, {"dataset": "e"}, start)
+    assert key != renderCacheKey(filePath, {"dataset": "d"},
+                                 datetime(2024, 1, 2))
+
+    (tmp_path / "local.vars").write_text('{"x": "y"}')
+    assert key != renderCacheKey(filePath, {"dataset": "d"}, start)
+
+
+def test_loader_skips_rendering_on_hit(tmp_path):
+    filePath = _writeTemplate(tmp_path)
+    cache = RenderCache(str(tmp_path / "cache.db"))
+
+    def load():
+        ldr = BqQueryTemplatingFileLoader(None, None, TableType.UNION_VIEW,
+                                          {"dataset": "d", "project": "p"},
+                                          renderCache=cache)
+        return ldr, list(ldr.load(filePath, dryrun=True))
+
+    (first, rsrcs) = load()
+    assert first.renderer(filePath) is None
+
+    with mock.patch.object(loader, "renderTemplateFile") as render:
+        (second, cached) = load()
+        render.assert_not_called()
+
+    assert [r.key() for r in rsrcs] == [r.key() for r in cached]
+    assert rsrcs[0].makeFinalQuery() == cached[0].makeFinalQuery()
+    assert cache.hits == 1
+
+
+def test_loader_renders_lazily_without_cache(tmp_path):
+    filePath = _writeTemplate(tmp_path)
+    ldr = BqQueryTemplatingFileLoader(None, None, TableType.UNION_VIEW,
+                                      {"dataset": "d", "project": "p"})
+
+    with mock.patch.object(loader, "renderQuery",
+                           wraps=loader.renderQuery) as render:
+        rendered = ldr.render(filePath)
+        render.assert_not_called()
+        assert [q for (_, q) in rendered] == ["select 1", "select 2"]
+        assert render.call_count == 2
@@ -1,13 +1,18 @@
 import datetime
+import gzip
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 
 import google.cloud.bigquery.dataset
 import mock
+from google.cloud.bigquery import ExternalConfig, SchemaField
 from google.cloud.bigquery.client import Client
 from google.cloud.bigquery.dataset import Dataset
 from google.cloud.bigquery.job import SourceFormat
 from google.cloud.bigquery.job import QueryJob
-from google.cloud.bigquery.table import Table
+from google.cloud.bigquery.table import Table, TableReference
 from google.cloud.exceptions import NotFound
 
 import resource
@@ -15,7 +20,8 @@ import pytest
 
 from resource import strictSubstring, \
     BqDatasetBackedResource, BqViewBackedTableResource, \
-    BqQueryBasedResource, BqDataLoadTableResource
+    BqQueryBasedResource, BqDataLoadTableResource, \
+    BqExternalTableBasedResource
 
 import pytest
 
@@ -362,3 +368,680 @@ def test_build_jobid_prefix_key_from_jobid():
 
     assert actual == expected
 
+
+
+def _snapshotClient(mocker, rows):
+    client = mocker.MagicMock()
+    client.query.return_value.result.return_value = rows
+    client.get_table.side_effect = NotFound("not found")
+    return client
+
+
+def testBqTablesServesMetadataFromOneQueryPerDataset(mocker):
+    client = _snapshotClient(mocker, [
+        {"table_name": "a", "creation_time": 123456789000,
+         "description": '"Do not edit\\nqueryhash:abc"'},
+        {"table_name": "b", "creation_time": 223456789000,
+         "description": None},
+    ])
+    tables = resource.BqTables(client)
+
+    a = tables.get_table(Table("p.d.a"))
+    assert a.created == datetime.datetime.fromtimestamp(
+        123456789, tz=datetime.timezone.utc)
+    assert a.description == "Do not edit\nqueryhash:abc"
+    assert tables.exists(Table("p.d.b"))
+    assert not tables.exists(Table("p.d.c"))
+
+    assert client.query.call_count == 1
+    assert "`p.d`.INFORMATION_SCHEMA.TABLES" in client.query.call_args[0][0]
+    client.get_table.assert_not_called()
+
+
+def testBqTablesInvalidatedTablesAreFetchedDirectly(mocker):
+    client = _snapshotClient(mocker, [
+        {"table_name": "a", "creation_time": 1000, "description": None}])
+    tables = resource.BqTables(client)
+    assert tables.exists(Table("p.d.a"))
+
+    tables.invalidate(Table("p.d.a"))
+
+    assert not tables.exists(Table("p.d.a"))
+    assert client.get_table.call_count == 1
+    assert client.query.call_count == 1
+
+
+def testBqTablesMissingDataset(mocker):
+    client = mocker.MagicMock()
+    client.query.side_effect = NotFound("no dataset")
+    tables = resource.BqTables(client)
+
+    assert not tables.exists(Table("p.d.a"))
+    assert not tables.exists(Table("p.d.b"))
+    assert client.query.call_count == 1
+
+
+def testQueryResourceUsesSnapshot(mocker):
+    client = _snapshotClient(mocker, [
+        {"table_name": "a", "creation_time": 1000,
+         "description": None}])
+    tables = resource.BqTables(client)
+    rsrc = BqQueryBasedResource(["select 1"], Table("p.d.a"), client,
+                                bqTables=tables)
+    client.update_table.side_effect = lambda table, fields: table
+
+    assert rsrc.exists()
+    assert not rsrc.shouldUpdate()
+    assert rsrc.updateTime() is not None
+
+    # description was written once and recorded in the snapshot
+    assert client.update_table.call_count == 1
+    client.get_table.assert_not_called()
+
+
+def testQueryResourceWritesNoMetadataWhenAskedNotTo(mocker):
+    client = _snapshotClient(mocker, [
+        {"table_name": "a", "creation_time": 1000,
+         "description": None}])
+    rsrc = BqQueryBasedResource(["select 1"], Table("p.d.a"), client,
+                                bqTables=resource.BqTables(client))
+    rsrc.writeMetadata = False
+
+    assert rsrc.exists()
+    assert not rsrc.shouldUpdate()
+    assert rsrc.updateTime() is not None
+    client.update_table.assert_not_called()
+
+
+def testSnapshotDoesNotReplaceConfiguredTable(mocker):
+    client = _snapshotClient(mocker, [
+        {"table_name": "a", "creation_time": 1000,
+         "description": "\"Do not edit\""}])
+    tables = resource.BqTables(client)
+    config = ExternalConfig("CSV")
+    config.source_uris = ["gs://bucket/a.csv"]
+    table = Table("p.d.a", schema=[SchemaField("x", "STRING")])
+    rsrc = BqExternalTableBasedResource(client, table, config,
+                                        bqTables=tables)
+    client.create_table.side_effect = lambda table: table
+
+    assert rsrc.updateTime() is not None
+    rsrc.create()
+
+    created = client.create_table.call_args[0][0]
+    assert created.external_data_configuration is not None
+    assert [f.name for f in created.schema] == ["x"]
+
+
+def testBqTablesLoadsDatasetsOutsideTheLock(mocker):
+    client = mocker.MagicMock()
+    started = threading.Event()
+    release = threading.Event()
+
+    def query(sql):
+        if "`p.slow`" in sql:
+            started.set()
+            release.wait(5)
+        job = mocker.MagicMock()
+        job.result.return_value = [
+            {"table_name": "a", "creation_time": 1000, "description": None}]
+        return job
+    client.query.side_effect = query
+    tables = resource.BqTables(client)
+
+    with ThreadPoolExecutor(3) as pool:
+        slow = pool.submit(tables.exists, Table("p.slow.a"))
+        assert started.wait(5)
+        # another dataset is answered while the first is still loading
+        assert pool.submit(tables.exists, Table("p.fast.a")).result(1)
+        waiting = pool.submit(tables.exists, Table("p.slow.a"))
+        release.set()
+        assert slow.result() and waiting.result()
+
+    assert client.query.call_count == 2
+
+
+def _trackedJob(mocker, job_id, state="RUNNING"):
+    job = mocker.MagicMock()
+    job.job_id = job_id
+    job.project = "p"
+    job.created = datetime.datetime(2023, 1, 1)
+    job.state = state
+    job.errors = None
+    job.error_result = None
+    job.running = lambda: job.state == "RUNNING"
+    return job
+
+
+def testJobTrackerReloadsOnlyJobsMissingFromTheSweep(mocker):
+    client = mocker.MagicMock()
+    running = _trackedJob(mocker, "create-d-running")
+    finished = _trackedJob(mocker, "create-d-finished")
+    client.list_jobs.return_value = [running]
+    tracker = resource.JobTracker(client, maxStaleness=60)
+
+    # first sight of a job reloads it
+    assert resource.isJobRunning(running, tracker)
+    assert resource.isJobRunning(finished, tracker)
+    assert tracker.reloads == 2
+
+    def finish():
+        finished.state = "DONE"
+    finished.reload.side_effect = finish
+
+    for _ in range(3):
+        assert resource.isJobRunning(running, tracker)
+        assert not resource.isJobRunning(finished, tracker)
+
+    assert tracker.sweeps == 1
+    client.list_jobs.assert_called_once_with(
+        project="p", state_filter="running",
+        min_creation_time=datetime.datetime(2023, 1, 1))
+    assert running.reload.call_count == 1
+    assert finished.reload.call_count == 2
+    assert tracker.reloads == 3
+
+
+def testJobTrackerFallsBackToReloadWhenListingFails(mocker):
+    from google.api_core.exceptions import Forbidden
+    client = mocker.MagicMock()
+    client.list_jobs.side_effect = Forbidden("no")
+    job = _trackedJob(mocker, "create-d-t")
+    tracker = resource.JobTracker(client, maxStaleness=0)
+
+    assert resource.isJobRunning(job, tracker)
+    assert resource.isJobRunning(job, tracker)
+    assert job.reload.call_count == 2
+
+
+def testJobTrackerListsJobsOutsideTheLock(mocker):
+    client = mocker.MagicMock()
+    listing = threading.Event()
+    release = threading.Event()
+
+    def list_jobs(**kwargs):
+        listing.set()
+        release.wait(5)
+        return []
+    client.list_jobs.side_effect = list_jobs
+    tracker = resource.JobTracker(client, maxStaleness=60)
+    seen = _trackedJob(mocker, "create-d-seen")
+    assert tracker.isRunning(seen)
+
+    with ThreadPoolExecutor(2) as pool:
+        sweeping = pool.submit(tracker.isRunning, seen)
+        assert listing.wait(5)
+        # a new job is answered while the sweep is still listing
+        assert pool.submit(tracker.isRunning,
+                           _trackedJob(mocker, "create-d-new")).result(1)
+        release.set()
+        assert sweeping.result()
+
+    assert tracker.sweeps == 1
+
+
+def _listedJob(mocker, job_id):
+    job = mocker.MagicMock()
+    job.job_id = job_id
+    return job
+
+
+def testLoadTableJobsKeepsOnlyWantedPrefixes(mocker):
+    uuid = "-a-b-c-d-e"
+    running = [[_listedJob(mocker, "create-d-t1" + uuid),
+                _listedJob(mocker, "create-d-other" + uuid)],
+               [_listedJob(mocker, "create-d-t1-x-b-c-d-e"),
+                _listedJob(mocker, "adhoc")]]
+    pending = [[_listedJob(mocker, "create-d-t1-p-b-c-d-e"),
+                _listedJob(mocker, "extract-d-t1" + uuid)]]
+
+    def list_jobs(page_size, state_filter, min_creation_time):
+        assert min_creation_time is not None
+        listed = mocker.MagicMock()
+        listed.pages = running if state_filter == "running" else pending
+        return listed
+
+    client = mocker.MagicMock()
+    client.list_jobs.side_effect = list_jobs
+    bqJobs = resource.BqJobs(client)
+
+    bqJobs.loadTableJobs({"create-d-t1", "extract-d-t1"})
+
+    assert sorted(bqJobs.tableToJobMap) == ["create-d-t1", "extract-d-t1"]
+    # the first running job wins over later and pending ones
+    assert bqJobs.getJob("create-d-t1") is running[0][0]
+    assert (bqJobs.pagesScanned, bqJobs.jobsScanned) == (3, 6)
+    assert resource.BqJobs(client).tableToJobMap == {}
+
+
+def testLoadTableJobsStopsAtPageLimit(mocker):
+    def list_jobs(page_size, state_filter, min_creation_time):
+        listed = mocker.MagicMock()
+        listed.pages = [[_listedJob(mocker, "create-d-%s%d-a-b-c-d-e" %
+                                    (state_filter, i))] for i in range(5)]
+        return listed
+
+    client = mocker.MagicMock()
+    client.list_jobs.side_effect = list_jobs
+    bqJobs = resource.BqJobs(client, page_limit=2)
+
+    bqJobs.loadTableJobs()
+
+    assert bqJobs.pagesScanned == 4
+    assert sorted(bqJobs.tableToJobMap) == \
+        ["create-d-pending0", "create-d-pending1",
+         "create-d-running0", "create-d-running1"]
+
+
+def testQueryBasedResourceCachesFinalQueryUntilAddQuery():
+    table = Table("p.d.t")
+    rsrc = BqQueryBasedResource(["select 1"], table, None)
+    tag = rsrc.makeQueryHashTag()
+    rsrc.dependencyCandidates(resource.ResourceKeyIndex([]))
+    assert rsrc.makeFinalQuery() is rsrc.makeFinalQuery()
+
+    rsrc.addQuery("select 1")
+    assert rsrc.makeQueryHashTag() == tag
+
+    rsrc.addQuery("select 2 from d.u")
+    assert rsrc.queries == ["select 1", "select 2 from d.u"]
+    assert rsrc.makeFinalQuery() == "select 1\nunion all\nselect 2 from d.u"
+    assert rsrc.makeQueryHashTag() != tag
+    other = BqQueryBasedResource(["select 1"], Table("p.d.u"), None)
+    assert rsrc.dependsOn(other)
+
+
+def _partitionedResource(mocker, description):
+    client = mocker.MagicMock()
+    table = Table("p.d.t")
+    table.description = description
+    client.get_table.return_value = table
+    rsrc = resource.BqPartitionedTableResource(
+        {"20230101": "select 1", "20230102": "select 2"}, Table("p.d.t"),
+        client, None, google.cloud.bigquery.QueryJobConfig(), None)
+    return (client, table, rsrc)
+
+
+def testPartitionedTableRecomputesOnlyStalePartitions(mocker):
+    (client, table, rsrc) = _partitionedResource(mocker, None)
+    fresh = "partitionhashes: 20230101=" + rsrc.partitionHash("20230101") \
+        + " 20221231=0123"
+    table.description = fresh
+    from google.cloud.bigquery.table import TimePartitioning
+    table.time_partitioning = TimePartitioning()
+
+    assert rsrc.shouldUpdate()
+    assert rsrc.stalePartitions() == ["20230102"]
+
+    rsrc.create()
+    client.create_table.assert_not_called()
+    assert client.query.call_count == 1
+    (query,), kwargs = client.query.call_args
+    assert query == "select 2"
+    config = kwargs["job_config"]
+    assert config.destination.table_id == "t$20230102"
+    assert config.write_disposition == "WRITE_TRUNCATE"
+    assert kwargs["job_id"].startswith("create-d-t-")
+
+
+def testPartitionedTableRecordsHashesOfFinishedJobs(mocker):
+    (client, table, rsrc) = _partitionedResource(mocker, None)
+    client.update_table.side_effect = lambda t, fields: t
+    client.get_table.side_effect = NotFound("no table")
+    client.query.side_effect = lambda *args, **kwargs: mocker.MagicMock()
+    rsrc.create()
+    client.create_table.assert_called_once()
+    assert client.query.call_count == 2
+    client.get_table.side_effect = None
+
+    jobs = rsrc.jobs
+    jobs["20230101"].state = "DONE"
+    jobs["20230101"].error_result = None
+    jobs["20230101"].ended = datetime.datetime(
+        2023, 1, 1, tzinfo=datetime.timezone.utc)
+    jobs["20230102"].state = "DONE"
+    jobs["20230102"].error_result = {"reason": "failed"}
+
+    assert rsrc.shouldUpdate()
+    assert rsrc.recordedHashes() == \
+        {"20230101": rsrc.partitionHash("20230101")}
+    assert rsrc.jobs == {}
+    assert rsrc.stalePartitions() == ["20230102"]
+
+    # metadata updates move the table's modified time but not ours
+    table._properties["lastModifiedTime"] = "1700000000000"
+    assert rsrc.updateTime() == 1672531200000
+    client.get_table.assert_called_with(rsrc.table)
+
+
+def testPartitionedTableLeavesAdoptedPartitionJobRunning(mocker):
+    (client, table, rsrc) = _partitionedResource(mocker, None)
+    client.get_table.side_effect = NotFound("no table")
+    client.query.side_effect = lambda *args, **kwargs: _trackedJob(
+        mocker, kwargs["job_id"])
+    adopted = _trackedJob(mocker, "create-d-t-adopted")
+    adopted.destination = TableReference.from_string("p.d.t$20230101")
+    adopted.query = "select 1"
+    rsrc.adoptJob(adopted)
+    assert rsrc.jobs == {"20230101": adopted}
+
+    rsrc.create()
+
+    assert [c[0][0] for c in client.query.call_args_list] == ["select 2"]
+
+
+def testPartitionedTableThroughSnapshot(mocker):
+    client = _snapshotClient(mocker, [])
+    rsrc = resource.BqPartitionedTableResource(
+        {"20230101": "select 1", "20230102": "select 2"}, Table("p.d.t"),
+        client, None, google.cloud.bigquery.QueryJobConfig(), None,
+        bqTables=resource.BqTables(client))
+    description = "partitionhashes: 20230101=" + \
+        rsrc.partitionHash("20230101")
+    client.query.return_value.result.return_value = [
+        {"table_name": "t", "creation_time": 1000,
+         "description": '"' + description + '"'}]
+    client.get_table.side_effect = None
+    client.get_table.return_value = Table.from_api_repr({
+        "tableReference": {"projectId": "p", "datasetId": "d",
+                           "tableId": "t"},
+        "creationTime": "1000",
+        "description": description,
+        "lastModifiedTime": "1672531200000",
+        "timePartitioning": {"type": "DAY"}})
+
+    assert rsrc.exists()
+    assert rsrc.updateTime() == 1672531200000
+    assert rsrc.shouldUpdate()
+
+    client.query.reset_mock()
+    rsrc.create()
+    client.delete_table.assert_not_called()
+    client.create_table.assert_not_called()
+    assert client.query.call_count == 1
+    assert client.query.call_args[0][0] == "select 2"
+
+
+def testPartitionedTableKeepsFewPartitionJobsRunning(mocker):
+    client = mocker.MagicMock()
+    client.get_table.side_effect = NotFound("no table")
+    jobs = []
+
+    def query(*args, **kwargs):
+        jobs.append(_trackedJob(mocker, "create-d-t-" + str(len(jobs))))
+        return jobs[-1]
+    client.query.side_effect = query
+    rsrc = resource.BqPartitionedTableResource(
+        {"20230101": "select 1", "20230102": "select 2",
+         "20230103": "select 3"}, Table("p.d.t"),
+        client, None, google.cloud.bigquery.QueryJobConfig(), None,
+        maxConcurrentPartitions=2)
+
+    rsrc.create()
+    assert len(jobs) == 2
+    assert rsrc.isRunning()
+    assert len(jobs) == 2
+
+    jobs[0].state = "DONE"
+    assert rsrc.isRunning()
+    assert len(jobs) == 3
+    assert sorted(rsrc.jobs) == ["20230101", "20230102", "20230103"]
+
+    for job in jobs:
+        job.state = "DONE"
+    assert not rsrc.isRunning()
+
+
+def testJobGroupWaitsForEveryJob(mocker):
+    jobs = [_trackedJob(mocker, "create-d-t-" + str(i)) for i in range(3)]
+    jobs[0].result.side_effect = NotFound("failed")
+
+    with pytest.raises(NotFound):
+        resource.JobGroup(jobs).result(timeout=None)
+
+    for job in jobs:
+        job.result.assert_called_once_with(timeout=None)
+
+
+def testPartitionedTableRejectsMixedGranularity():
+    with pytest.raises(Exception):
+        resource.BqPartitionedTableResource(
+            {"20230101": "select 1", "2023010100": "select 2"},
+            Table("p.d.t"), None, None, None, None)
+
+
+def testQueryBackedTableEstimatesWithDryRun(mocker):
+    client = mocker.MagicMock()
+    client.query.return_value.total_bytes_processed = 1234
+    config = google.cloud.bigquery.QueryJobConfig()
+    config.use_legacy_sql = False
+    config.default_dataset = "p.d"
+    config.query_parameters = [
+        google.cloud.bigquery.ScalarQueryParameter("day", "STRING", "1")]
+    config.destination = "p.d.t"
+    rsrc = resource.BqQueryBackedTableResource(
+        ["select 1"], Table("p.d.t"), client, None, config, None, "EU")
+
+    assert rsrc.estimateBytes() == 1234
+    (query,), kwargs = client.query.call_args
+    assert query == "select 1"
+    assert kwargs["job_config"].dry_run
+    assert not kwargs["job_config"].use_query_cache
+    assert kwargs["job_config"].default_dataset.dataset_id == "d"
+    assert kwargs["job_config"].query_parameters[0].name == "day"
+    assert kwargs["job_config"].destination is None
+    assert kwargs["location"] == "EU"
+
+
+def _processResource(mocker, script, table="p.d.proc"):
+    client = mocker.MagicMock()
+    client.get_table.side_effect = NotFound("no table")
+    loaded = {}
+
+    def load(spool, table, job_config, job_id):
+        loaded["data"] = gzip.decompress(spool.read())
+        loaded["config"] = job_config
+        job = mocker.MagicMock()
+        job.job_id = job_id
+        job.result.return_value = "loaded"
+        return job
+
+    client.load_table_from_file.side_effect = load
+    rsrc = resource.BqProcessTableResource(
+        "#!/bin/sh\n" + script, Table(table), None, client, None)
+    return (client, rsrc, loaded)
+
+
+def testProcessTableRunsScriptInTheBackground(mocker):
+    (client, rsrc, loaded) = _processResource(
+        mocker, "sleep 0.3\nprintf 'a\\t1\\nb\\t2\\n'\n")
+    rsrc.create()
+    assert rsrc.isRunning()
+    assert rsrc.trackedJob() is rsrc.pipeline
+
+    assert rsrc.trackedJob().result(timeout=None) == "loaded"
+    assert loaded["data"] == b"a\t1\nb\t2\n"
+    assert loaded["config"].source_format == SourceFormat.CSV
+    assert loaded["config"].field_delimiter == "\t"
+    rsrc.pipeline.loadJob.result.assert_called_once_with(timeout=None)
+    (_, kwargs) = client.load_table_from_file.call_args
+    assert kwargs["job_id"].startswith("create-d-proc-")
+
+    loadJob = rsrc.pipeline.loadJob
+    loadJob.running.return_value = False
+    loadJob.error_result = None
+    loadJob.errors = None
+    assert not rsrc.isRunning()
+    assert rsrc.trackedJob() is loadJob
+
+
+def testProcessTableDetectsJsonOutput(mocker):
+    (client, rsrc, loaded) = _processResource(
+        mocker, "echo '{\"a\": 1}'\n")
+    rsrc.create()
+    rsrc.pipeline.wait()
+    assert loaded["config"].source_format == \
+        SourceFormat.NEWLINE_DELIMITED_JSON
+    assert loaded["config"].field_delimiter is None
+
+
+def testProcessTableFailedScriptIsNotLoaded(mocker):
+    (client, rsrc, loaded) = _processResource(mocker, "exit 3\n")
+    rsrc.create()
+    pipeline = rsrc.pipeline
+    pipeline.wait()
+    assert pipeline.returncode == 3
+    client.load_table_from_file.assert_not_called()
+    assert pipeline.result() is None
+    assert not rsrc.isRunning()
+    assert rsrc.trackedJob() is None
+
+
+def testProcessTablesRunConcurrently(mocker):
+    resources = [_processResource(mocker, "sleep 0.5\necho x\n",
+                                  "p.d.proc%d" % i)[1] for i in range(4)]
+    started = time.time()
+    for rsrc in resources:
+        rsrc.create()
+    for rsrc in resources:
+        rsrc.pipeline.wait()
+    assert time.time() - started < 1.5
+
+
+def testDataLoadHashTagReadsEachFileOnce(mocker, tmp_path):
+    data = tmp_path / "t.localdata"
+    data.write_bytes(b"a\tb\n")
+    (tmp_path / "t.localdata.schema").write_text("a:string,b:string")
+    rsrc = BqDataLoadTableResource(str(data), Table("p.d.t"), None,
+                                   mocker.MagicMock(), None)
+    hashTag = rsrc.makeHashTag()
+    assert hashTag == rsrc.makeHashTag()
+    assert rsrc.localFiles() == [str(data), str(data) + ".schema"]
+    assert (rsrc.fileHashes.hits, rsrc.fileHashes.misses) == (2, 2)
+
+
+def _dataLoadResource(mocker, tmp_path, contents, **kwargs):
+    data = tmp_path / "t.localdata"
+    data.write_bytes(contents)
+    (tmp_path / "t.localdata.schema").write_text("a:string,b:string")
+    client = mocker.MagicMock()
+    client.get_table.side_effect = NotFound("no table")
+    uploaded = {}
+
+    def load(source, table, job_config, job_id, size):
+        uploaded["data"] = source.read()
+        uploaded["size"] = size
+        uploaded["config"] = job_config
+        return mocker.MagicMock()
+
+    client.load_table_from_file.side_effect = load
+    rsrc = BqDataLoadTableResource(str(data), Table("p.d.t"), (), client,
+                                   None, **kwargs)
+    return (rsrc, uploaded)
+
+
+def testDataLoadUploadsRawFileByDefault(mocker, tmp_path):
+    contents = b"a\tb\n" + b"x\ty\n" * 1000
+    (rsrc, uploaded) = _dataLoadResource(mocker, tmp_path, contents)
+    rsrc.create()
+    assert uploaded["data"] == contents
+    assert uploaded["size"] == len(contents)
+    assert uploaded["config"].source_format == SourceFormat.CSV
+    assert uploaded["config"].skip_leading_rows == 1
+
+
+def testDataLoadUploadsGzippedFile(mocker, tmp_path):
+    contents = b'{"a": "x", "b": "y"}\n' * 1000
+    (rsrc, uploaded) = _dataLoadResource(mocker, tmp_path, contents,
+                                         uploadCompression="gzip")
+    rsrc.create()
+    assert gzip.decompress(uploaded["data"]) == contents
+    assert uploaded["size"] == len(uploaded["data"]) < len(contents)
+    assert uploaded["config"].source_format == \
+        SourceFormat.NEWLINE_DELIMITED_JSON
+
+
+def testDataLoadSendsRawFileTooBigToGzip(mocker, tmp_path):
+    contents = b"a\tb\n" + b"x\ty\n" * 1000
+    mocker.patch("resource.MAX_GZIP_UPLOAD_BYTES", 10)
+    (rsrc, uploaded) = _dataLoadResource(mocker, tmp_path, contents,
+                                         uploadCompression="gzip")
+    rsrc.create()
+    assert uploaded["data"] == contents
+
+
+def testDataLoadRejectsUnknownCompression(mocker, tmp_path):
+    with pytest.raises(Exception):
+        _dataLoadResource(mocker, tmp_path, b"a\tb\n",
+                          uploadCompression="zstd")
+
+
+def _blob(mocker, name, updated):
+    blob = mocker.MagicMock()
+    blob.name = name
+    blob.size = 10
+    blob.updated = updated
+    return blob
+
+
+def _extractResource(mocker, gcsListings):
+    gcsClient = mocker.MagicMock()
+    updated = datetime.datetime(2023, 1, 1, tzinfo=datetime.timezone.utc)
+    gcsClient.get_bucket.return_value.list_blobs.return_value = [
+        _blob(mocker, "out/t-%d.csv" % i, updated) for i in range(3)] + \
+        [_blob(mocker, "out/t-0.json", updated)]
+    rsrc = resource.BqExtractTableResource(
+        Table("p.d.t"), mocker.MagicMock(), gcsClient, None,
+        "gs://b/out/t-*.csv", {}, gcsListings=gcsListings)
+    return (gcsClient, rsrc)
+
+
+def testExtractListsPrefixOncePerPass(mocker):
+    gcsListings = resource.GcsListings(None)
+    (gcsClient, rsrc) = _extractResource(mocker, gcsListings)
+    gcsListings.gcsClient = gcsClient
+
+    assert rsrc.exists()
+    assert rsrc.updateTime() == 1672531200000
+    assert rsrc.updateTime() == 1672531200000
+    assert gcsListings.listed == 1
+    gcsClient.get_bucket.return_value.list_blobs.assert_called_once_with(
+        prefix="out/t-", delimiter="/")
+    assert len(resource.gcsUris(gcsClient, rsrc.uris, gcsListings)) == 3
+
+    gcsListings.reset()
+    rsrc.exists()
+    assert gcsListings.listed == 2
+
+
+def testExtractInvalidatesListingWhileWriting(mocker):
+    gcsListings = resource.GcsListings(None)
+    (gcsClient, rsrc) = _extractResource(mocker, gcsListings)
+    gcsListings.gcsClient = gcsClient
+    other = gcsListings.list("b", "elsewhere/")
+
+    rsrc.exists()
+    rsrc.create()
+    rsrc.invalidateMetadata()
+    rsrc.exists()
+    assert gcsListings.listed == 3
+
+    rsrc.extractJob.running.return_value = True
+    assert rsrc.isRunning()
+    rsrc.exists()
+    assert gcsListings.listed == 4
+    assert gcsListings.list("b", "elsewhere/") is other
+
+
+def testGcsBlobExistsFromListing(mocker):
+    gcsClient = mocker.MagicMock()
+    gcsClient.get_bucket.return_value.list_blobs.return_value = [
+        _blob(mocker, "in/_SUCCESS", None),
+        _blob(mocker, "in/_SUCCESS.bak", None)]
+    gcsListings = resource.GcsListings(gcsClient)
+
+    assert resource.gcsBlobExists(gcsClient, "gs://b/in/_SUCCESS",
+                                  gcsListings)
+    assert not resource.gcsBlobExists(gcsClient, "gs://b/in/_SUCC",
+                                      gcsListings)
+    gcsClient.bucket.assert_not_called()
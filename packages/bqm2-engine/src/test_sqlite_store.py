@@ -0,0 +1,29 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlite_store import SqliteStore
+
+SCHEMA = "CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v INTEGER)"
+
+
+def test_persists_between_instances(tmp_path):
+    path = str(tmp_path / "store.db")
+    store = SqliteStore(path, SCHEMA)
+    store.write("INSERT INTO kv (k, v) VALUES (?, ?)", ("a", 1))
+    store.close()
+
+    store = SqliteStore(path, SCHEMA)
+    assert store.fetchone("SELECT v FROM kv WHERE k = ?", ("a",)) == (1,)
+    assert store.fetchone("SELECT v FROM kv WHERE k = ?", ("b",)) is None
+
+
+def test_shared_by_threads(tmp_path):
+    store = SqliteStore(str(tmp_path / "store.db"), SCHEMA)
+
+    def put(i):
+        store.write("INSERT INTO kv (k, v) VALUES (?, ?)", (str(i), i))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(put, range(100)))
+
+    assert sorted(v for (_, v) in store.fetchall("SELECT k, v FROM kv")) \
+        == list(range(100))
@@ -5,7 +5,8 @@ from datetime import datetime, timedelta
 
 from frozendict import frozendict
 
-from tmplhelper import explodeTemplate, handleDateField, evalTmplRecurse
+from tmplhelper import explodeTemplate, handleDateField, evalTmplRecurse, \
+    iterExplodeTemplate, compileTemplate, keysOfTemplate
 
 
 class Test(unittest.TestCase):
@@ -308,6 +309,41 @@ class Test(unittest.TestCase):
         result = set(frozendict(x) for x in result)
         self.assertEqual(expected, result)
 
+    def testIterExplodeTemplateIsLazy(self):
+        templateVars = {"a": list(range(1000)),
+                        "b": list(range(1000)),
+                        "c": [{"d": "e", "f": ["g", "h"]}]}
+
+        result = iterExplodeTemplate(templateVars)
+        self.assertEqual({"a": 0, "b": 0, "d": "e", "f": "g"}, next(result))
+        self.assertEqual({"a": 0, "b": 0, "d": "e", "f": "h"}, next(result))
+        self.assertEqual({"a": 0, "b": 1, "d": "e", "f": "g"}, next(result))
+        self.assertEqual(list, type(templateVars["a"]))
+
+    def testIterExplodeTemplateMatchesExplodeTemplate(self):
+        templateVars = {"yyyymmdd": [-1, -3],
+                        "keywords_table": ["url_kw", "url_kw_title"],
+                        "d": [{"e": ["f", "g"], "h": "i"}, {"e": "j"}]}
+
+        self.assertEqual(explodeTemplate(dict(templateVars)),
+                         list(iterExplodeTemplate(templateVars)))
+        self.assertEqual(3 * 2 * 3,
+                         len(explodeTemplate(templateVars)))
+
+    def testCompiledTemplateMatchesFormat(self):
+        values = {"a": "x", "b": 3, "c": 0.5}
+        for text in ["select {a} from {{escaped}} where b = {b}",
+                     "no fields", "", "{a}{b}{c}",
+                     "{b:03d} {a!r}", "{c.real}"]:
+            compiled = compileTemplate(text)
+            self.assertEqual(text.format(**values), compiled.format(values))
+            self.assertEqual(keysOfTemplate(text), compiled.keys)
+
+        self.assertEqual({"a", "b"}, keysOfTemplate("{a}_{b}_{a}"))
+        self.assertIs(compileTemplate("{a}"), compileTemplate("{a}"))
+        with self.assertRaises(KeyError):
+            compileTemplate("{missing}").format(values)
+
     def testBuildTemplateWithEmptyTable(self):
 
         n = datetime.strptime("20230914", "%Y%m%d")
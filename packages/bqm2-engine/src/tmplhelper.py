@@ -1,3 +1,5 @@
+import functools
+import itertools
 import string
 from datetime import datetime, timedelta
 from dateutil.relativedelta import relativedelta
@@ -44,7 +46,8 @@ def evalTmplRecurse(templateKeys: dict):
         else:
             # format removes any {.} escaping
             if isinstance(templateKeysCopy[k], str):
-                templateKeysCopy[k] = templateKeysCopy[k].format()
+                templateKeysCopy[k] = \
+                    compileTemplate(templateKeysCopy[k]).format({})
             usableKeys[k] = templateKeysCopy[k]
 
     missing_keys = all_keys_needed - set(templateKeysCopy.keys())
@@ -60,8 +63,8 @@ def evalTmplRecurse(templateKeys: dict):
 
             needed = keysNeeded[k]
             if needed.issubset(usableKeys.keys()):
-                templateKeysCopy[k] = templateKeysCopy[k].format(
-                    **usableKeys)
+                templateKeysCopy[k] = compileTemplate(
+                    templateKeysCopy[k]).format(usableKeys)
                 usableKeys[k] = templateKeysCopy[k]
                 del keysNeeded[k]
 
@@ -80,7 +83,55 @@ def evalTmplRecurse(templateKeys: dict):
 def keysOfTemplate(strr):
     if not isinstance(strr, str):
         return set()
-    return set([x[1] for x in string.Formatter().parse(strr) if x[1]])
+    return compileTemplate(strr).keys
+
+
+class CompiledTemplate:
+    """
+    A format string parsed once into literal and field segments.
+
+    format(values) gives the same result as text.format(**values)
+    but only joins the pre split segments, so rendering the same
+    template for many variants doesn't parse it every time.  Templates
+    using conversions, format specs, attribute/index lookups or
+    positional fields fall back to str.format.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.segments = []
+        self.simple = True
+        keys = set()
+        for (literal, field, spec, conversion) in \
+                string.Formatter().parse(text):
+            if literal:
+                self.segments.append((literal, None))
+            if field is None:
+                continue
+            if field:
+                keys.add(field)
+            if spec or conversion or not field.isidentifier():
+                self.simple = False
+            self.segments.append((None, field))
+        self.keys = frozenset(keys)
+
+    def format(self, values: dict) -> str:
+        if not self.simple:
+            return self.text.format(**values)
+        parts = []
+        for (literal, field) in self.segments:
+            if field is None:
+                parts.append(literal)
+            else:
+                value = values[field]
+                parts.append(value if type(value) is str
+                             else format(value))
+        return "".join(parts)
+
+
+@functools.lru_cache(maxsize=4096)
+def compileTemplate(text: str) -> CompiledTemplate:
+    return CompiledTemplate(text)
 
 
 def handleDateField(dt: datetime, val, key) -> str:
@@ -141,8 +192,20 @@ def explodeTemplate(templateVars: dict):
     Goal of this method is simply to replace
     any array elements with simple string expansions
 
-    :return:
+    :return: list of every expansion, see iterExplodeTemplate
     """
+    return list(iterExplodeTemplate(templateVars))
+
+
+def iterExplodeTemplate(templateVars: dict):
+    """
+    Generator form of explodeTemplate.  Yields one expanded dict at a
+    time, in the same order, so callers never hold the whole cartesian
+    product of the vars in memory.
+
+    :return: generator of dicts without any list values
+    """
+    templateVars = templateVars.copy()
 
     # check for key with yyyymm, yyyymmdd, or yyyymmddhh
     # and handle it specially
@@ -153,31 +216,17 @@ def explodeTemplate(templateVars: dict):
 
     topremute = []
     for (k, v) in templateVars.items():
-        items = []
         if isinstance(v, list):
-            for vv in v:
-                items.append((k, vv))
+            topremute.append([(k, vv) for vv in v])
         else:
-            items.append((k, v))
-        topremute.append(items)
-
-    collect = []
-    out = []
-    makeCombinations(topremute, out, collect)
-    # now make maps
-    maps = []
-    for s in collect:
-        maps.append(handle_map_of_maps(dict(s)))
-
-    final = []
-    for m in maps:
-        types = set([type(x) for x in m.values()])
-        if list in types:
-            final += explodeTemplate(m)
-        else:
-            final.append(m)
+            topremute.append([(k, v)])
 
-    return final
+    for s in makeCombinations(topremute):
+        m = handle_map_of_maps(dict(s))
+        if any(isinstance(x, list) for x in m.values()):
+            yield from iterExplodeTemplate(m)
+        else:
+            yield m
 
 
 def handle_map_of_maps(m):
@@ -190,28 +239,17 @@ def handle_map_of_maps(m):
     return ret
 
 
-def makeCombinations(lists: list, out: list, collect: list):
+def makeCombinations(lists: list):
     """
-        given a list of lists, generate a list of lists which
-        has all combinations of each element as a member
+        given a list of lists, lazily generate all combinations
+        of each element as a member
 
         Example:
-            [[a,b], [c,d]] becomes
+            [[a,b], [c,d]] yields
 
-            [
-             [a,c],
-             [a,d],
-             [b,c],
-             [b,d]
-            ]
+             (a,c),
+             (a,d),
+             (b,c),
+             (b,d)
     """
-    if not len(lists):
-        collect.append(out)
-        return
-
-    listsCopy = lists.copy()
-    first = listsCopy.pop(0)
-    for m in first:
-        outCopy = out.copy()
-        outCopy.append(m)
-        makeCombinations(listsCopy, outCopy, collect)
+    return itertools.product(*lists)